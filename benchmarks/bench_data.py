@@ -0,0 +1,84 @@
+"""
+                        This script includes seeded generators of synthetic data used by the
+                                    benchmarks of the modelselec package
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-04-01
+"""
+import numpy as np
+import pandas as pd
+
+
+def make_db(n_rows: int, n_continuous: int = 10, n_categorical: int = 3, n_categories: int = 8,
+            seed: int = 0) -> pd.DataFrame:
+    """
+    This function generates a database of continuous and categorical variables. Continuous variables are correlated
+    normal variables with 1% of missing values, categorical variables are strings whose frequencies decrease
+    :param n_rows: int, the number of rows
+    :param n_continuous: int, optional, the number of continuous variables, named cont_0, cont_1, ...
+    :param n_categorical: int, optional, the number of categorical variables, named categ_0, categ_1, ...
+    :param n_categories: int, optional, the number of categories of each categorical variable
+    :param seed: int, optional, the seed of the random generator
+    :return: pd.DataFrame, the database
+    """
+    rng = np.random.default_rng(seed)
+    common = rng.standard_normal(n_rows)
+    columns = {}
+    for i in range(n_continuous):
+        values = 0.5 * common + rng.standard_normal(n_rows) * (i + 1)
+        values[rng.random(n_rows) < 0.01] = np.nan
+        columns[f'cont_{i}'] = values
+    weights = 1 / np.arange(1, n_categories + 1)
+    labels = np.array([f'label_{j}' for j in range(n_categories)], dtype=object)
+    for i in range(n_categorical):
+        columns[f'categ_{i}'] = labels[rng.choice(n_categories, size=n_rows, p=weights / weights.sum())]
+    return pd.DataFrame(columns)
+
+
+def make_levels(n_rows: int, n_series: int = 10, seed: int = 0) -> pd.DataFrame:
+    """
+    This function generates positive series in level, as geometric random walks
+    :param n_rows: int, the number of periods
+    :param n_series: int, optional, the number of series, named lvl_0, lvl_1, ...
+    :param seed: int, optional, the seed of the random generator
+    :return: pd.DataFrame, one column per series
+    """
+    rng = np.random.default_rng(seed)
+    log_levels = np.cumsum(rng.normal(loc=0.0001, scale=0.01, size=(n_rows, n_series)), axis=0)
+    return pd.DataFrame(100 * np.exp(log_levels), columns=[f'lvl_{i}' for i in range(n_series)])
+
+
+def make_panel(n_rows: int, n_series: int = 10, n_entities: int = 100, seed: int = 0) -> pd.DataFrame:
+    """
+    This function generates a long-format panel of entities whose series are in level, with rows in random order
+    :param n_rows: int, the number of rows, split evenly between entities
+    :param n_series: int, optional, the number of series, named lvl_0, lvl_1, ...
+    :param n_entities: int, optional, the number of entities, named ent_0, ent_1, ...
+    :param seed: int, optional, the seed of the random generator
+    :return: pd.DataFrame, with the columns entity and period followed by one column per series
+    """
+    rng = np.random.default_rng(seed)
+    panel = make_levels(n_rows=n_rows, n_series=n_series, seed=seed)
+    panel.insert(0, 'entity', np.array([f'ent_{i}' for i in range(n_entities)])[np.arange(n_rows) % n_entities])
+    panel.insert(1, 'period', np.arange(n_rows) // n_entities)
+    return panel.iloc[rng.permutation(n_rows)].reset_index(drop=True)
+
+
+def make_predictions(n_rows: int, y_type: str = 'num', n_classes: int = 5, seed: int = 0) -> tuple:
+    """
+    This function generates observed values of a dependent variable and the values predicted by a model
+    :param n_rows: int, the number of observations
+    :param y_type: str, optional, 'num' for a numerical dependent variable and 'categ' for a categorical one
+    :param n_classes: int, optional, the number of classes of a categorical dependent variable
+    :param seed: int, optional, the seed of the random generator
+    :return: tuple of 2 pd.DataFrame of 1 column named y, the observed and the predicted values
+    """
+    rng = np.random.default_rng(seed)
+    if y_type == 'num':
+        obs = 100 * np.exp(np.cumsum(rng.normal(scale=0.01, size=n_rows)))
+        pred = obs * np.exp(rng.normal(scale=0.02, size=n_rows))
+    else:
+        obs = rng.integers(0, n_classes, size=n_rows)
+        pred = np.where(rng.random(n_rows) < 0.7, obs, rng.integers(0, n_classes, size=n_rows))
+    return pd.DataFrame({'y': obs}), pd.DataFrame({'y': pred})
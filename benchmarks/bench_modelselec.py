@@ -0,0 +1,235 @@
+"""
+                        This script runs the benchmarks of the modelselec package on synthetic data
+                            of several sizes and compares the results with a stored baseline
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-04-01
+
+Usage:
+    python benchmarks/bench_modelselec.py --rows 1e3 1e5 --cols 10 --output results.json
+    python benchmarks/bench_modelselec.py --rows 1e3 1e5 --cols 10 --output new.json --baseline results.json
+"""
+import argparse, gc, json, os, platform, sys, tempfile, time, tracemalloc
+from datetime import datetime
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+# The libraries which modelselec imports on first use are imported here so that no benchmark measures their import
+import seaborn, sklearn.metrics
+# The package is imported from the source tree the benchmarks belong to
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_data import make_db, make_levels, make_panel, make_predictions
+from modelselec.db.db_cls import DBhist
+from modelselec.eda.categorical_var import categorical_categorical_crosstab
+from modelselec.eda.continuous_var import continuous_categorical_stats, continuous_categorical_overlap_histogram, \
+    continuous_categorical_boxplot, continuous_continuous_scatter, continuous_continuous_heatmap
+from modelselec.util.util_db import diff, ln_diff, diff_inv, ln_diff_inv, diff_inv_paths, panel_transform
+from modelselec.util.util_perf import perf_metrics
+
+
+class BenchData:
+    """
+    This class generates the synthetic data of one size on first use and keeps it for every benchmark of that size
+    """
+
+    def __init__(self, n_rows: int, n_cols: int, seed: int, tmp_dir: str):
+        self.n_rows, self.n_cols, self.seed, self.tmp_dir = n_rows, n_cols, seed, tmp_dir
+        self._cache = {}
+
+    def get(self, name: str):
+        if name not in self._cache:
+            self._cache[name] = getattr(self, '_make_' + name)()
+        return self._cache[name]
+
+    def _make_db(self) -> pd.DataFrame:
+        return make_db(n_rows=self.n_rows, n_continuous=self.n_cols, n_categorical=max(2, self.n_cols // 4),
+                       seed=self.seed)
+
+    def _make_levels(self) -> pd.DataFrame:
+        return make_levels(n_rows=self.n_rows, n_series=self.n_cols, seed=self.seed)
+
+    def _make_diff(self) -> pd.DataFrame:
+        return diff(db=self.get('levels'), nTransf=1)
+
+    def _make_ln_diff(self) -> pd.DataFrame:
+        return ln_diff(db=self.get('levels'), nTransf=1)
+
+    def _make_paths(self) -> np.ndarray:
+        # The simulated paths hold as many values as the other data, split into 100 paths
+        rng = np.random.default_rng(self.seed)
+        return rng.normal(loc=0.0001, scale=0.01, size=(100, max(1, self.n_rows // 100), self.n_cols))
+
+    def _make_panel(self) -> pd.DataFrame:
+        return make_panel(n_rows=self.n_rows, n_series=self.n_cols, seed=self.seed)
+
+    def _make_num(self) -> tuple:
+        return make_predictions(n_rows=self.n_rows, y_type='num', seed=self.seed)
+
+    def _make_categ(self) -> tuple:
+        return make_predictions(n_rows=self.n_rows, y_type='categ', seed=self.seed)
+
+    def _make_parquet(self) -> str:
+        self.get('db').to_parquet(os.path.join(self.tmp_dir, 'bench.parquet'))
+        return self.tmp_dir + '/'
+
+    def _make_csv(self) -> str:
+        self.get('db').to_csv(os.path.join(self.tmp_dir, 'bench.csv'), index=False)
+        return self.tmp_dir + '/'
+
+
+def _plot_dir(data: BenchData) -> str:
+    return data.tmp_dir + '/'
+
+
+# Each benchmark builds, from the synthetic data, the function whose run is measured, and is skipped above max_rows
+BENCHMARKS = {
+    'dbhist_load_parquet': (lambda data: lambda: DBhist(path_db=data.get('parquet'), file_name='bench',
+                                                        file_type='parquet', lazy=True).db, None),
+    'dbhist_load_csv': (lambda data: lambda: DBhist(path_db=data.get('csv'), file_name='bench', file_type='csv',
+                                                    lazy=True).db, 10**6),
+    'dbhist_get_desc': (lambda data: lambda: DBhist(path_db=data.get('parquet'), file_name='bench',
+                                                    file_type='parquet', lazy=True).get_desc(db=data.get('db')),
+                        None),
+    'diff': (lambda data: lambda: diff(db=data.get('levels'), nTransf=1), None),
+    'ln_diff': (lambda data: lambda: ln_diff(db=data.get('levels'), nTransf=1), None),
+    'diff_inv': (lambda data: lambda: diff_inv(db=data.get('diff'), nTransf=1, t0=data.get('levels').head(1)), None),
+    'ln_diff_inv': (lambda data: lambda: ln_diff_inv(db=data.get('ln_diff'), nTransf=1,
+                                                     t0=data.get('levels').head(1)), None),
+    'diff_inv_paths': (lambda data: lambda: diff_inv_paths(values=data.get('paths'), nTransf=1,
+                                                           t0=data.get('levels').head(1), log=True,
+                                                           quantiles=[0.05, 0.5, 0.95]), None),
+    'panel_transform': (lambda data: lambda: panel_transform(db=data.get('panel'), entity='entity', time='period',
+                                                             lags=[1, 4, 12]), None),
+    'perf_metrics_num': (lambda data: lambda: perf_metrics(obs=data.get('num')[0], pred=data.get('num')[1],
+                                                           y_type='num', transf='diffln'), None),
+    'perf_metrics_categ': (lambda data: lambda: perf_metrics(obs=data.get('categ')[0], pred=data.get('categ')[1],
+                                                             y_type='categ'), None),
+    'continuous_categorical_stats': (lambda data: lambda: continuous_categorical_stats(
+        db=data.get('db'), continuous_var='cont_0', categorical_var='categ_0'), None),
+    'categorical_categorical_crosstab': (lambda data: lambda: categorical_categorical_crosstab(
+        db=data.get('db'), var1='categ_0', var2='categ_1'), None),
+    'continuous_categorical_overlap_histogram': (lambda data: lambda: continuous_categorical_overlap_histogram(
+        db=data.get('db'), continuous_var='cont_0', categorical_var='categ_0', path_save=_plot_dir(data)), None),
+    'continuous_categorical_boxplot': (lambda data: lambda: continuous_categorical_boxplot(
+        db=data.get('db'), continuous_var='cont_0', categorical_var='categ_0', path_save=_plot_dir(data)), 10**6),
+    'continuous_continuous_scatter': (lambda data: lambda: continuous_continuous_scatter(
+        db=data.get('db'), x_var='cont_0', y_var='cont_1', path_save=_plot_dir(data), aggregate=True), None),
+    'continuous_continuous_heatmap': (lambda data: lambda: continuous_continuous_heatmap(
+        db=data.get('db'), var_list=[f'cont_{i}' for i in range(data.n_cols)], path_save=_plot_dir(data)), None),
+}
+
+
+def measure(func, repeat: int) -> dict:
+    """
+    This function measures the wall time of a function as the fastest of several runs, and the peak of the memory
+    allocated during one more run traced by tracemalloc, which covers the allocations of Python and numpy
+    :param func: callable without arguments, the function to be measured
+    :param repeat: int, the number of timed runs
+    :return: dict, the wall time in seconds and the peak memory in bytes
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+        plt.close('all')
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        plt.close('all')
+    return {'seconds': min(times), 'peak_bytes': peak_bytes}
+
+
+def run_benchmarks(rows: list, cols: list, names: list = None, repeat: int = 3, seed: int = 0) -> dict:
+    """
+    This function runs the benchmarks on synthetic data of every combination of number of rows and columns
+    :param rows: list of int, the numbers of rows
+    :param cols: list of int, the numbers of continuous variables
+    :param names: list of str, optional, the benchmarks to be run. All of them by default
+    :param repeat: int, optional, the number of timed runs of each benchmark
+    :param seed: int, optional, the seed of the synthetic data
+    :return: dict, the results and the environment they were measured in
+    """
+    names = list(BENCHMARKS) if names is None else names
+    results = []
+    for n_rows in rows:
+        for n_cols in cols:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                data = BenchData(n_rows=n_rows, n_cols=n_cols, seed=seed, tmp_dir=tmp_dir)
+                for name in names:
+                    make_func, max_rows = BENCHMARKS[name]
+                    if (max_rows is not None) and (n_rows > max_rows):
+                        continue
+                    result = {'benchmark': name, 'n_rows': n_rows, 'n_cols': n_cols,
+                              **measure(func=make_func(data), repeat=repeat)}
+                    print(f"{name:<42} rows={n_rows:<10} cols={n_cols:<5} {result['seconds']:10.4f} s "
+                          f"{result['peak_bytes'] / 1024 ** 2:10.1f} MiB", flush=True)
+                    results.append(result)
+    return {'created': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': np.__version__, 'pandas': pd.__version__, 'seed': seed,
+            'repeat': repeat, 'results': results}
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float = 0.2) -> pd.DataFrame:
+    """
+    This function compares benchmark results with a baseline measured on the same benchmarks and sizes
+    :param results: dict, the results returned by run_benchmarks
+    :param baseline: dict, the baseline results, in the same format
+    :param tolerance: float, optional, the relative increase in wall time or peak memory above which a benchmark is
+                        flagged as a regression
+    :return: pd.DataFrame, one row per benchmark and size found in both results, with the ratios to the baseline
+    """
+    keys = ['benchmark', 'n_rows', 'n_cols']
+    comparison = pd.DataFrame(results['results']).merge(pd.DataFrame(baseline['results']), on=keys,
+                                                        suffixes=('', '_baseline'))
+    comparison['time_ratio'] = comparison['seconds'] / comparison['seconds_baseline']
+    comparison['memory_ratio'] = comparison['peak_bytes'] / comparison['peak_bytes_baseline'].clip(lower=1)
+    comparison['regression'] = (comparison['time_ratio'] > 1 + tolerance) | \
+                               (comparison['memory_ratio'] > 1 + tolerance)
+    return comparison[keys + ['seconds', 'seconds_baseline', 'time_ratio', 'peak_bytes', 'peak_bytes_baseline',
+                              'memory_ratio', 'regression']]
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks of the modelselec package on synthetic data')
+    parser.add_argument('--rows', nargs='+', type=float, default=[1e3, 1e4, 1e5],
+                        help='numbers of rows of the synthetic data, from 1e3 to 1e7')
+    parser.add_argument('--cols', nargs='+', type=int, default=[10], help='numbers of continuous variables')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), default=None,
+                        help='benchmarks to be run, all of them by default')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--output', default='bench_results.json', help='path of the JSON results file')
+    parser.add_argument('--baseline', default=None, help='path of a JSON results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative increase in time or memory flagged as a regression')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(rows=[int(n_rows) for n_rows in args.rows], cols=args.cols, names=args.benchmarks,
+                             repeat=args.repeat, seed=args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved in {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare_results(results=results, baseline=baseline, tolerance=args.tolerance)
+        with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.max_rows', None):
+            print(comparison.round(4).to_string(index=False))
+        if comparison['regression'].any():
+            print(f"{comparison['regression'].sum()} regressions above {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,31 @@
 """
-                            This script is necessary to ensure that all submodules are imported
-                                        when model_selec is imported
+                            This script is necessary to ensure that all submodules are available
+                            when model_selec is imported, each of them is imported on first use
 
                                             Guillaume A. Khayat
                                            guill.khayat@gmail.com
                                                 2024-03-12
 """
+import importlib
 
 __all__ = ['db_cls']
 
-# Import the specified submodules
-from . import db_cls
+
+# The specified submodules are imported on first access, so that importing the package stays fast
+def __getattr__(name: str):
+    """
+    This function imports a submodule the first time it is accessed as an attribute of the package
+    :param name: str, the name of the attribute
+    :return: module, the submodule
+    """
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    """
+    This function lists the attributes of the package, including the submodules which are not imported yet
+    :return: list of str, the names of the attributes
+    """
+    return sorted(set(globals()) | set(__all__))
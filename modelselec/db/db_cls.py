@@ -6,46 +6,271 @@
                                                 2023-12-15
 """
 import attr
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Union
 from modelselec.modules_paths import *
-from modelselec.util.util_db import check_file_exists
+from modelselec.util.util_profile import profiled
+from modelselec.util.util_db import check_file_exists, apply_filters, compact_dtypes, memory_report, dataset_files, \
+    read_dataset_file, _filter_columns
+from modelselec.util.util_stats import SummaryState, parquet_footer_desc
+from modelselec.util.util_cache import read_csv_cached
 
 
 @attr.define(slots=True)
 class DBhist:
     """
-    This class stores historical databases and provides attributes and methods to be applied to them
+    This class stores historical databases and provides attributes and methods to be applied to them.
+    When lazy is True, the file is only read the first time db is accessed and the descriptions are only
+    computed the first time desc_continuous or desc_categorical are accessed.
+    When chunksize is provided, the descriptions and the percentage of NAs are computed by reading the file chunk by
+    chunk, so that the file is never held in memory unless db is accessed.
+    When compact is True, the dtypes of the database are made more compact after it is read.
+    When cache_dir is provided, parsed .csv files are cached in that directory as Feather files.
+    When file_type is 'dataset', file_name is either a directory of .parquet files partitioned as key=value
+    directories or a glob pattern of .parquet files. Files whose partitions do not satisfy the filters are skipped,
+    the others are read over a pool of n_jobs threads and the descriptions are merged from summaries of each file.
+    When footer_stats is True, the count, min and max rows of the descriptions and the percentage of NAs of a
+    .parquet file are read from the statistics stored in its footer, without reading the column data. The other
+    rows are NaN until complete_desc is called.
+    When mergeable_desc is True, the descriptions of a database held in memory are computed from mergeable summaries,
+    so that the summaries of rows added through append_rows or update_db are merged into them instead of describing
+    the whole database again. The 25%, 50% and 75% rows then come from quantile sketches and are approximate for
+    large databases
     """
 
     path_db: str = attr.field(validator=attr.validators.instance_of(str))
     file_name: str = attr.field(validator=attr.validators.and_(attr.validators.instance_of(str),
                                                                check_file_exists))
     file_type: str = attr.field(default='parquet', validator=attr.validators.instance_of(str))
-    desc_continuous: Union[pd.DataFrame, None] = attr.field(default=None)
-    desc_categorical: Union[pd.DataFrame, None] = attr.field(default=None)
+    _desc_continuous: Union[pd.DataFrame, None] = attr.field(default=None)
+    _desc_categorical: Union[pd.DataFrame, None] = attr.field(default=None)
     dtype: dict = attr.field(default=None, validator=attr.validators.optional(attr.validators.instance_of(dict)))
     parse_dates: list = attr.field(default=None, validator=attr.validators.optional(attr.validators.instance_of(list)))
     header: int = attr.field(default=0, validator=attr.validators.instance_of(int))
+    columns: list = attr.field(default=None, validator=attr.validators.optional(attr.validators.instance_of(list)))
+    filters: list = attr.field(default=None, validator=attr.validators.optional(attr.validators.instance_of(list)))
+    lazy: bool = attr.field(default=False, validator=attr.validators.instance_of(bool))
+    chunksize: int = attr.field(default=None, validator=attr.validators.optional(
+        attr.validators.and_(attr.validators.instance_of(int), attr.validators.gt(0))))
+    compact: bool = attr.field(default=False, validator=attr.validators.instance_of(bool))
+    category_threshold: float = attr.field(default=0.5, validator=attr.validators.instance_of((int, float)))
+    arrow_strings: bool = attr.field(default=False, validator=attr.validators.instance_of(bool))
+    cache_dir: str = attr.field(default=None, validator=attr.validators.optional(attr.validators.instance_of(str)))
+    cache_max_bytes: int = attr.field(default=10 * 1024 ** 3, validator=attr.validators.instance_of(int))
+    footer_stats: bool = attr.field(default=False, validator=attr.validators.instance_of(bool))
+    n_jobs: int = attr.field(default=None, validator=attr.validators.optional(attr.validators.instance_of(int)))
+    mergeable_desc: bool = attr.field(default=False, validator=attr.validators.instance_of(bool))
 
-    db: pd.DataFrame = attr.field(init=False)
+    _db: Union[pd.DataFrame, None] = attr.field(init=False, default=None)
+    _desc_stale: bool = attr.field(init=False, default=True)
+    _summary_state: Union[SummaryState, None] = attr.field(init=False, default=None)
+    _db_parts: list = attr.field(init=False, factory=list)
+    _memory_report: Union[pd.DataFrame, None] = attr.field(init=False, default=None)
+    _footer_na: Union[pd.Series, None] = attr.field(init=False, default=None)
 
     def __attrs_post_init__(self):
         """
-        Read the historical data file into a pandas DataFrame after the instance is created
+        Read the historical data file into a pandas DataFrame after the instance is created,
+        unless the instance is lazy
+        """
+        if self.footer_stats and ((self.file_type != 'parquet') or self.filters):
+            raise Exception("'footer_stats' is only available for parquet files read without filters")
+        self._desc_stale = True
+        if not self.lazy:
+            self._refresh_desc()
+
+    @property
+    def db(self) -> pd.DataFrame:
+        """
+        The historical database, read from the file on first access if the instance is lazy. Rows added through
+        append_rows are concatenated to it on first access
+        """
+        if self._db is None:
+            self._db = self.load_db()
+        if len(self._db_parts) > 0:
+            self._db = pd.concat(objs=[self._db, *self._db_parts], axis='index')
+            self._db_parts = []
+        return self._db
+
+    @db.setter
+    def db(self, value: pd.DataFrame) -> None:
+        self._db = value
+        self._db_parts = []
+
+    @property
+    def desc_continuous(self) -> Union[pd.DataFrame, None]:
+        """
+        The description of the continuous variables, computed on first access if the instance is lazy
+        """
+        if self._desc_stale:
+            self._refresh_desc()
+        return self._desc_continuous
+
+    @desc_continuous.setter
+    def desc_continuous(self, value: Union[pd.DataFrame, None]) -> None:
+        self._desc_continuous = value
+        self._desc_stale = False
+
+    @property
+    def desc_categorical(self) -> Union[pd.DataFrame, None]:
+        """
+        The description of the categorical variables, computed on first access if the instance is lazy
+        """
+        if self._desc_stale:
+            self._refresh_desc()
+        return self._desc_categorical
+
+    @desc_categorical.setter
+    def desc_categorical(self, value: Union[pd.DataFrame, None]) -> None:
+        self._desc_categorical = value
+        self._desc_stale = False
+
+    def _refresh_desc(self) -> None:
+        """
+        Compute the descriptions of the continuous and categorical variables and store them as attributes
+        :return: None
+        """
+        self._footer_na = None
+        if self.footer_stats and (self._db is None) and (len(self._db_parts) == 0):
+            self._summary_state = None
+            desc_continuous, desc_categorical, self._footer_na = parquet_footer_desc(
+                path=f'{self.path_db}{self.file_name}.parquet', columns=self.columns)
+        elif ((self.chunksize is not None) or (self.file_type == 'dataset')) and (self._db is None):
+            self._summary_state = self.stream_summary()
+            for part in self._db_parts:
+                self._summary_state = self._summary_state.merge(SummaryState.from_frame(db=part))
+            desc_continuous, desc_categorical = self._summary_state.get_desc()
+        elif self.mergeable_desc:
+            self._summary_state = SummaryState.from_frame(db=self.db)
+            desc_continuous, desc_categorical = self._summary_state.get_desc()
+        else:
+            self._summary_state = None
+            desc_continuous, desc_categorical = self.get_desc()
+        self._desc_continuous = desc_continuous
+        self._desc_categorical = desc_categorical
+        self._desc_stale = False
+
+    @profiled
+    def load_db(self) -> pd.DataFrame:
+        """
+        A method to read the historical data file, only keeping the requested columns and the rows which satisfy
+        the filters. Both are pushed down into the reader for parquet files
+        :return: pd.DataFrame, the historical database
         """
         match self.file_type:
             case 'parquet':
-                self.db = pd.read_parquet(path=f'{self.path_db}{self.file_name}.parquet')
+                db = pd.read_parquet(path=f'{self.path_db}{self.file_name}.parquet', columns=self.columns,
+                                     filters=self.filters)
+            case 'csv' if self.cache_dir is not None:
+                db = read_csv_cached(path=f'{self.path_db}{self.file_name}.csv', cache_dir=self.cache_dir,
+                                     max_bytes=self.cache_max_bytes, dtype=self.dtype, parse_dates=self.parse_dates,
+                                     header=self.header, usecols=self._read_columns())
+                db = self._filter(db=db)
             case 'csv':
-                self.db = pd.read_csv(filepath_or_buffer=f'{self.path_db}{self.file_name}.csv', dtype=self.dtype,
-                                      header=self.header, parse_dates=self.parse_dates)
+                db = pd.read_csv(filepath_or_buffer=f'{self.path_db}{self.file_name}.csv', dtype=self.dtype,
+                                 header=self.header, parse_dates=self.parse_dates, usecols=self._read_columns())
+                db = self._filter(db=db)
+            case 'dataset':
+                import pyarrow as pa
+                tables = self._map_dataset(lambda table: table)
+                if len(tables) == 0:
+                    db = pd.DataFrame(columns=self.columns)
+                else:
+                    table = pa.concat_tables(tables, promote_options='default')
+                    # The Arrow buffers are released while they are converted, which bounds the peak memory
+                    del tables
+                    db = table.to_pandas(self_destruct=True)
+                    del table
+            case _:
+                raise Exception(f"'file_type' should be either 'parquet', 'csv' or 'dataset', not "
+                                f"'{self.file_type}'")
+
+        if self.compact:
+            db_compact = compact_dtypes(db=db, category_threshold=self.category_threshold,
+                                        arrow_strings=self.arrow_strings)
+            self._memory_report = memory_report(db_before=db, db_after=db_compact)
+            db = db_compact
+        return db
+
+    @profiled
+    def get_memory_report(self) -> pd.DataFrame:
+        """
+        A method to provide the memory used by each column of the database before and after its dtypes were made
+        more compact
+        :return: pd.DataFrame, indexed by column name, with the dtype and the number of bytes before and after the
+                    conversion and the percentage of memory saved
+        """
+        if not self.compact:
+            raise Exception("The memory report is only available when 'compact' is True")
+        if self._memory_report is None:
+            # Accessing db reads the file, which computes the report, if the instance is lazy
+            self.db
+        return self._memory_report
 
+    @profiled
+    def stream_summary(self) -> SummaryState:
+        """
+        A method to summarize the historical data file chunk by chunk, only keeping the requested columns and the rows
+        which satisfy the filters. Peak memory is bounded by the chunk size
+        :return: SummaryState, the mergeable summaries of every column of the file
+        """
+        state = SummaryState()
+        match self.file_type:
+            case 'parquet':
+                import pyarrow.parquet as pq
+                parquet_file = pq.ParquetFile(f'{self.path_db}{self.file_name}.parquet')
+                for batch in parquet_file.iter_batches(batch_size=self.chunksize, columns=self._read_columns()):
+                    state.update(self._filter(db=batch.to_pandas()))
+            case 'csv':
+                with pd.read_csv(filepath_or_buffer=f'{self.path_db}{self.file_name}.csv', dtype=self.dtype,
+                                 header=self.header, parse_dates=self.parse_dates, usecols=self._read_columns(),
+                                 chunksize=self.chunksize) as reader:
+                    for chunk in reader:
+                        state.update(self._filter(db=chunk))
+            case 'dataset':
+                for file_state in self._map_dataset(lambda table: SummaryState.from_frame(db=table.to_pandas())):
+                    state = state.merge(file_state)
+            case _:
+                raise Exception(f"'file_type' should be either 'parquet', 'csv' or 'dataset', not "
+                                f"'{self.file_type}'")
+        return state
+
+    def _read_columns(self) -> Union[list, None]:
+        """
+        A method to list the columns to be read from the file: the requested columns and the columns the filters
+        have conditions on
+        :return: list of str, or None if all columns are requested
+        """
+        if self.columns is None:
+            return None
+        return list(dict.fromkeys(self.columns + _filter_columns(self.filters)))
 
-        desc_continuous, desc_categorical = self.get_desc()
-        self.desc_continuous = desc_continuous
-        self.desc_categorical = desc_categorical
+    def _filter(self, db: pd.DataFrame) -> pd.DataFrame:
+        """
+        A method to keep the rows of a dataframe read from the file which satisfy the filters, then drop the columns
+        which were only read for the filters
+        :param db: pd.DataFrame, the rows read from the file
+        :return: pd.DataFrame, the filtered rows of the requested columns
+        """
+        db = apply_filters(db=db, filters=self.filters)
+        if (self.columns is None) or (len(db.columns) == len(self.columns)):
+            return db
+        return db[[col for col in db.columns if col in self.columns]]
 
+    def _map_dataset(self, func) -> list:
+        """
+        A method to read the files of a partitioned dataset over a pool of threads and apply a function to each of
+        them, only keeping the requested columns and the rows which satisfy the filters
+        :param func: callable, applied to the pyarrow.Table of each file
+        :return: list, the outputs of func for each file, in the order of the file paths
+        """
+        files = dataset_files(path=f'{self.path_db}{self.file_name}', filters=self.filters)
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            return list(executor.map(lambda file: func(read_dataset_file(path=file[0], partition=file[1],
+                                                                         columns=self.columns,
+                                                                         filters=self.filters)), files))
 
+    @profiled
     def get_desc(self, db: pd.DataFrame = None) -> Tuple[Union[pd.DataFrame, None], Union[pd.DataFrame, None]]:
         """
         A method to provide the description of the pandas dataframe
@@ -66,12 +291,56 @@ class DBhist:
             desc_continuous = None
 
         if len(categorical_cols) > 0:
-            desc_categorical = db.select_dtypes(exclude=np.number).describe()
+            # Datetimes are described with their mean, min, quantiles and max, and the other columns are kept
+            desc_categorical = db.select_dtypes(exclude=np.number).describe(include='all')
         else:
             desc_categorical = None
 
         return desc_continuous, desc_categorical
 
+    @profiled
+    def complete_desc(self, stats: list = None) -> None:
+        """
+        A method to compute the rows of the descriptions which are missing, e.g. the mean, std and quantiles when
+        the descriptions were read from the footer of a .parquet file. Only the columns with missing values in the
+        requested rows are read, chunk by chunk when chunksize is provided
+        :param stats: list, optional, the rows of the descriptions to be computed, e.g. ['mean', 'std']. All rows by
+                        default
+        :return: None
+        """
+        if self._desc_stale:
+            self._refresh_desc()
+        descs = {'continuous': self._desc_continuous, 'categorical': self._desc_categorical}
+        rows, cols = {}, []
+        for key, desc in descs.items():
+            if desc is None:
+                continue
+            rows[key] = [row for row in desc.index if (stats is None) or (row in stats)]
+            cols += [col for col in desc.columns if desc.loc[rows[key], col].isna().any()]
+        if len(cols) == 0:
+            return
+
+        if self._db is not None:
+            desc_continuous, desc_categorical = self.get_desc(db=self._db[cols])
+        elif self.chunksize is not None:
+            import pyarrow.parquet as pq
+            state = SummaryState()
+            parquet_file = pq.ParquetFile(f'{self.path_db}{self.file_name}.parquet')
+            for batch in parquet_file.iter_batches(batch_size=self.chunksize, columns=cols):
+                state.update(batch.to_pandas())
+            desc_continuous, desc_categorical = state.get_desc()
+        else:
+            desc_continuous, desc_categorical = self.get_desc(
+                db=pd.read_parquet(path=f'{self.path_db}{self.file_name}.parquet', columns=cols))
+
+        for key, desc_scan in [('continuous', desc_continuous), ('categorical', desc_categorical)]:
+            if (descs[key] is None) or (desc_scan is None):
+                continue
+            scan_cols = [col for col in desc_scan.columns if col in descs[key].columns]
+            scan_rows = [row for row in rows[key] if row in desc_scan.index]
+            descs[key].loc[scan_rows, scan_cols] = desc_scan.loc[scan_rows, scan_cols]
+
+    @profiled
     def get_na_percent(self, db: pd.DataFrame = None) -> pd.Series:
         """
         A method to provide the percentage of NAs in each column of the dataframe
@@ -80,6 +349,15 @@ class DBhist:
                     the index of the series are the column names of the dataframe
         """
 
+        if (db is None) and self.footer_stats and (self._db is None):
+            if self._desc_stale:
+                self._refresh_desc()
+            if (self._footer_na is not None) and not self._footer_na.isna().any():
+                return self._footer_na.copy()
+        if (db is None) and ((self.chunksize is not None) or (self.file_type == 'dataset')) and (self._db is None):
+            if self._desc_stale:
+                self._refresh_desc()
+            return self._summary_state.get_na_percent()
         if db is None:
             db = self.db
 
@@ -87,15 +365,119 @@ class DBhist:
         prct_nas.name = '% of NA obs.'
         return prct_nas
 
+    @profiled
+    def append_rows(self, db_rows: pd.DataFrame) -> None:
+        """
+        This method appends rows to the historical database. The existing dataframe is not copied, the rows are only
+        concatenated to it the next time db is accessed. If the descriptions come from mergeable summaries, i.e. when
+        mergeable_desc is True or the file is described chunk by chunk, the summaries of the new rows are merged into
+        them. Otherwise the descriptions are computed again on the whole database the next time they are accessed
+        :param db_rows: pd.DataFrame, the rows to be appended, with the same columns as the historical database
+        :return: None
+        """
+        columns = list(self._summary_state.na_counts) if self._summary_state is not None else \
+            list(self._db.columns) if self._db is not None else list(db_rows.columns)
+        if list(db_rows.columns) != columns:
+            raise Exception('The appended rows should have the same columns as the historical database')
+        if (not self._desc_stale) and (self._summary_state is not None):
+            self._summary_state = self._summary_state.merge(SummaryState.from_frame(db=db_rows))
+            self._desc_continuous, self._desc_categorical = self._summary_state.get_desc()
+        else:
+            self._desc_stale = True
+        self._db_parts.append(db_rows)
+
+    @profiled
+    def update_columns(self, db_columns: pd.DataFrame) -> None:
+        """
+        This method adds or replaces columns of the historical database in place. Only the columns whose values
+        actually changed are described again
+        :param db_columns: pd.DataFrame, the new columns, with the same index as the historical database
+        :return: None
+        """
+        db = self.db
+        if not db_columns.index.equals(db.index):
+            raise Exception('The updated columns should have the same index as the historical database')
+
+        changed = [col for col in db_columns.columns if (col not in db.columns) or
+                   (not db[col].equals(db_columns[col]))]
+        for col in changed:
+            db[col] = db_columns[col]
+        self._update_desc_columns(changed=changed)
+
+    def _update_desc_columns(self, changed: list, removed: list = None) -> None:
+        """
+        Describe again the changed columns and splice their descriptions into the existing ones
+        :param changed: list, the names of the columns which were added or whose values changed
+        :param removed: list, optional, the names of the columns which were removed
+        :return: None
+        """
+        if self._desc_stale:
+            return
+        removed = [] if removed is None else removed
+        if self._summary_state is not None:
+            self._summary_state = self._summary_state.replace_columns(
+                other=SummaryState.from_frame(db=self.db[changed]), removed=removed)
+            self._desc_continuous, self._desc_categorical = self._summary_state.get_desc()
+            return
+
+        desc_continuous, desc_categorical = self.get_desc(db=self.db[changed])
+        self._desc_continuous = self._splice_desc(desc_old=self._desc_continuous, desc_new=desc_continuous,
+                                                  dropped=changed + removed)
+        self._desc_categorical = self._splice_desc(desc_old=self._desc_categorical, desc_new=desc_categorical,
+                                                   dropped=changed + removed)
+
+    def _splice_desc(self, desc_old: Union[pd.DataFrame, None], desc_new: Union[pd.DataFrame, None],
+                     dropped: list) -> Union[pd.DataFrame, None]:
+        """
+        Replace the descriptions of some columns, keeping the order of the columns of the historical database
+        :param desc_old: pd.DataFrame or None, the existing description
+        :param desc_new: pd.DataFrame or None, the description of the changed columns
+        :param dropped: list, the names of the columns whose existing description should be dropped
+        :return: pd.DataFrame or None if there is no column to describe
+        """
+        descs = [desc for desc in [desc_old.drop(columns=dropped, errors='ignore') if desc_old is not None else None,
+                                   desc_new] if (desc is not None) and (len(desc.columns) > 0)]
+        if len(descs) == 0:
+            return None
+        desc = pd.concat(objs=descs, axis='columns')
+        return desc[[col for col in self.db.columns if col in desc.columns]]
+
+    @profiled
     def update_db(self, db_new: pd.DataFrame) -> None:
         """
-        This method updates the object's attributes in case we would like to change the historical database
+        This method updates the object's attributes in case we would like to change the historical database.
+        If the new dataframe only appends rows to the current one and mergeable_desc is True, the summaries of the new
+        rows are merged into the descriptions, and if it has the same index only the columns which changed are
+        described again
         :param db_new: pd.DataFrame, the new dataframe of the object
         :return: None
         """
 
-        desc_continuous, desc_categorical = self.get_desc(db=db_new)
+        if self._desc_stale or (self._db is None) or (len(self._db_parts) > 0):
+            self._db = db_new
+            self._db_parts = []
+            self._desc_stale = True
+            if not self.lazy:
+                self._refresh_desc()
+            return
 
-        self.db = db_new
-        self.desc_continuous = desc_continuous
-        self.desc_categorical = desc_categorical
\ No newline at end of file
+        db_old = self._db
+        n_old = len(db_old)
+        if db_new is db_old:
+            # The database was changed in place, so the old values are lost and every column is described again
+            self._refresh_desc()
+        elif (self._summary_state is not None) and (list(db_new.columns) == list(db_old.columns)) and \
+                (len(db_new) > n_old) and db_new.index[:n_old].equals(db_old.index) and \
+                db_new.iloc[:n_old].equals(db_old):
+            self.append_rows(db_rows=db_new.iloc[n_old:])
+            self._db = db_new
+            self._db_parts = []
+        elif db_new.index.equals(db_old.index):
+            changed = [col for col in db_new.columns if (col not in db_old.columns) or
+                       (not db_old[col].equals(db_new[col]))]
+            removed = [col for col in db_old.columns if col not in db_new.columns]
+            self._db = db_new
+            self._update_desc_columns(changed=changed, removed=removed)
+        else:
+            self._db = db_new
+            self._refresh_desc()
\ No newline at end of file
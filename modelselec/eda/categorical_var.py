@@ -6,9 +6,120 @@
                                            guill.khayat@gmail.com
                                                 2024-02-11
 """
+import attr
 from modelselec.modules_paths import *
+from modelselec.util.util_profile import profiled
 
 
+@attr.define(slots=True)
+class CrosstabCounts:
+    """
+    This class stores the number of observations of each pair of categories of two categorical variables. Counts of
+    different chunks of a database can be merged, so that the cross tabulation table does not require holding all
+    the database in memory
+    """
+
+    var1: str = attr.field(validator=attr.validators.instance_of(str))
+    var2: str = attr.field(validator=attr.validators.instance_of(str))
+    counts: pd.DataFrame = attr.field(default=None)
+
+    def __attrs_post_init__(self):
+        if self.counts is None:
+            self.counts = pd.DataFrame(data=np.zeros((0, 0), dtype=np.int64), index=pd.Index([], name=self.var1),
+                                       columns=pd.Index([], name=self.var2))
+
+    def update(self, db: pd.DataFrame) -> None:
+        """
+        Add the observations of a chunk of the database to the counts, missing values are ignored
+        :param db: pd.DataFrame, the chunk which includes the two categorical variables
+        :return: None
+        """
+        self.counts = self.merge(crosstab_counts(db=db, pairs=[(self.var1, self.var2)])[(self.var1, self.var2)]).counts
+
+    def merge(self, other: 'CrosstabCounts') -> 'CrosstabCounts':
+        """
+        Combine two count tables, whose categories are aligned by label
+        :param other: CrosstabCounts, the count table to be merged with
+        :return: CrosstabCounts, the counts of the union of the observations of both count tables
+        """
+        counts = self.counts.add(other.counts, fill_value=0).fillna(0).astype(np.int64)
+        counts.index.name, counts.columns.name = self.var1, self.var2
+        return CrosstabCounts(var1=self.var1, var2=self.var2, counts=counts)
+
+    def crosstab(self, normalize: str = None) -> pd.DataFrame:
+        """
+        Report the cross tabulation table in the format of categorical_categorical_crosstab
+        :param normalize: str, optional, the input should be provided if the desired crosstab should be normalizd.
+                            Only 'all', 'index' or 'columns' are allowed
+        :return: pd.DataFrame, the cross tabulation table with its totals
+        """
+        if normalize is not None and normalize.lower() not in ['all', 'columns', 'index']:
+            raise Exception(f"Invalid value for 'normalize': {normalize}. Only 'all', 'columns' or 'index' are "
+                            f"allowed.")
+
+        normalize_str = str(normalize).lower()
+
+        # Categories without any observation are dropped, as pd.crosstab does
+        cross_tabular = self.counts.loc[self.counts.sum(axis='columns') > 0, self.counts.sum() > 0]
+        match normalize_str:
+            case 'all':
+                cross_tabular = cross_tabular / cross_tabular.to_numpy().sum()
+            case 'index':
+                cross_tabular = cross_tabular.div(cross_tabular.sum(axis='columns'), axis='index')
+            case 'columns':
+                cross_tabular = cross_tabular / cross_tabular.sum()
+
+        if normalize_str == 'columns':
+            cross_tabular_first_sum = pd.concat(objs=[cross_tabular,
+                                                      pd.DataFrame(data=[cross_tabular.sum()], index=['Total'],
+                                                                   columns=cross_tabular.columns)], axis='index')
+        else:
+            cross_tabular_first_sum = pd.concat(objs=[cross_tabular, pd.DataFrame(cross_tabular.sum(axis='columns'),
+                                                                                  columns=['Total'])], axis='columns')
+
+        if normalize_str in ['none', 'all']:
+            cross_tabular_final = pd.concat(objs=[cross_tabular_first_sum,
+                                                  pd.DataFrame(data=[cross_tabular.sum()], index=['Total'],
+                                                               columns=cross_tabular_first_sum.columns)],
+                                            axis='index')
+        else:
+            cross_tabular_final = cross_tabular_first_sum
+
+        cross_tabular_final.insert(loc=0, column=self.var1, value=cross_tabular_final.index)
+        cross_tabular_final.reset_index(drop=True, inplace=True)
+        cross_tabular_final.index.name = None
+        cross_tabular_final.columns.name = None
+        return cross_tabular_final
+
+
+@profiled
+def crosstab_counts(db: pd.DataFrame, pairs: list) -> dict:
+    """
+    This function counts the observations of each pair of categories for many pairs of categorical variables. Each
+    variable is converted to integer codes only once, and the observations of a pair of variables are counted with a
+    single np.bincount on their combined codes
+    :param db: pd.DataFrame, the dataframe which contain the categorical variables
+    :param pairs: list of (str, str) tuples, the names of the two categorical variables of each pair
+    :return: dict, the CrosstabCounts of each pair, with the pair as key
+    """
+    factorized = {}
+    for var in dict.fromkeys(var for pair in pairs for var in pair):
+        factorized[var] = pd.factorize(db[var], sort=True)
+
+    counts = {}
+    for var1, var2 in pairs:
+        (codes1, labels1), (codes2, labels2) = factorized[var1], factorized[var2]
+        valid = (codes1 >= 0) & (codes2 >= 0)
+        pair_counts = np.bincount(codes1[valid].astype(np.int64) * len(labels2) + codes2[valid],
+                                  minlength=len(labels1) * len(labels2)).reshape(len(labels1), len(labels2))
+        counts[(var1, var2)] = CrosstabCounts(
+            var1=var1, var2=var2, counts=pd.DataFrame(data=pair_counts.astype(np.int64),
+                                                      index=pd.Index(labels1, name=var1),
+                                                      columns=pd.Index(labels2, name=var2)))
+    return counts
+
+
+@profiled
 def categorical_categorical_crosstab(db: pd.DataFrame, var1: str, var2: str, normalize: str = None,
                                      path_save: str = None):
     """
@@ -24,33 +135,33 @@ def categorical_categorical_crosstab(db: pd.DataFrame, var1: str, var2: str, nor
     if normalize is not None and normalize.lower() not in ['all', 'columns', 'index']:
         raise Exception(f"Invalid value for 'normalize': {normalize}. Only 'all', 'columns' or 'index' are allowed.")
 
-    normalize_str = str(normalize).lower()
-
-    cross_tabular = pd.crosstab(db[var1], db[var2], normalize=normalize_str if normalize_str != 'none' else False)
-
-    if normalize_str == 'columns':
-        cross_tabular_first_sum = pd.concat(objs=[cross_tabular,
-                                                  pd.DataFrame(data=[cross_tabular.sum()], index=['Total'],
-                                                               columns=cross_tabular.columns)], axis='index')
-    else:
-        cross_tabular_first_sum = pd.concat(objs=[cross_tabular, pd.DataFrame(cross_tabular.sum(axis='columns'),
-                                                                              columns=['Total'])], axis='columns')
-
-    if normalize_str in ['none', 'all']:
-        cross_tabular_final = pd.concat(objs=[cross_tabular_first_sum,
-                                              pd.DataFrame(data=[cross_tabular.sum()], index=['Total'],
-                                                           columns=cross_tabular_first_sum.columns)], axis='index')
-    else:
-        cross_tabular_final = cross_tabular_first_sum
-
-    cross_tabular_final.insert(loc=0, column=var1, value=cross_tabular_final.index)
-    cross_tabular_final.reset_index(drop=True, inplace=True)
-    cross_tabular_final.index.name = None
-    cross_tabular_final.columns.name = None
-
+    cross_tabular_final = crosstab_counts(db=db, pairs=[(var1, var2)])[(var1, var2)].crosstab(normalize=normalize)
 
     if path_save is not None:
         cross_tabular_final.to_csv(path_or_buf=f'{path_save}crosstabular_{var1}_{var2}.csv', index=False)
 
     return cross_tabular_final
 
+
+@profiled
+def categorical_categorical_crosstab_batch(db: pd.DataFrame, pairs: list, normalize: str = None,
+                                           path_save: str = None) -> dict:
+    """
+    This function creates the cross tabulation tables of many pairs of categorical variables, converting each
+    variable to integer codes only once
+    :param db: pd.DataFrame, the dataframe which contain the categorical variables
+    :param pairs: list of (str, str) tuples, the names of the two categorical variables of each pair
+    :param normalize: str, optional, the input should be provided if the desired crosstabs should be normalizd.
+                        Only 'all', 'index' or 'columns' are allowed
+    :param path_save: str, optional, needed if the tables should be saved as .csv files
+    :return: dict, the cross tabulation table of each pair, with the pair as key
+    """
+    if normalize is not None and normalize.lower() not in ['all', 'columns', 'index']:
+        raise Exception(f"Invalid value for 'normalize': {normalize}. Only 'all', 'columns' or 'index' are allowed.")
+
+    crosstabs = {}
+    for (var1, var2), counts in crosstab_counts(db=db, pairs=pairs).items():
+        crosstabs[(var1, var2)] = counts.crosstab(normalize=normalize)
+        if path_save is not None:
+            crosstabs[(var1, var2)].to_csv(path_or_buf=f'{path_save}crosstabular_{var1}_{var2}.csv', index=False)
+    return crosstabs
@@ -6,68 +6,124 @@
                                            guill.khayat@gmail.com
                                                 2024-02-11
 """
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Union
 from modelselec.modules_paths import *
+from modelselec.util.util_profile import profiled
 
 
-def continuous_categorical_stats(db: pd.DataFrame, continuous_var: str, categorical_var: str, relative: bool = False,
-                                 base_categorical_var: str = None,
-                                 path_save: str = None):
+@profiled
+def continuous_categorical_stats(db: pd.DataFrame, continuous_var: Union[str, list], categorical_var: str,
+                                 relative: bool = False, base_categorical_var: str = None, path_save: str = None,
+                                 stats: list = None):
     """
-    This function reports the mean and median of a continuous variable when these are calculated based
-    on grouped observations by the categroies of the categorical variable
+    This function reports statistics (by default the mean and median) of one or several continuous variables when
+    these are calculated based on grouped observations by the categroies of the categorical variable. The
+    observations are grouped once and every statistic is computed from the same grouping
     :param db: pd.DataFrame, the dataframe which contain the categorical and continuous data
     :param categorical_var: str, the name of the categorical variable
-    :param continuous_var: str, the name of the continuous variable
+    :param continuous_var: str or list of str, the name(s) of the continuous variable(s)
     :param relative: boolean, optional, True if the ratio of the statistic relative to a base category
     :param base_categorical_var: str, optional, the base category to be used when calculating the relative ratios
     :param path_save:, str, optional, needed if the plot should be saved instead of shown in a pop-up window
-    :return: pd.DataFrame if no path_save is provided and None if it is provided,
+    :param stats: list of str, optional, the statistics among 'mean', 'median', 'std', 'var', 'count', 'sum', 'min',
+                    'max' and quantiles written as 'q' followed by a percentage, e.g. 'q25'.
+                    By default ['mean', 'median']
+    :return: pd.DataFrame with one row per category and one column per statistic. If several continuous variables
+                are provided, the columns are indexed by (continuous variable, statistic)
     """
     if (base_categorical_var is not None) and (not relative):
         raise Exception('base_categorical_var should be None if relative is different from True')
 
-    categs = list(set(db[categorical_var]))
-    categs.sort()
-    dictData = {}
-    list(map(lambda categ: dictData.update({categ: [np.mean(db[continuous_var][db[categorical_var] == categ]),
-                                                    np.median(db[continuous_var][db[categorical_var] == categ])]}),
-             categs))
-    stat_df = pd.DataFrame(dictData)
-    stat_df = stat_df.transpose()
-    stat_df.columns = ['Mean', 'Median']
+    stats = ['mean', 'median'] if stats is None else stats
+    continuous_vars = [continuous_var] if isinstance(continuous_var, str) else list(continuous_var)
+
+    grouped = db.groupby(by=categorical_var, observed=True, sort=True)[continuous_vars]
+    stat_dfs = {}
+    for stat in stats:
+        if stat in ['mean', 'median', 'std', 'var', 'count', 'sum', 'min', 'max']:
+            stat_dfs[stat.capitalize()] = grouped.agg(stat)
+        elif (stat[0] == 'q') and stat[1:].replace('.', '', 1).isdigit():
+            stat_dfs[stat.upper()] = grouped.quantile(float(stat[1:]) / 100)
+        else:
+            raise Exception(f"Invalid statistic: {stat}")
+    stat_df = pd.concat(objs=stat_dfs, axis='columns').astype(float)
+    stat_df = stat_df.swaplevel(axis='columns')[continuous_vars]
+    if isinstance(continuous_var, str):
+        stat_df = stat_df[continuous_var]
+    stat_df.index.name = None
+
     if relative:
         if base_categorical_var is None:
-            base_categorical_var = categs[0]
+            base_categorical_var = stat_df.index[0]
         stat_df = stat_df.div(stat_df.loc[base_categorical_var])
         stat_df = stat_df.drop(base_categorical_var)
-        stat_df.index = [row + '/' + base_categorical_var for row in list(stat_df.index)]
+        stat_df.index = [str(row) + '/' + str(base_categorical_var) for row in list(stat_df.index)]
 
     if path_save is not None:
-        stat_df.to_csv(path_or_buf=path_save + continuous_var + '_' + categorical_var + '_stats.csv')
+        stat_df.to_csv(path_or_buf=path_save + '_'.join(continuous_vars) + '_' + categorical_var + '_stats.csv')
 
     return stat_df
 
 
+@profiled
+def continuous_categorical_histogram_counts(db: pd.DataFrame, continuous_var: str, categorical_var: str,
+                                            bins: int = 10) -> pd.DataFrame:
+    """
+    This function counts the observations of a continuous variable in each bin for each category of the
+    categorical variable. The bins are the same for every category and all categories are counted in one pass
+    :param db: pd.DataFrame, the dataframe which contain the categorical and continuous data
+    :param continuous_var: str, the name of the continuous variable
+    :param categorical_var: str, the name of the categorical variable
+    :param bins: int, optional, the number of bins of equal width between the minimum and the maximum of the
+                    continuous variable
+    :return: pd.DataFrame with one row per category and one column per bin. The columns are intervals closed on the
+                left, except the last one which also includes the maximum
+    """
+    codes, categs = pd.factorize(db[categorical_var], sort=True)
+    values = db[continuous_var].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = (codes >= 0) & np.isfinite(values)
+    codes, values = codes[valid], values[valid]
+
+    edges = np.histogram_bin_edges(values, bins=bins)
+    bin_idx = np.clip(((values - edges[0]) / (edges[-1] - edges[0]) * bins).astype(np.int64), 0, bins - 1)
+    counts = np.bincount(codes * bins + bin_idx, minlength=len(categs) * bins).reshape(len(categs), bins)
+    return pd.DataFrame(data=counts, index=categs, columns=pd.IntervalIndex.from_breaks(edges, closed='left'))
+
+
+@profiled
 def continuous_categorical_overlap_histogram(db: pd.DataFrame, continuous_var: str, categorical_var: str,
-                                             path_save: str = None):
+                                             path_save: str = None, bins: int = 10) -> pd.DataFrame:
     """
     This function plots overlapping histograms of a continuous variable when considered the categorical variable has
-    different values
+    different values. Every histogram uses the same bins
     :param db: pd.DataFrame, the dataframe which contain the categorical and continuous data
     :param categorical_var: str, the name of the categorical variable
     :param continuous_var: str, the name of the continuous variable
     :param path_save:, str, optional, needed if the plot should be saved instead of shown in a pop-up window
-    :return: None
+    :param bins: int, optional, the number of bins of equal width
+    :return: pd.DataFrame, the counts of each category in each bin (see continuous_categorical_histogram_counts)
     """
 
+    counts = continuous_categorical_histogram_counts(db=db, continuous_var=continuous_var,
+                                                     categorical_var=categorical_var, bins=bins)
+    edges = np.append(counts.columns.left, counts.columns.right[-1])
+
     plt.close('all')
     plt.figure(figsize=(8, 6))
     if path_save is not None:
         plt.ioff()
-    categs = list(set(db[categorical_var]))
-    for i in range(len(categs)):
-        series = db[continuous_var][db[categorical_var] == categs[i]]
-        plt.hist(series, label=categs[i], color=colorsPyPlot[i], density=True, alpha=0.5)
+    # Beyond the Tableau colors, the colors are taken from a colormap sized to the number of categories so that no
+    # two categories share a color
+    n_categs = len(counts.index)
+    colors = colorsPyPlot if n_categs <= len(colorsPyPlot) else \
+        plt.colormaps['viridis'].resampled(n_categs)(np.arange(n_categs))
+    for i, categ in enumerate(counts.index):
+        # A category whose continuous variable is always missing has no histogram
+        if counts.loc[categ].sum() == 0:
+            continue
+        density = counts.loc[categ].to_numpy() / (counts.loc[categ].sum() * np.diff(edges))
+        plt.stairs(density, edges, fill=True, label=categ, color=colors[i], alpha=0.5)
     plt.legend()
 
     if path_save is not None:
@@ -77,7 +133,10 @@ def continuous_categorical_overlap_histogram(db: pd.DataFrame, continuous_var: s
     else:
         plt.show()
 
+    return counts
+
 
+@profiled
 def continuous_categorical_boxplot(db: pd.DataFrame, continuous_var: str, categorical_var: str, path_save: str = None):
     """
     This function plots (shows or saves) the boxplot of a categorical variable in x-axis and
@@ -104,19 +163,114 @@ def continuous_categorical_boxplot(db: pd.DataFrame, continuous_var: str, catego
         plt.show()
 
 
-def continuous_continuous_scatter(db: pd.DataFrame, x_var: str, y_var: str, path_save: str = None):
+@profiled
+def bin_2d(x: np.ndarray, y: np.ndarray, gridsize: int = 500, chunk_size: int = 1000000) -> Tuple:
+    """
+    This function counts the observations of two continuous variables falling in each cell of a regular 2D grid.
+    The observations are processed by chunks, so the memory used only depends on the grid size and the chunk size
+    :param x: np.ndarray, the observations of the first variable, observations with missing or infinite values are
+                ignored
+    :param y: np.ndarray, the observations of the second variable
+    :param gridsize: int, optional, the number of cells of the grid along each axis
+    :param chunk_size: int, optional, the number of observations processed at once
+    :return: np.ndarray of shape (gridsize, gridsize) with the counts indexed by (x cell, y cell), and the edges of the
+                cells along the x-axis and along the y-axis. When a variable has no finite observation, every count
+                is 0 and its edges span [-0.5, 0.5]
+    """
+    x_min, x_max = _finite_range(values=x)
+    y_min, y_max = _finite_range(values=y)
+
+    counts = np.zeros(gridsize * gridsize, dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        cell = _cell_2d(x=x[start:start + chunk_size], y=y[start:start + chunk_size], gridsize=gridsize,
+                        x_range=(x_min, x_max), y_range=(y_min, y_max))
+        counts += np.bincount(cell[cell >= 0], minlength=gridsize * gridsize)
+    return (counts.reshape(gridsize, gridsize), np.linspace(x_min, x_max, gridsize + 1),
+            np.linspace(y_min, y_max, gridsize + 1))
+
+
+def _finite_range(values: np.ndarray) -> Tuple:
+    """
+    This function finds the bounds of a regular grid covering the finite observations of a variable
+    :param values: np.ndarray, the observations of the variable
+    :return: the lower and upper bounds, 0.5 away from the observations if they are all equal and [-0.5, 0.5] if no
+                observation is finite
+    """
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return -0.5, 0.5
+    lower, upper = finite.min(), finite.max()
+    if lower == upper:
+        lower, upper = lower - 0.5, upper + 0.5
+    return lower, upper
+
+
+def _cell_2d(x: np.ndarray, y: np.ndarray, gridsize: int, x_range: Tuple, y_range: Tuple) -> np.ndarray:
     """
-    This function's output is a scatter plot of two continuous variables x_var and y_var
+    This function finds the flat index of the cell of a regular 2D grid where each observation falls
+    :param x: np.ndarray, the observations of the first variable
+    :param y: np.ndarray, the observations of the second variable
+    :param gridsize: int, the number of cells of the grid along each axis
+    :param x_range: tuple, the lower and upper bounds of the grid along the x-axis
+    :param y_range: tuple, the lower and upper bounds of the grid along the y-axis
+    :return: np.ndarray of int, the index of the cell of each observation, -1 if the observation has missing or
+                infinite values
+    """
+    # Missing and infinite values are left out before binning, since they cannot be cast to integers
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y = x[valid], y[valid]
+    x_cell = np.clip(((x - x_range[0]) / (x_range[1] - x_range[0]) * gridsize).astype(np.int64), 0, gridsize - 1)
+    y_cell = np.clip(((y - y_range[0]) / (y_range[1] - y_range[0]) * gridsize).astype(np.int64), 0, gridsize - 1)
+    cell = np.full(len(valid), -1, dtype=np.int64)
+    cell[valid] = x_cell * gridsize + y_cell
+    return cell
+
+
+@profiled
+def continuous_continuous_scatter(db: pd.DataFrame, x_var: str, y_var: str, path_save: str = None,
+                                  aggregate: bool = False, gridsize: int = 500, n_outliers: int = 0,
+                                  random_state: int = None):
+    """
+    This function's output is a scatter plot of two continuous variables x_var and y_var. For large datasets, the
+    observations can instead be counted on a fixed-size grid and the density of each cell is plotted, so that the
+    time and memory spent rendering depend on the grid size and not on the number of observations
     :param db: pd.DataFrame, the dataframe which contain the two continuous variables
     :param x_var: str, the first continuous variable to be plotted on the x-axis
     :param y_var: str, the second continuous variable to be plotted on the y-axis
     :param path_save: str, optional, needed if the plot should be saved instead of shown in a pop-up window
+    :param aggregate: bool, optional, True if the density of the observations should be plotted instead of each of them
+    :param gridsize: int, optional, the number of cells of the grid along each axis when aggregate is True
+    :param n_outliers: int, optional, the maximum number of isolated observations (alone in their cell) drawn on top
+                        of the density when aggregate is True, chosen at random
+    :param random_state: int, optional, the seed used to choose the isolated observations
     :return: None
     """
     plt.figure(figsize=(8, 6))
     if path_save is not None:
         plt.ioff()
-    plt.scatter(x=db[x_var], y=db[y_var])
+    if aggregate:
+        x = db[x_var].to_numpy(dtype=np.float64, na_value=np.nan)
+        y = db[y_var].to_numpy(dtype=np.float64, na_value=np.nan)
+        counts, x_edges, y_edges = bin_2d(x=x, y=y, gridsize=gridsize)
+        # The bounds of the color scale are set so that it stays valid when no cell has more than 1 observation
+        plt.imshow(np.ma.masked_equal(counts.T, 0), origin='lower', aspect='auto', cmap='viridis',
+                   extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+                   norm=mcolors.LogNorm(vmin=1, vmax=max(2, counts.max())))
+        plt.colorbar(label='Number of observations')
+        if n_outliers > 0:
+            # At most one observation per isolated cell, so the candidates are bounded by the grid size
+            isolated = np.flatnonzero(counts.ravel() == 1)
+            candidates = []
+            for start in range(0, len(x), 1000000):
+                cell = _cell_2d(x=x[start:start + 1000000], y=y[start:start + 1000000], gridsize=gridsize,
+                                x_range=(x_edges[0], x_edges[-1]), y_range=(y_edges[0], y_edges[-1]))
+                candidates.append(start + np.flatnonzero(np.isin(cell, isolated)))
+            candidates = np.concatenate(candidates)
+            rng = np.random.default_rng(random_state)
+            outliers = rng.choice(candidates, size=min(n_outliers, len(candidates)), replace=False)
+            plt.scatter(x=x[outliers], y=y[outliers], s=4, color=colorsPyPlot[3])
+    else:
+        plt.scatter(x=db[x_var], y=db[y_var])
     plt.xlabel(x_var)
     plt.ylabel(y_var)
     if path_save is not None:
@@ -127,18 +281,145 @@ def continuous_continuous_scatter(db: pd.DataFrame, x_var: str, y_var: str, path
         plt.show()
 
 
-def continuous_continuous_heatmap(db: pd.DataFrame, var_list: list, path_save: str = None):
+def _correlation_strip(z: np.ndarray, mask: Union[np.ndarray, None], start: int, stop: int,
+                       col_start: int) -> np.ndarray:
+    """
+    This function computes the correlations between a block of variables and the variables from col_start onwards
+    :param z: np.ndarray of shape (n, p), the standardized observations if mask is None, otherwise the centered
+                observations with zeros in place of missing values
+    :param mask: np.ndarray of shape (n, p) or None, 1 where an observation is available and 0 otherwise. None if
+                    only complete cases are used
+    :param start: int, the position of the first variable of the block
+    :param stop: int, the position after the last variable of the block
+    :param col_start: int, the position of the first variable the block is correlated with
+    :return: np.ndarray of shape (stop - start, p - col_start), the correlations
+    """
+    z_block = z[:, start:stop]
+    if mask is None:
+        return np.clip(z_block.T @ z[:, col_start:] / (z.shape[0] - 1), -1, 1)
+
+    # Sums over the observations available for both variables of each pair
+    m_block, z_cols, m_cols = mask[:, start:stop], z[:, col_start:], mask[:, col_start:]
+    n = m_block.T @ m_cols
+    sum_x, sum_y = z_block.T @ m_cols, m_block.T @ z_cols
+    sum_xx, sum_yy = (z_block ** 2).T @ m_cols, m_block.T @ z_cols ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = sum_xx - sum_x ** 2 / n
+        var_y = sum_yy - sum_y ** 2 / n
+        corr = (z_block.T @ z_cols - sum_x * sum_y / n) / np.sqrt(var_x * var_y)
+    corr[(n < 2) | (var_x <= 10**(-10) * sum_xx) | (var_y <= 10**(-10) * sum_yy)] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+@profiled
+def correlation_matrix(db: pd.DataFrame, var_list: list = None, block_size: int = 256, dtype: str = 'float64',
+                       na: str = 'pairwise', n_jobs: int = None, top_k: int = None,
+                       top_k_by: str = 'overall') -> pd.DataFrame:
+    """
+    This function computes the Pearson correlation matrix of many continuous variables. The observations are
+    standardized once and the matrix is computed by blocks of variables over a pool of threads, so that only a few
+    blocks are held in memory when only the largest correlations are requested
+    :param db: pd.DataFrame, the dataframe which includes the observations of the variables of interest
+    :param var_list: list of strings, optional, the variables of interest. All numerical columns by default
+    :param block_size: int, optional, the number of variables of each block
+    :param dtype: str, optional, 'float64' or 'float32', the precision of the computations
+    :param na: str, optional, 'pairwise' to use, for each pair of variables, the observations available for both of
+                them (as pd.DataFrame.corr), or 'complete' to only use the observations available for all variables
+    :param n_jobs: int, optional, the number of threads. All the available CPUs by default
+    :param top_k: int, optional, if provided only the top_k largest absolute correlations are returned
+    :param top_k_by: str, optional, 'overall' for the top_k pairs of variables overall or 'variable' for the top_k
+                        other variables of each variable
+    :return: pd.DataFrame, the correlation matrix, or if top_k is provided a dataframe with the columns var1, var2
+                and corr sorted by decreasing absolute correlation
+    """
+    if na not in ['pairwise', 'complete']:
+        raise Exception("'na' should be either 'pairwise' or 'complete'")
+    if top_k_by not in ['overall', 'variable']:
+        raise Exception("'top_k_by' should be either 'overall' or 'variable'")
+
+    var_list = list(db.select_dtypes(include=np.number).columns) if var_list is None else var_list
+    x = db[var_list].to_numpy(dtype=np.float64, na_value=np.nan)
+    missing = np.isnan(x)
+    if na == 'complete' or not missing.any():
+        x = x[~missing.any(axis=1)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = ((x - x.mean(axis=0)) / x.std(axis=0, ddof=1)).astype(dtype)
+        mask = None
+    else:
+        with np.errstate(invalid='ignore'):
+            z = np.where(missing, 0.0, x - np.nanmean(x, axis=0)).astype(dtype)
+        mask = (~missing).astype(dtype)
+
+    p = len(var_list)
+    blocks = [(start, min(start + block_size, p)) for start in range(0, p, block_size)]
+    full_rows = (top_k is not None) and (top_k_by == 'variable')
+
+    def compute_block(block: Tuple) -> Tuple:
+        start, stop = block
+        col_start = 0 if full_rows else start
+        corr = _correlation_strip(z=z, mask=mask, start=start, stop=stop, col_start=col_start).astype(np.float64)
+        if top_k is None:
+            return start, stop, corr
+        # Pairs of a variable with itself are excluded, as well as pairs already seen in a previous block
+        rows, cols = np.indices(corr.shape)
+        rows, cols = rows + start, cols + col_start
+        keep = (rows != cols) if full_rows else (cols > rows)
+        corr = np.where(keep & ~np.isnan(corr), corr, 0.0)
+        if full_rows:
+            k = min(top_k, p - 1)
+            idx = np.argpartition(-np.abs(corr), k - 1, axis=1)[:, :k] if k > 0 else np.empty((len(corr), 0), int)
+            return rows[:, :k].ravel(), np.take_along_axis(cols, idx, axis=1).ravel(), \
+                np.take_along_axis(corr, idx, axis=1).ravel()
+        k = min(top_k, corr.size)
+        idx = np.argpartition(-np.abs(corr).ravel(), k - 1)[:k] if k > 0 else np.empty(0, int)
+        return rows.ravel()[idx], cols.ravel()[idx], corr.ravel()[idx]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(compute_block, blocks))
+
+    if top_k is None:
+        corr_matrix = np.empty((p, p))
+        for start, stop, corr in results:
+            corr_matrix[start:stop, start:] = corr
+            corr_matrix[start:, start:stop] = corr.T
+        return pd.DataFrame(data=corr_matrix, index=var_list, columns=var_list)
+
+    rows, cols, corr = (np.concatenate([result[i] for result in results]) for i in range(3))
+    top = pd.DataFrame({'var1': np.array(var_list, dtype=object)[rows], 'var2': np.array(var_list, dtype=object)[cols],
+                        'corr': corr})
+    top = top.iloc[np.argsort(-np.abs(corr), kind='stable')]
+    if not full_rows:
+        top = top.head(top_k)
+    return top.reset_index(drop=True)
+
+
+@profiled
+def continuous_continuous_heatmap(db: pd.DataFrame, var_list: list, path_save: str = None, top_k: int = None,
+                                  **kwargs):
     """
     Produces the correlation heatmap of a list of variables in a pandas dataframe
     :param db: pd.DataFrame, the dataframe which includes the observations of the variables of interest
     :param var_list: list of strings, the list of column names representing the variables of interest in the dataframe
     :param path_save: str, optional, the path where the .png file should be saved
+    :param top_k: int, optional, if provided only the variables of the top_k pairs of variables with the largest
+                    absolute correlations are plotted
+    :param kwargs: optional, other arguments of correlation_matrix
     :return: None
     """
+    corr = correlation_matrix(db=db, var_list=var_list, **kwargs)
+    if top_k is not None:
+        # The pairs are ranked as in correlation_matrix, on the matrix already computed
+        rows, cols = np.triu_indices(len(var_list), k=1)
+        pair_corr = np.abs(np.nan_to_num(corr.to_numpy()[rows, cols]))
+        top = np.argsort(-pair_corr, kind='stable')[:top_k]
+        selected = set(rows[top]) | set(cols[top])
+        keep = [var for i, var in enumerate(var_list) if i in selected]
+        corr = corr.loc[keep, keep]
+
     if path_save is not None:
         plt.ioff()
     plt.figure(figsize=(8, 6))
-    sns.heatmap(db[var_list].corr(), annot=True, cmap='coolwarm', fmt=".2f", vmin=-1, vmax=1)
+    sns.heatmap(corr, annot=True, cmap='coolwarm', fmt=".2f", vmin=-1, vmax=1)
     plt.title('Correlation Heatmap')
     if path_save is not None:
         file_name = var_list[0] + '_--_' + var_list[len(var_list) - 1] + '_heatmap'
@@ -0,0 +1,147 @@
+"""
+                        This script includes a runner which produces a whole pack of Exploratory
+                            Data Analysis artifacts over a pool of processes
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-03-29
+"""
+import itertools, json, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Union
+from modelselec.modules_paths import *
+from modelselec.util.util_profile import profiled
+from modelselec.db.db_cls import DBhist
+from modelselec.eda import categorical_var, continuous_var
+
+# The EDA functions which can be run by eda_report and the names of the files each of them saves
+EDA_FUNCTIONS = {
+    'continuous_categorical_stats': (
+        continuous_var.continuous_categorical_stats,
+        lambda kw: ['_'.join([kw['continuous_var']] if isinstance(kw['continuous_var'], str) else
+                             kw['continuous_var']) + f"_{kw['categorical_var']}_stats.csv"]),
+    'continuous_categorical_overlap_histogram': (
+        continuous_var.continuous_categorical_overlap_histogram,
+        lambda kw: [f"{kw['categorical_var']}_{kw['continuous_var']}_overlap_hist.png"]),
+    'continuous_categorical_boxplot': (
+        continuous_var.continuous_categorical_boxplot,
+        lambda kw: [f"{kw['categorical_var']}_{kw['continuous_var']}_boxplot.png"]),
+    'continuous_continuous_scatter': (
+        continuous_var.continuous_continuous_scatter,
+        lambda kw: [f"{kw['x_var']}_{kw['y_var']}_scatter.png"]),
+    'continuous_continuous_heatmap': (
+        continuous_var.continuous_continuous_heatmap,
+        lambda kw: [f"{kw['var_list'][0]}_--_{kw['var_list'][-1]}_heatmap.png"]),
+    'categorical_categorical_crosstab': (
+        categorical_var.categorical_categorical_crosstab,
+        lambda kw: [f"crosstabular_{kw['var1']}_{kw['var2']}.csv"]),
+}
+
+# The database of the worker processes, set by _init_worker
+_worker_db = None
+
+
+@profiled
+def eda_spec_all_pairs(db: pd.DataFrame, functions: list = None) -> list:
+    """
+    This function lists the EDA artifacts of every pair of variables, chosen by variable type: statistics, overlapping
+    histograms and boxplots for (continuous, categorical) pairs, scatter plots for (continuous, continuous) pairs,
+    crosstabs for (categorical, categorical) pairs and the heatmap of all continuous variables
+    :param db: pd.DataFrame, the dataframe whose variables should be analyzed
+    :param functions: list of str, optional, only the artifacts of these EDA functions are listed
+    :return: list of dicts with the name of the EDA function under 'function' and its arguments under 'kwargs'
+    """
+    continuous_cols = list(db.select_dtypes(include=np.number).columns)
+    categorical_cols = list(db.select_dtypes(exclude=[np.number, 'datetime', 'datetimetz', 'timedelta']).columns)
+
+    spec = []
+    for cont, categ in itertools.product(continuous_cols, categorical_cols):
+        spec += [{'function': name, 'kwargs': {'continuous_var': cont, 'categorical_var': categ}}
+                 for name in ['continuous_categorical_stats', 'continuous_categorical_overlap_histogram',
+                              'continuous_categorical_boxplot']]
+    spec += [{'function': 'continuous_continuous_scatter', 'kwargs': {'x_var': x_var, 'y_var': y_var}}
+             for x_var, y_var in itertools.combinations(continuous_cols, 2)]
+    spec += [{'function': 'categorical_categorical_crosstab', 'kwargs': {'var1': var1, 'var2': var2}}
+             for var1, var2 in itertools.combinations(categorical_cols, 2)]
+    if len(continuous_cols) > 1:
+        spec += [{'function': 'continuous_continuous_heatmap', 'kwargs': {'var_list': continuous_cols}}]
+
+    if functions is not None:
+        spec = [task for task in spec if task['function'] in functions]
+    return spec
+
+
+def _init_worker(db: pd.DataFrame) -> None:
+    """
+    This function prepares a worker process: plots are rendered with a non-interactive backend and the database is
+    received once per worker instead of once per task
+    :param db: pd.DataFrame, the dataframe whose variables should be analyzed
+    :return: None
+    """
+    global _worker_db
+    import matplotlib
+    matplotlib.use('Agg')
+    _worker_db = db
+
+
+def _run_task(function: str, kwargs: dict, path_save: str) -> dict:
+    """
+    This function produces one EDA artifact in a worker process
+    :param function: str, the name of the EDA function
+    :param kwargs: dict, the arguments of the EDA function other than db and path_save
+    :param path_save: str, the directory where the artifact is saved
+    :return: dict, the manifest entry of the artifact
+    """
+    func, file_names = EDA_FUNCTIONS[function]
+    start = time.perf_counter()
+    error = None
+    try:
+        func(db=_worker_db, path_save=path_save, **kwargs)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        plt.close('all')
+    return {'function': function, 'kwargs': kwargs, 'files': file_names(kwargs) if error is None else [],
+            'seconds': time.perf_counter() - start, 'error': error}
+
+
+@profiled
+def eda_report(db_hist: Union[DBhist, pd.DataFrame], path_save: str, spec: Union[list, str] = 'all',
+               functions: list = None, n_workers: int = None) -> dict:
+    """
+    This function produces a pack of EDA artifacts over a pool of processes, each rendering its plots with a
+    non-interactive backend, and saves a JSON manifest of the files and of the time spent on each of them
+    as eda_manifest.json in path_save
+    :param db_hist: DBhist or pd.DataFrame, the historical database whose variables should be analyzed
+    :param path_save: str, the directory where the artifacts and the manifest are saved
+    :param spec: list or str, optional, either 'all' for the artifacts of every pair of variables chosen by variable
+                    type (see eda_spec_all_pairs), or a list of dicts with the name of an EDA function under
+                    'function' and its arguments other than db and path_save under 'kwargs'
+    :param functions: list of str, optional, only the artifacts of these EDA functions are produced
+    :param n_workers: int, optional, the number of worker processes. All the available CPUs by default
+    :return: dict, the manifest
+    """
+    db = db_hist.db if isinstance(db_hist, DBhist) else db_hist
+    if isinstance(spec, str):
+        if spec != 'all':
+            raise Exception("'spec' should be either 'all' or a list of EDA tasks")
+        spec = eda_spec_all_pairs(db=db, functions=functions)
+    elif functions is not None:
+        spec = [task for task in spec if task['function'] in functions]
+    invalid = [task['function'] for task in spec if task['function'] not in EDA_FUNCTIONS]
+    if len(invalid) > 0:
+        raise Exception(f'Invalid EDA functions: {invalid}. Only {list(EDA_FUNCTIONS)} are allowed')
+
+    os.makedirs(path_save, exist_ok=True)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(db,)) as executor:
+        artifacts = list(executor.map(_run_task, [task['function'] for task in spec],
+                                      [task['kwargs'] for task in spec], [path_save] * len(spec)))
+
+    manifest = {'created': datetime.now().isoformat(timespec='seconds'), 'path_save': path_save,
+                'n_tasks': len(spec), 'n_errors': sum(artifact['error'] is not None for artifact in artifacts),
+                'seconds': time.perf_counter() - start, 'artifacts': artifacts}
+    with open(path_save + 'eda_manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    return manifest
@@ -7,12 +7,35 @@
                                                 2024-02-06
 """
 
+import importlib
 import pandas as pd
 import numpy as np
-import os, sklearn, matplotlib.pyplot as plt
-import seaborn as sns
+import os
 
-import matplotlib.colors as mcolors
 
-# Get a list of all available colors in Matplotlib
-colorsPyPlot = list(mcolors.TABLEAU_COLORS.values())
+class _LazyModule:
+    """
+    This class stands for a module which is only imported when one of its attributes is first used, so that
+    importing modelselec does not load the plotting and machine learning libraries
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        module = importlib.import_module(self._name)
+        self.__dict__.update({attribute: getattr(module, attribute)})
+        return getattr(module, attribute)
+
+    def __repr__(self) -> str:
+        return f"<lazy module '{self._name}'>"
+
+
+sklearn = _LazyModule('sklearn')
+plt = _LazyModule('matplotlib.pyplot')
+sns = _LazyModule('seaborn')
+mcolors = _LazyModule('matplotlib.colors')
+
+# The Tableau colors of Matplotlib (matplotlib.colors.TABLEAU_COLORS), listed here so that matplotlib is not imported
+colorsPyPlot = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22',
+                '#17becf']
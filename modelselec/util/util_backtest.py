@@ -0,0 +1,123 @@
+"""
+                        This script includes a backtest engine which computes performance metrics
+                            over many rolling or expanding windows in a single pass
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-03-25
+"""
+from typing import Tuple
+from modelselec.modules_paths import *
+
+
+def _window_sums(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    This function sums an array over many windows with one cumulative sum, so that each window costs O(1)
+    :param values: np.ndarray, the array to be summed
+    :param starts: np.ndarray, the first position of each window
+    :param ends: np.ndarray, the position after the last position of each window
+    :return: np.ndarray, the sum of values over each window
+    """
+    prefix = np.concatenate([[0.0], np.cumsum(values)])
+    return prefix[ends] - prefix[starts]
+
+
+def _window_corr(x: np.ndarray, y: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    This function computes the Pearson correlation between two series over many windows from cumulative sums,
+    ignoring the positions where one of the series is missing
+    :param x: np.ndarray, the first series
+    :param y: np.ndarray, the second series
+    :param starts: np.ndarray, the first position of each window
+    :param ends: np.ndarray, the position after the last position of each window
+    :return: np.ndarray, the correlation over each window. NaN when fewer than 2 positions are available or a variance
+                is 0
+    """
+    valid = np.isfinite(x) & np.isfinite(y)
+    if not valid.any():
+        return np.full(len(starts), np.nan)
+    # Centering on the overall means limits the cancellation in the sums of squares
+    x = np.where(valid, x - x[valid].mean(), 0.0)
+    y = np.where(valid, y - y[valid].mean(), 0.0)
+    n = _window_sums(valid.astype(np.float64), starts, ends)
+    sum_x, sum_y = _window_sums(x, starts, ends), _window_sums(y, starts, ends)
+    sum_xx, sum_yy = _window_sums(x * x, starts, ends), _window_sums(y * y, starts, ends)
+    sum_xy = _window_sums(x * y, starts, ends)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = sum_xx - sum_x ** 2 / n
+        var_y = sum_yy - sum_y ** 2 / n
+        corr = (sum_xy - sum_x * sum_y / n) / np.sqrt(var_x * var_y)
+    corr[(n < 2) | (var_x <= 10**(-12) * sum_xx) | (var_y <= 10**(-12) * sum_yy)] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def backtest_windows(n_obs: int, window: int, step: int = 1, window_type: str = 'rolling') -> Tuple:
+    """
+    This function lists the windows of a backtest
+    :param n_obs: int, the number of observations
+    :param window: int, the number of observations of each rolling window, or of the first expanding window
+    :param step: int, optional, the number of observations between the ends of two consecutive windows
+    :param window_type: str, optional, 'rolling' if every window has the same length and 'expanding' if every
+                        window starts at the first observation
+    :return: the first position and the position after the last position of each window
+    """
+    if window_type not in ['rolling', 'expanding']:
+        raise Exception("'window_type' should be either 'rolling' or 'expanding'")
+    if (window < 2) or (window > n_obs) or (step < 1):
+        raise Exception("'window' should be between 2 and the number of observations and 'step' at least 1")
+    ends = np.arange(window, n_obs + 1, step)
+    starts = ends - window if window_type == 'rolling' else np.zeros(len(ends), dtype=np.int64)
+    return starts, ends
+
+
+def backtest_metrics(obs: pd.DataFrame, pred: pd.DataFrame, window: int, step: int = 1,
+                     window_type: str = 'rolling', transf: str = 'lvl') -> pd.DataFrame:
+    """
+    This function returns the metrics of perf_metrics for a numerical dependent variable over every window of a
+    backtest. All windows are computed together from cumulative sums, so the cost of each window is O(1). Missing
+    values are not allowed
+    :param obs: pd.DataFrame of 1 column which includes the observed historical data of the dependent variable
+    :param pred: pd.DataFrame of 1 column which includes the model predicted values of the dependent variable
+    :param window: int, the number of observations of each rolling window, or of the first expanding window
+    :param step: int, optional, the number of observations between the ends of two consecutive windows
+    :param window_type: str, optional, 'rolling' if every window has the same length and 'expanding' if every
+                        window starts at the first observation
+    :param transf: str, optional, one of 'lvl', 'diff' or 'diffln', the transformation whose correlation should be
+                    reported in addition to the correlation in level
+    :return: pd.DataFrame, one row per window with the index labels of its first and last observations and the
+                same metrics as perf_metrics
+    """
+    if list(obs.columns) != list(pred.columns):
+        raise Exception('Both observed and predicted dataframes should have the same column name')
+    if len(obs.columns) != 1:
+        raise Exception('Computing the performance metrics is possible only for 1 series at a time')
+    if len(obs) != len(pred):
+        raise Exception('Both observed and predicted dataframes should have the same number of rows')
+    if (transf is None) or (transf.lower() not in ['lvl', 'diff', 'diffln']):
+        raise Exception("'transf' should be one of the following transformations ['lvl', 'diff', 'diffln']")
+
+    starts, ends = backtest_windows(n_obs=len(obs), window=window, step=step, window_type=window_type)
+    obs_values = obs.iloc[:, 0].to_numpy(dtype=np.float64)
+    pred_values = pred.iloc[:, 0].to_numpy(dtype=np.float64)
+    # A missing value would spread to every later window through the cumulative sums
+    if np.isnan(obs_values).any() or np.isnan(pred_values).any():
+        raise Exception('The observed and predicted dataframes should not include missing values')
+    errors = obs_values - pred_values
+    n = (ends - starts).astype(np.float64)
+
+    metrics = {'start': obs.index[starts], 'end': obs.index[ends - 1],
+               'lvlCorr': _window_corr(x=pred_values, y=obs_values, starts=starts, ends=ends)}
+    # The differences inside a window start at its second observation
+    match transf.lower():
+        case 'diff':
+            metrics['diffCorr'] = _window_corr(x=np.diff(pred_values), y=np.diff(obs_values), starts=starts,
+                                               ends=ends - 1)
+        case 'diffln':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                metrics['diffLnCorr'] = _window_corr(x=np.diff(np.log(pred_values)), y=np.diff(np.log(obs_values)),
+                                                     starts=starts, ends=ends - 1)
+    rmse = np.sqrt(_window_sums(errors ** 2, starts, ends) / n)
+    metrics['RMSE'] = rmse
+    metrics['NRMSE'] = rmse / (_window_sums(obs_values, starts, ends) / n)
+    metrics['MAPE'] = _window_sums(np.abs(errors / (obs_values + 10**(-10))), starts, ends) / n
+    return pd.DataFrame(metrics)
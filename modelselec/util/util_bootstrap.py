@@ -0,0 +1,214 @@
+"""
+                        This script includes bootstrap confidence intervals of performance metrics,
+                            with every replicate of a chunk computed by batched reductions
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-04-04
+"""
+from concurrent.futures import ProcessPoolExecutor
+from modelselec.modules_paths import *
+from modelselec.util.util_profile import profiled
+
+# The data of the worker processes, set by _init_worker
+_worker_data = None
+
+
+def bootstrap_indices(rng: np.random.Generator, n_boot: int, n_obs: int, method: str = 'iid',
+                      block_size: int = None) -> np.ndarray:
+    """
+    This function draws the positions of the observations of many bootstrap replicates as one index matrix
+    :param rng: np.random.Generator, the random generator
+    :param n_boot: int, the number of replicates
+    :param n_obs: int, the number of observations
+    :param method: str, optional, 'iid' to draw observations independently, or 'block' to draw blocks of consecutive
+                    observations (moving block bootstrap), which keeps the autocorrelation of time series
+    :param block_size: int, optional, the number of observations of each block. By default, n_obs ** (1/3)
+    :return: np.ndarray of int of shape (n_boot, n_obs), the positions of the observations of each replicate
+    """
+    if method == 'iid':
+        return rng.integers(0, n_obs, size=(n_boot, n_obs))
+    if method != 'block':
+        raise Exception("'method' should be either 'iid' or 'block'")
+    block_size = max(1, int(round(n_obs ** (1 / 3)))) if block_size is None else min(block_size, n_obs)
+    n_blocks = -(-n_obs // block_size)
+    starts = rng.integers(0, n_obs - block_size + 1, size=(n_boot, n_blocks))
+    return (starts[:, :, None] + np.arange(block_size)).reshape(n_boot, -1)[:, :n_obs]
+
+
+def _corr_rows(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    This function computes the Pearson correlation between the rows of two matrices
+    :param x: np.ndarray of shape (b, n), the first series of each replicate
+    :param y: np.ndarray of shape (b, n), the second series of each replicate
+    :return: np.ndarray of shape (b,), the correlations. NaN when a variance is 0
+    """
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    var_x, var_y = np.einsum('ij,ij->i', x, x), np.einsum('ij,ij->i', y, y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.einsum('ij,ij->i', x, y) / np.sqrt(var_x * var_y)
+    corr[(var_x == 0) | (var_y == 0)] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def _resampled_metrics(data: dict, idx: np.ndarray, idx_diff: np.ndarray) -> dict:
+    """
+    This function computes the metrics of perf_metrics for many bootstrap replicates at once
+    :param data: dict, the observed and predicted values prepared by bootstrap_metrics
+    :param idx: np.ndarray of shape (b, n), the positions of the observations of each replicate
+    :param idx_diff: np.ndarray of shape (b, n - 1) or None, the positions of the differences of each replicate
+    :return: dict, the name of each metric and an np.ndarray of shape (b,) with its values for each replicate
+    """
+    obs, pred = data['obs'][idx], data['pred'][idx]
+    if data['y_type'] == 'categ':
+        # The true positives, observed and predicted counts of each class of all replicates are counted with one
+        # bincount each, without the full confusion matrices whose size grows with the square of the number of labels
+        n_boot, n_labels = len(idx), len(data['labels'])
+        offsets = np.arange(n_boot)[:, None] * n_labels
+
+        def class_counts(cells: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+            return np.bincount(cells.ravel(), weights=None if weights is None else weights.ravel(),
+                               minlength=n_boot * n_labels).reshape(n_boot, n_labels).astype(np.float64)
+
+        true_pos = class_counts(cells=offsets + obs, weights=(obs == pred).astype(np.float64))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.nan_to_num(true_pos / class_counts(cells=offsets + pred), nan=0.0)
+            recall = np.nan_to_num(true_pos / class_counts(cells=offsets + obs), nan=0.0)
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall), nan=0.0)
+        metrics = {'accuracy': true_pos.sum(axis=1) / idx.shape[1]}
+        for name, values in [('precision', precision), ('recall', recall), ('f1', f1)]:
+            metrics.update({f'{name}_{label}': values[:, i] for i, label in enumerate(data['labels'])})
+        return metrics
+
+    errors = obs - pred
+    rmse = np.sqrt(np.einsum('ij,ij->i', errors, errors) / idx.shape[1])
+    metrics = {'lvlCorr': _corr_rows(pred, obs)}
+    match data['transf']:
+        case 'diff':
+            metrics['diffCorr'] = _corr_rows(data['pred_diff'][idx_diff], data['obs_diff'][idx_diff])
+        case 'diffln':
+            metrics['diffLnCorr'] = _corr_rows(data['pred_diff'][idx_diff], data['obs_diff'][idx_diff])
+    metrics['RMSE'] = rmse
+    metrics['NRMSE'] = rmse / obs.mean(axis=1)
+    metrics['MAPE'] = np.mean(np.abs(errors / (obs + 10**(-10))), axis=1)
+    return metrics
+
+
+def _bootstrap_chunk(data: dict, seed: np.random.SeedSequence, n_boot: int) -> dict:
+    """
+    This function computes the metrics of a chunk of bootstrap replicates
+    :param data: dict, the observed and predicted values prepared by bootstrap_metrics
+    :param seed: np.random.SeedSequence, the seed of the chunk
+    :param n_boot: int, the number of replicates of the chunk
+    :return: dict, the name of each metric and an np.ndarray of shape (n_boot,) with its values for each replicate
+    """
+    rng = np.random.default_rng(seed)
+    idx = bootstrap_indices(rng=rng, n_boot=n_boot, n_obs=len(data['obs']), method=data['method'],
+                            block_size=data['block_size'])
+    idx_diff = None
+    if 'obs_diff' in data:
+        # The differences are resampled as pairs of observed and predicted differences
+        idx_diff = bootstrap_indices(rng=rng, n_boot=n_boot, n_obs=len(data['obs_diff']), method=data['method'],
+                                     block_size=data['block_size'])
+    return _resampled_metrics(data=data, idx=idx, idx_diff=idx_diff)
+
+
+def _init_worker(data: dict) -> None:
+    """
+    This function sends the observed and predicted values once to each worker process instead of once per task
+    :param data: dict, the observed and predicted values prepared by bootstrap_metrics
+    :return: None
+    """
+    global _worker_data
+    _worker_data = data
+
+
+def _run_chunk(seed: np.random.SeedSequence, n_boot: int) -> dict:
+    """
+    This function computes the metrics of a chunk of bootstrap replicates in a worker process
+    :param seed: np.random.SeedSequence, the seed of the chunk
+    :param n_boot: int, the number of replicates of the chunk
+    :return: dict, the name of each metric and an np.ndarray with its values for each replicate
+    """
+    return _bootstrap_chunk(data=_worker_data, seed=seed, n_boot=n_boot)
+
+
+@profiled
+def bootstrap_metrics(obs: pd.DataFrame, pred: pd.DataFrame, y_type: str = 'num', transf: str = 'lvl',
+                      n_boot: int = 1000, method: str = 'iid', block_size: int = None, conf_level: float = 0.95,
+                      random_state: int = None, n_workers: int = None, chunk_size: int = None) -> pd.DataFrame:
+    """
+    This function returns bootstrap confidence intervals of the metrics of perf_metrics. The replicates are drawn as
+    one index matrix per chunk and their metrics are computed by batched reductions over the whole chunk. Each chunk
+    has its own seed spawned from random_state, so the results do not depend on the number of worker processes
+    :param obs: pd.DataFrame of 1 column which includes the observed historical data of the dependent variable
+    :param pred: pd.DataFrame of 1 column which includes the model predicted values of the dependent variable
+    :param y_type: str, optional, 'num' if the dependent variable is numerical and 'categ' if the dependent variable
+                    is categorical
+    :param transf: str, optional, one of 'lvl', 'diff' or 'diffln', the transformation whose correlation should be
+                    reported in addition to the correlation in level. Ignored for categorical variables
+    :param n_boot: int, optional, the number of bootstrap replicates
+    :param method: str, optional, 'iid' to resample observations independently, or 'block' to resample blocks of
+                    consecutive observations (moving block bootstrap) for time series
+    :param block_size: int, optional, the number of observations of each block. By default, n ** (1/3)
+    :param conf_level: float, optional, the confidence level of the percentile intervals
+    :param random_state: int, optional, the seed of the random generator
+    :param n_workers: int, optional, the number of worker processes. The replicates are computed in the current
+                        process by default
+    :param chunk_size: int, optional, the number of replicates of each chunk. By default, chunks hold about 16
+                        million resampled observations
+    :return: pd.DataFrame, one row per metric with the estimate on the original data, the standard deviation of the
+                replicates and the lower and upper bounds of the interval. Categorical metrics are reported by class,
+                e.g. precision_<class>
+    """
+    if list(obs.columns) != list(pred.columns):
+        raise Exception('Both observed and predicted dataframes should have the same column name')
+    if len(obs.columns) != 1:
+        raise Exception('Computing the performance metrics is possible only for 1 series at a time')
+    if len(obs) != len(pred):
+        raise Exception('Both observed and predicted dataframes should have the same number of rows')
+    if y_type not in ['num', 'categ']:
+        raise Exception('"y_type" should be either "num" if the dependent variable is numerical or '
+                        '"categ" if the dependant variable is categorical')
+    if (y_type == 'num') and ((transf is None) or (transf.lower() not in ['lvl', 'diff', 'diffln'])):
+        raise Exception("'transf' should be one of the following transformations ['lvl', 'diff', 'diffln']")
+    if method not in ['iid', 'block']:
+        raise Exception("'method' should be either 'iid' or 'block'")
+    if obs.isna().any().any() or pred.isna().any().any():
+        raise Exception('The observed and predicted dataframes should not include missing values')
+
+    data = {'y_type': y_type, 'method': method, 'block_size': block_size}
+    if y_type == 'categ':
+        # Labels are sorted as in sklearn, so the metrics of each class are reported in the same order
+        codes, labels = pd.factorize(pd.concat([obs.iloc[:, 0], pred.iloc[:, 0]], ignore_index=True), sort=True)
+        data.update({'obs': codes[:len(obs)], 'pred': codes[len(obs):], 'labels': list(labels)})
+    else:
+        obs_values, pred_values = obs.iloc[:, 0].to_numpy(dtype=np.float64), pred.iloc[:, 0].to_numpy(dtype=np.float64)
+        data.update({'obs': obs_values, 'pred': pred_values, 'transf': transf.lower()})
+        if transf.lower() == 'diff':
+            data.update({'obs_diff': np.diff(obs_values), 'pred_diff': np.diff(pred_values)})
+        elif transf.lower() == 'diffln':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                data.update({'obs_diff': np.diff(np.log(obs_values)), 'pred_diff': np.diff(np.log(pred_values))})
+
+    n_obs = len(obs)
+    chunk_size = max(1, min(n_boot, 2**24 // max(n_obs, 1))) if chunk_size is None else chunk_size
+    sizes = [min(chunk_size, n_boot - start) for start in range(0, n_boot, chunk_size)]
+    seeds = np.random.SeedSequence(random_state).spawn(len(sizes))
+    if (n_workers is None) or (n_workers <= 1):
+        results = [_bootstrap_chunk(data=data, seed=seed, n_boot=size) for seed, size in zip(seeds, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(data,)) as executor:
+            results = list(executor.map(_run_chunk, seeds, sizes))
+    replicates = pd.DataFrame({metric: np.concatenate([result[metric] for result in results])
+                               for metric in results[0]})
+
+    identity = np.arange(n_obs)[None, :]
+    identity_diff = np.arange(len(data['obs_diff']))[None, :] if 'obs_diff' in data else None
+    estimates = _resampled_metrics(data=data, idx=identity, idx_diff=identity_diff)
+    alpha = 1 - conf_level
+    return pd.DataFrame({'estimate': {metric: values[0] for metric, values in estimates.items()},
+                         'std': replicates.std(),
+                         'lower': replicates.quantile(alpha / 2),
+                         'upper': replicates.quantile(1 - alpha / 2)})
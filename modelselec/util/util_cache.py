@@ -0,0 +1,101 @@
+"""
+                        This script includes an on-disk cache of parsed .csv files, stored as
+                            uncompressed Feather files which can be memory-mapped when read
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-03-22
+"""
+import hashlib, json, tempfile, warnings
+from modelselec.modules_paths import *
+
+
+def cache_key(path: str, dtype: dict = None, parse_dates: list = None, header: int = 0) -> str:
+    """
+    This function builds the name of the cache file of a .csv file. It changes whenever the file is modified or
+    the arguments used to parse it change
+    :param path: str, the path of the .csv file
+    :param dtype: dict, optional, the dtype argument of pd.read_csv
+    :param parse_dates: list, optional, the parse_dates argument of pd.read_csv
+    :param header: int, optional, the header argument of pd.read_csv
+    :return: str, the name of the cache file, whose prefix only depends on the path of the .csv file
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    path_hash = hashlib.sha1(path.encode()).hexdigest()[:16]
+    args = json.dumps([path, stat.st_size, stat.st_mtime_ns,
+                       None if dtype is None else {str(k): str(v) for k, v in dtype.items()}, parse_dates, header],
+                      default=str)
+    return f'{path_hash}_{hashlib.sha1(args.encode()).hexdigest()[:16]}.feather'
+
+
+def evict_cache(cache_dir: str, max_bytes: int, keep: str = None) -> None:
+    """
+    This function removes the least recently used cache files until the cache uses at most max_bytes
+    :param cache_dir: str, the directory of the cache
+    :param max_bytes: int, the maximum disk usage of the cache in bytes
+    :param keep: str, optional, the name of a cache file which should not be removed
+    :return: None
+    """
+    files = [entry for entry in os.scandir(cache_dir) if entry.is_file() and entry.name.endswith('.feather')]
+    files.sort(key=lambda entry: entry.stat().st_mtime_ns)
+    total_bytes = sum(entry.stat().st_size for entry in files)
+    for entry in files:
+        if total_bytes <= max_bytes:
+            break
+        if entry.name != keep:
+            total_bytes -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+def read_csv_cached(path: str, cache_dir: str, max_bytes: int, dtype: dict = None, parse_dates: list = None,
+                    header: int = 0, usecols: list = None) -> pd.DataFrame:
+    """
+    This function reads a .csv file through an on-disk cache. The first read parses the .csv file and writes its
+    content as a Feather file, later reads memory-map the Feather file instead of parsing the text again. Cache
+    files of previous versions of the .csv file are removed and the least recently used files are evicted when the
+    cache grows beyond max_bytes
+    :param path: str, the path of the .csv file
+    :param cache_dir: str, the directory of the cache, created if it does not exist
+    :param max_bytes: int, the maximum disk usage of the cache in bytes
+    :param dtype: dict, optional, the dtype argument of pd.read_csv
+    :param parse_dates: list, optional, the parse_dates argument of pd.read_csv
+    :param header: int, optional, the header argument of pd.read_csv
+    :param usecols: list, optional, the columns to be returned, in the order of the .csv file
+    :return: pd.DataFrame, the content of the .csv file
+    """
+    import pyarrow.feather as feather
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_name = cache_key(path=path, dtype=dtype, parse_dates=parse_dates, header=header)
+    path_cache = os.path.join(cache_dir, file_name)
+
+    if os.path.isfile(path_cache):
+        os.utime(path_cache)
+        table = feather.read_table(path_cache, memory_map=True)
+        if usecols is not None:
+            table = table.select([col for col in table.column_names if col in usecols])
+        return table.to_pandas()
+
+    db = pd.read_csv(filepath_or_buffer=path, dtype=dtype, header=header, parse_dates=parse_dates)
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith(file_name.split('_')[0] + '_'):
+            # Another process caching the same file may have removed it already
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    # Each writer has its own temporary file, so that processes caching the same file at once do not overwrite or
+    # remove each other's file
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.tmp', delete=False) as file_tmp:
+        path_tmp = file_tmp.name
+    try:
+        db.to_feather(path=path_tmp, compression='uncompressed')
+        os.replace(path_tmp, path_cache)
+    except Exception as e:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+        warnings.warn(f'The file {path} could not be cached: {e}')
+    evict_cache(cache_dir=cache_dir, max_bytes=max_bytes, keep=file_name)
+
+    return db if usecols is None else db[[col for col in db.columns if col in usecols]]
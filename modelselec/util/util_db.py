@@ -6,18 +6,228 @@
                                            guill.khayat@gmail.com
                                                 2024-02-06
 """
+import glob
+from typing import Union
 from modelselec.modules_paths import *
+from modelselec.util.util_profile import profiled
 
 
 def check_file_exists(instance, attribute, value) -> None:
     """
-    This validator checks if a file exists in a given path and raises a ValueError if it does not
+    This validator checks if a file exists in a given path and raises a ValueError if it does not. For datasets, it
+    checks if the directory exists or if the glob pattern matches at least one file
     :param instance: DBhist, the class instance to be check during creation
     :return: None
     """
-    if not os.path.isfile(f'{instance.path_db}{instance.file_name}.{instance.file_type}'):
+    if instance.file_type == 'dataset':
+        path = f'{instance.path_db}{instance.file_name}'
+        if not (os.path.isdir(path) or any(os.path.isfile(file) for file in glob.iglob(path, recursive=True))):
+            raise ValueError(f"The dataset {instance.file_name} does not exist.")
+    elif not os.path.isfile(f'{instance.path_db}{instance.file_name}.{instance.file_type}'):
         raise ValueError(f"The file {instance.file_name}.{instance.file_type} does not exist.")
 
+@profiled
+def apply_filters(db: pd.DataFrame, filters: list = None) -> pd.DataFrame:
+    """
+    This function keeps the rows of a dataframe which satisfy filters written in the same format as the filters of
+    pd.read_parquet, i.e. a list of (column, operator, value) tuples combined with AND, or a list of such lists
+    combined with OR
+    :param db: pd.DataFrame, the dataframe to be filtered
+    :param filters: list, optional, the filters. Allowed operators are '=', '==', '!=', '<', '<=', '>', '>=', 'in'
+                    and 'not in'
+    :return: pd.DataFrame, the rows of db which satisfy the filters
+    """
+    if not filters:
+        return db
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+
+    mask = np.zeros(len(db), dtype=bool)
+    for conjunction in filters:
+        mask_conj = np.ones(len(db), dtype=bool)
+        for column, operator, value in conjunction:
+            series = db[column]
+            match operator:
+                case '=' | '==':
+                    mask_pred = series == value
+                case '!=':
+                    mask_pred = series != value
+                case '<':
+                    mask_pred = series < value
+                case '<=':
+                    mask_pred = series <= value
+                case '>':
+                    mask_pred = series > value
+                case '>=':
+                    mask_pred = series >= value
+                case 'in':
+                    mask_pred = series.isin(value)
+                case 'not in':
+                    mask_pred = ~series.isin(value)
+                case _:
+                    raise Exception(f'Invalid filter operator: {operator}')
+            mask_conj &= np.asarray(mask_pred, dtype=bool)
+        mask |= mask_conj
+    return db[mask]
+
+def _filter_columns(filters: list = None) -> list:
+    """
+    This function lists the columns on which filters written in the format of apply_filters have conditions
+    :param filters: list, optional, the filters
+    :return: list of str, the columns, without duplicates
+    """
+    conjunctions = [filters] if filters and isinstance(filters[0], tuple) else (filters or [])
+    return list(dict.fromkeys(cond[0] for conjunction in conjunctions for cond in conjunction))
+
+def _partition_value(value: str) -> Union[int, float, str, None]:
+    """
+    This function converts the value of a partition key, as written in a directory name, to an int or a float
+    when possible
+    :param value: str, the value of the partition key
+    :return: int, float, str, or None for the default partition of missing values
+    """
+    if value == '__HIVE_DEFAULT_PARTITION__':
+        return None
+    for convert in [int, float]:
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+@profiled
+def dataset_files(path: str, filters: list = None) -> list:
+    """
+    This function lists the files of a partitioned dataset and the values of their partition keys, read from
+    directory names written as key=value. Files whose partition values do not satisfy the filters are pruned
+    :param path: str, either a directory whose files (at any depth) are the dataset, or a glob pattern of files
+    :param filters: list, optional, the filters in the format of apply_filters. Only the conditions on partition keys
+                    are used to prune files, the other conditions are ignored
+    :return: list of (str, dict) tuples, the path of each file and the values of its partition keys, sorted by path
+    """
+    if os.path.isdir(path):
+        root = path
+        files = [os.path.join(dir_path, file_name) for dir_path, dir_names, file_names in os.walk(path)
+                 for file_name in file_names if not file_name.startswith(('.', '_'))]
+    else:
+        # Partition keys are read from the directories matched by the pattern
+        parts = path.split(os.sep)
+        n_root = next((i for i, part in enumerate(parts) if glob.has_magic(part)), len(parts) - 1)
+        root = os.sep.join(parts[:n_root]) or os.curdir
+        files = [file for file in glob.glob(path, recursive=True) if os.path.isfile(file)]
+
+    partitions = []
+    for file in files:
+        parts = os.path.relpath(os.path.dirname(file), root).split(os.sep)
+        partitions.append(dict(part.split('=', 1) for part in parts if '=' in part))
+    # A partition key is converted to a number only if all its values are numbers
+    for key in set(key for partition in partitions for key in partition):
+        values = [_partition_value(partition[key]) for partition in partitions if key in partition]
+        numeric = all(isinstance(value, (int, float)) or value is None for value in values)
+        for partition in partitions:
+            if key in partition:
+                value = _partition_value(partition[key])
+                partition[key] = value if numeric or (value is None) else partition[key]
+    dataset = sorted(zip(files, partitions), key=lambda file: file[0])
+
+    if filters:
+        if isinstance(filters[0], tuple):
+            filters = [filters]
+        keys = set(key for _, partition in dataset for key in partition)
+        pruned = []
+        for file, partition in dataset:
+            row = pd.DataFrame({key: [partition.get(key)] for key in keys})
+            # A conjunction may be true for a file if the conditions on its partition keys are true
+            if any(len(apply_filters(db=row, filters=[[cond for cond in conjunction if cond[0] in keys]])) > 0
+                   if any(cond[0] in keys for cond in conjunction) else True for conjunction in filters):
+                pruned.append((file, partition))
+        dataset = pruned
+    return dataset
+
+@profiled
+def read_dataset_file(path: str, partition: dict, columns: list = None, filters: list = None):
+    """
+    This function reads one file of a partitioned dataset as an Arrow table, adds its partition keys as columns and
+    keeps the rows which satisfy the filters
+    :param path: str, the path of the file
+    :param partition: dict, the values of the partition keys of the file
+    :param columns: list, optional, the columns to be returned, partition keys included. All columns by default
+    :param filters: list, optional, the filters in the format of apply_filters
+    :return: pyarrow.Table, the rows of the file which satisfy the filters
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    read_cols = None
+    if columns is not None:
+        read_cols = [col for col in dict.fromkeys(list(columns) + _filter_columns(filters)) if col not in partition]
+        read_cols = [col for col in read_cols if col in pq.read_schema(path).names]
+    table = pq.read_table(path, columns=read_cols)
+    for key, value in partition.items():
+        if key not in table.column_names:
+            table = table.append_column(key, pa.repeat(value, table.num_rows) if value is not None else
+                                        pa.nulls(table.num_rows))
+    if filters:
+        table = table.filter(pq.filters_to_expression(filters))
+    if columns is not None:
+        table = table.select([col for col in columns if col in table.column_names])
+    return table
+
+@profiled
+def compact_dtypes(db: pd.DataFrame, category_threshold: float = 0.5, arrow_strings: bool = False) -> pd.DataFrame:
+    """
+    This function reduces the memory footprint of a dataframe: integer columns are downcast to the smallest signed
+    integer type which holds their values, float columns are downcast to float32 only when no value changes, and
+    text columns are converted to category when they have few distinct values
+    :param db: pd.DataFrame, the dataframe to be compacted
+    :param category_threshold: float, optional, text columns whose number of distinct values divided by their number
+                                of rows is at most this ratio are converted to category
+    :param arrow_strings: bool, optional, True if the remaining text columns should use the Arrow-backed string dtype
+    :return: pd.DataFrame, a new dataframe with the same values and more compact dtypes
+    """
+    columns = {}
+    for col in db.columns:
+        series = db[col]
+        if pd.api.types.is_bool_dtype(series) or isinstance(series.dtype, pd.CategoricalDtype):
+            columns[col] = series
+        elif pd.api.types.is_integer_dtype(series):
+            columns[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series) and series.dtype.itemsize > 4:
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+            with np.errstate(over='ignore'):
+                values_32 = values.astype(np.float32)
+            columns[col] = series.astype(np.float32) if np.array_equal(values_32.astype(np.float64), values,
+                                                                       equal_nan=True) else series
+        elif (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)) and \
+                pd.api.types.infer_dtype(series, skipna=True) in ['string', 'empty']:
+            if series.nunique() <= category_threshold * len(series):
+                columns[col] = series.astype('category')
+            elif arrow_strings:
+                columns[col] = series.astype('string[pyarrow]')
+            else:
+                columns[col] = series
+        else:
+            columns[col] = series
+    return pd.DataFrame(columns, index=db.index)
+
+@profiled
+def memory_report(db_before: pd.DataFrame, db_after: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function compares the memory used by each column of a dataframe before and after a dtype conversion
+    :param db_before: pd.DataFrame, the dataframe before the conversion
+    :param db_after: pd.DataFrame, the dataframe after the conversion, with the same columns
+    :return: pd.DataFrame, indexed by column name, with the dtype and the number of bytes before and after the
+                conversion and the percentage of memory saved. The last row is the total
+    """
+    report = pd.DataFrame({'Dtype before': db_before.dtypes.astype(str),
+                           'Dtype after': db_after.dtypes.astype(str),
+                           'Bytes before': db_before.memory_usage(index=False, deep=True),
+                           'Bytes after': db_after.memory_usage(index=False, deep=True)})
+    report.loc['Total'] = ['', '', report['Bytes before'].sum(), report['Bytes after'].sum()]
+    report['% saved'] = (1 - report['Bytes after'] / report['Bytes before']) * 100
+    return report
+
+@profiled
 def diff(db: pd.DataFrame, nTransf: int) -> pd.DataFrame:
     """
     This function calculates the x(t)-x(t-n) value for each column in a dataframe
@@ -29,6 +239,7 @@ def diff(db: pd.DataFrame, nTransf: int) -> pd.DataFrame:
     dbDiff = db.astype(float).diff(periods=nTransf)
     return dbDiff
 
+@profiled
 def ln_diff(db: pd.DataFrame, nTransf: int) -> pd.DataFrame:
     """
     This function calculates the ln(x(t))-ln(x(t-n)) value for each column in a dataframe
@@ -40,6 +251,87 @@ def ln_diff(db: pd.DataFrame, nTransf: int) -> pd.DataFrame:
     dbLogDiff = np.log(db.astype(float)).diff(periods=nTransf)
     return dbLogDiff
 
+@profiled
+def panel_transform(db: pd.DataFrame, entity: Union[str, list], time: str, columns: list = None, lags: list = None,
+                    transfs: list = None, dtype: str = 'float64') -> pd.DataFrame:
+    """
+    This function calculates the diff and ln_diff of each column of a long-format panel for several lags at once. The
+    rows are sorted once by entity and time, every lag is computed on the sorted arrays, and the values whose lagged
+    observation belongs to another entity are set to NaN, so that no value leaks across entities
+    :param db: pd.DataFrame, the panel, with one row per entity and period
+    :param entity: str or list of str, the column(s) which identify each entity
+    :param time: str, the column of the periods, used to order the observations of each entity
+    :param columns: list of str, optional, the columns in level to be transformed. By default, every numerical column
+                    other than entity and time
+    :param lags: list of int, optional, how many observations of the same entity should we look back to calculate
+                    each difference. By default, [1]
+    :param transfs: list of str, optional, the transformations among 'diff' and 'ln_diff'. By default, both of them
+    :param dtype: str, optional, 'float64' or 'float32', the dtype of the computations and of the output
+    :return: pd.DataFrame, with the same index and order of rows as db and one column per column, transformation and
+                lag, named {col}_diff_{lag} or {col}_ln_diff_{lag}
+    """
+    keys = [entity] if isinstance(entity, str) else list(entity)
+    lags = [1] if lags is None else list(lags)
+    transfs = ['diff', 'ln_diff'] if transfs is None else list(transfs)
+    if columns is None:
+        columns = [col for col in db.select_dtypes(include=np.number).columns if col not in keys + [time]]
+    if any(isinstance(lag, bool) or not isinstance(lag, (int, np.integer)) or lag < 1 for lag in lags):
+        raise Exception("'lags' should only include positive integers")
+    invalid = [transf for transf in transfs if transf not in ['diff', 'ln_diff']]
+    if len(invalid) > 0:
+        raise Exception(f"Invalid transformations: {invalid}. Only ['diff', 'ln_diff'] are allowed")
+    if dtype not in ['float64', 'float32']:
+        raise Exception("'dtype' should be either 'float64' or 'float32'")
+
+    # Rows are sorted by entity then time, the sort is stable so that ties keep their original order
+    entity_codes = db.groupby(keys, sort=False, dropna=False).ngroup().to_numpy()
+    order = np.lexsort((pd.factorize(db[time], sort=True)[0], entity_codes))
+    entity_codes = entity_codes[order]
+    # The first row of each entity in the sorted rows, the next lag rows have no lagged observation in the entity
+    starts = np.flatnonzero(np.r_[True, entity_codes[1:] != entity_codes[:-1]])
+    ends = np.r_[starts[1:], len(db)]
+
+    # Arrays are stored with one row per series, so that each series and each output column is contiguous
+    values = np.ascontiguousarray(db[columns].to_numpy(dtype=dtype)[order].T)
+    levels = {'diff': values}
+    if 'ln_diff' in transfs:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            levels['ln_diff'] = np.log(values)
+
+    names, features = [], np.empty((len(columns) * len(transfs) * len(lags), len(db)), dtype=dtype)
+    for i, (transf, lag) in enumerate([(transf, lag) for transf in transfs for lag in lags]):
+        block = features[i * len(columns):(i + 1) * len(columns)]
+        lag_use = min(lag, len(db))
+        np.subtract(levels[transf][:, lag_use:], levels[transf][:, :len(db) - lag_use], out=block[:, lag_use:])
+        no_lag = (starts[:, None] + np.arange(lag_use)).ravel()
+        block[:, no_lag[no_lag < np.repeat(ends, lag_use)]] = np.nan
+        names += [f'{col}_{transf}_{lag}' for col in columns]
+
+    # The rows are put back in their original order
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    return pd.DataFrame(features.take(inverse, axis=1).T, index=db.index, columns=names, copy=False)
+
+def _diff_inv_values(values: np.ndarray, t0_tail: np.ndarray, nTransf: int) -> np.ndarray:
+    """
+    This function rebuilds level values from differences in closed form: the level nTransf periods after a known
+    level is that level plus the cumulative sum of every nTransf-th difference, computed by reshaping the differences
+    into blocks of nTransf periods and summing them cumulatively across blocks
+    :param values: np.ndarray, the differences, with periods on the second to last axis and series on the last axis
+    :param t0_tail: np.ndarray, the last nTransf level values of each series, of shape (nTransf, number of series)
+    :param nTransf: int, the number of periods we looked back to calculate the difference
+    :return: np.ndarray of the same shape as values with the level values
+    """
+    horizon, n_series = values.shape[-2], values.shape[-1]
+    n_blocks = -(-horizon // nTransf)
+    pad = n_blocks * nTransf - horizon
+    if pad > 0:
+        values = np.concatenate([values, np.zeros(values.shape[:-2] + (pad, n_series), dtype=values.dtype)], axis=-2)
+    levels = np.cumsum(values.reshape(values.shape[:-2] + (n_blocks, nTransf, n_series)), axis=-3)
+    levels += t0_tail
+    return levels.reshape(values.shape)[..., :horizon, :]
+
+@profiled
 def diff_inv(db: pd.DataFrame, nTransf: int, t0: pd.DataFrame) -> pd.DataFrame:
     """
     This function receives as input a databased based on differences and the initial level values and returns
@@ -52,25 +344,18 @@ def diff_inv(db: pd.DataFrame, nTransf: int, t0: pd.DataFrame) -> pd.DataFrame:
     if len(t0) < nTransf:
         raise Exception('The number of provided historical observations should be at least as large as the number '
                         'of the backward observations from which the difference was calculated')
-    dbInt = db.copy()
+    dbInt = db
     if db.isna().any().any():
         dbInt = dbInt.dropna()
-    dbInt.reset_index(inplace=True, drop=True)
-    if len(dbInt) > 1:
-        t0.reset_index(inplace=True, drop=True)
-        t0Loop = t0.tail(nTransf)
-        t0Loop.reset_index(drop=True, inplace=True)
-        t0Loop = pd.concat(objs=[t0, dbInt.head(1) + t0Loop.iloc[[0, ]]], axis='index')
-        diffDB = dbInt.iloc[1:, ]
-        return diff_inv(db=diffDB, nTransf=nTransf, t0=t0Loop)
-    else:
-        t0.reset_index(inplace=True, drop=True)
-        t0Loop = t0.tail(nTransf)
-        t0Loop.reset_index(drop=True, inplace=True)
-        t0Loop = pd.concat(objs=[t0, dbInt.head(1) + t0Loop.iloc[[0, ]]], axis='index', ignore_index=True)
-        return t0Loop
+    t0Lvl = t0.reset_index(drop=True)
+    levels = _diff_inv_values(values=dbInt.to_numpy(dtype=np.float64),
+                              t0_tail=t0Lvl[dbInt.columns].tail(nTransf).to_numpy(dtype=np.float64),
+                              nTransf=nTransf)
+    return pd.concat(objs=[t0Lvl, pd.DataFrame(data=levels, columns=dbInt.columns)], axis='index',
+                     ignore_index=True)
 
 
+@profiled
 def ln_diff_inv(db: pd.DataFrame, nTransf: int, t0: pd.DataFrame) -> pd.DataFrame:
     """
     This function receives as input a databased based on differences of ln() and the initial level values and returns
@@ -86,3 +371,44 @@ def ln_diff_inv(db: pd.DataFrame, nTransf: int, t0: pd.DataFrame) -> pd.DataFram
 
     lvl_log = diff_inv(db=db, nTransf=nTransf, t0=np.log(t0))
     return np.exp(lvl_log)
+
+
+@profiled
+def diff_inv_paths(values: np.ndarray, nTransf: int, t0: Union[pd.DataFrame, np.ndarray], log: bool = False,
+                   quantiles: list = None) -> dict:
+    """
+    This function rebuilds the level values of many simulated forecast paths which share the same history, from their
+    differences or differences of ln(), in one vectorized operation over all paths
+    :param values: np.ndarray of shape (paths, horizon, series), the differences (or differences of ln()) of each
+                    path, without missing values
+    :param nTransf: int, the number of periods we looked back to calculate the difference
+    :param t0: pd.DataFrame or np.ndarray of shape (periods, series), the initial level values shared by all paths,
+                with at least nTransf periods. The columns of a dataframe are the series, in the order of values
+    :param log: bool, optional, True if values are differences of ln() as returned by ln_diff
+    :param quantiles: list of float, optional, the quantiles of the fan bands, computed across paths
+    :return: dict, the level values of each path under 'levels', an np.ndarray of the same shape as values which
+                does not include t0, and, if quantiles are provided, the fan bands under 'bands', an np.ndarray of
+                shape (quantiles, horizon, series)
+    """
+    values = np.asarray(values)
+    if values.ndim != 3:
+        raise Exception("'values' should be an array of shape (paths, horizon, series)")
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(np.float64)
+    t0 = t0.to_numpy(dtype=values.dtype) if isinstance(t0, pd.DataFrame) else np.asarray(t0, dtype=values.dtype)
+    if (t0.ndim != 2) or (t0.shape[1] != values.shape[2]):
+        raise Exception("'t0' should have one column per series of 'values'")
+    if len(t0) < nTransf:
+        raise Exception('The number of provided historical observations should be at least as large as the number '
+                        'of the backward observations from which the difference was calculated')
+
+    t0_tail = t0[-nTransf:]
+    if log:
+        t0_tail = np.log(t0_tail)
+    levels = _diff_inv_values(values=values, t0_tail=t0_tail, nTransf=nTransf)
+    if log:
+        np.exp(levels, out=levels)
+    paths = {'levels': levels}
+    if quantiles is not None:
+        paths['bands'] = np.quantile(levels, quantiles, axis=0)
+    return paths
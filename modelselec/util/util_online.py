@@ -0,0 +1,320 @@
+"""
+                        This script includes accumulators which update performance metrics batch by
+                            batch in constant memory, to monitor models on live traffic
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-04-05
+"""
+import attr
+from typing import Union
+from modelselec.modules_paths import *
+from modelselec.util.util_perf import _batch_metrics, _confusion_derived, confusion_metrics
+
+
+def _to_array(values: Union[pd.DataFrame, pd.Series, np.ndarray, list], dtype=None) -> np.ndarray:
+    """
+    This function converts a batch of values to a 1D array
+    :param values: pd.DataFrame of 1 column, pd.Series, np.ndarray or list, the batch of values
+    :param dtype: optional, the dtype of the array
+    :return: np.ndarray, the values
+    """
+    if isinstance(values, pd.DataFrame):
+        if len(values.columns) != 1:
+            raise Exception('Computing the performance metrics is possible only for 1 series at a time')
+        values = values.iloc[:, 0]
+    return np.asarray(values, dtype=dtype).ravel()
+
+
+def _batch_weights(n: int, decay: Union[float, None]) -> np.ndarray:
+    """
+    This function returns the weights of the observations of a batch, the last observation having a weight of 1 and
+    each previous observation the weight of the next one multiplied by decay
+    :param n: int, the number of observations of the batch
+    :param decay: float or None, the decay factor. All weights are 1 if None
+    :return: np.ndarray of shape (n,), the weights
+    """
+    return np.ones(n) if decay is None else decay ** np.arange(n - 1, -1, -1, dtype=np.float64)
+
+
+@attr.define(slots=True)
+class _CoMoments:
+    """
+    This class stores mergeable weighted co-moments of two variables: the sum of the weights, the means, the sums of
+    squared deviations and the sum of cross deviations, merged with Chan's parallel formulas
+    """
+
+    weight: float = attr.field(default=0.0)
+    mean_x: float = attr.field(default=0.0)
+    mean_y: float = attr.field(default=0.0)
+    m2_x: float = attr.field(default=0.0)
+    m2_y: float = attr.field(default=0.0)
+    c_xy: float = attr.field(default=0.0)
+
+    @classmethod
+    def from_values(cls, x: np.ndarray, y: np.ndarray, weights: np.ndarray) -> '_CoMoments':
+        """
+        Compute the co-moments of a batch of observations
+        :param x: np.ndarray, the observations of the first variable
+        :param y: np.ndarray, the observations of the second variable
+        :param weights: np.ndarray, the weight of each observation
+        :return: _CoMoments, the co-moments of the batch
+        """
+        weight = float(weights.sum())
+        if weight == 0:
+            return cls()
+        mean_x, mean_y = float(weights @ x / weight), float(weights @ y / weight)
+        dev_x, dev_y = x - mean_x, y - mean_y
+        return cls(weight=weight, mean_x=mean_x, mean_y=mean_y, m2_x=float(weights @ dev_x ** 2),
+                   m2_y=float(weights @ dev_y ** 2), c_xy=float(weights @ (dev_x * dev_y)))
+
+    def scale(self, factor: float) -> '_CoMoments':
+        """
+        Multiply the weights of every observation by a factor, e.g. to decay them
+        :param factor: float, the factor
+        :return: _CoMoments, the scaled co-moments
+        """
+        return _CoMoments(weight=self.weight * factor, mean_x=self.mean_x, mean_y=self.mean_y, m2_x=self.m2_x * factor,
+                          m2_y=self.m2_y * factor, c_xy=self.c_xy * factor)
+
+    def merge(self, other: '_CoMoments') -> '_CoMoments':
+        """
+        Combine two co-moments
+        :param other: _CoMoments, the co-moments to be merged with
+        :return: _CoMoments, the co-moments of the union of the observations of both
+        """
+        if self.weight == 0:
+            return other
+        if other.weight == 0:
+            return self
+        weight = self.weight + other.weight
+        delta_x, delta_y = other.mean_x - self.mean_x, other.mean_y - self.mean_y
+        factor = self.weight * other.weight / weight
+        return _CoMoments(weight=weight, mean_x=self.mean_x + delta_x * other.weight / weight,
+                          mean_y=self.mean_y + delta_y * other.weight / weight,
+                          m2_x=self.m2_x + other.m2_x + delta_x ** 2 * factor,
+                          m2_y=self.m2_y + other.m2_y + delta_y ** 2 * factor,
+                          c_xy=self.c_xy + other.c_xy + delta_x * delta_y * factor)
+
+    def corr(self) -> float:
+        """
+        Report the Pearson correlation of the two variables
+        :return: float, the correlation. NaN when a variance is 0
+        """
+        if (self.m2_x <= 0) or (self.m2_y <= 0):
+            return np.nan
+        return float(np.clip(self.c_xy / np.sqrt(self.m2_x * self.m2_y), -1, 1))
+
+
+@attr.define(slots=True)
+class NumericAccumulator:
+    """
+    This class updates the metrics of perf_metrics for a numerical dependent variable batch by batch, in constant
+    memory. Observations can be weighted with an exponential decay, so that recent observations weigh more, or only
+    the last window observations can be kept in a ring buffer. Differences are computed across batches, batches are
+    expected in chronological order
+    """
+
+    transf: str = attr.field(default='lvl', validator=attr.validators.in_(['lvl', 'diff', 'diffln']),
+                             converter=str.lower)
+    decay: float = attr.field(default=None, validator=attr.validators.optional(
+        attr.validators.and_(attr.validators.gt(0), attr.validators.le(1))))
+    window: int = attr.field(default=None, validator=attr.validators.optional(
+        attr.validators.and_(attr.validators.instance_of(int), attr.validators.gt(1))))
+    n_obs: int = attr.field(default=0)
+    levels: _CoMoments = attr.field(factory=_CoMoments)
+    diffs: _CoMoments = attr.field(factory=_CoMoments)
+    sum_sq_errors: float = attr.field(default=0.0)
+    sum_abs_prct_errors: float = attr.field(default=0.0)
+    first: Union[np.ndarray, None] = attr.field(default=None)
+    last: Union[np.ndarray, None] = attr.field(default=None)
+    _buffer: Union[np.ndarray, None] = attr.field(default=None)
+
+    def __attrs_post_init__(self):
+        if (self.decay is not None) and (self.window is not None):
+            raise Exception("Only one of 'decay' and 'window' can be provided")
+        if (self.window is not None) and (self._buffer is None):
+            self._buffer = np.empty((0, 2))
+
+    def _transform(self, values: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(values) if self.transf == 'diffln' else values
+
+    def update(self, obs_batch: Union[pd.DataFrame, pd.Series, np.ndarray, list],
+               pred_batch: Union[pd.DataFrame, pd.Series, np.ndarray, list]) -> None:
+        """
+        Add a batch of observed and predicted values, which follow the values already added. Missing values, and
+        non-positive values when transf is 'diffln', are not allowed
+        :param obs_batch: pd.DataFrame of 1 column, pd.Series, np.ndarray or list, the observed values
+        :param pred_batch: pd.DataFrame of 1 column, pd.Series, np.ndarray or list, the predicted values
+        :return: None
+        """
+        obs, pred = _to_array(obs_batch, dtype=np.float64), _to_array(pred_batch, dtype=np.float64)
+        if len(obs) != len(pred):
+            raise Exception('Both observed and predicted batches should have the same number of rows')
+        # The batch is checked before any state is changed, a missing value would make every metric NaN for good
+        if np.isnan(obs).any() or np.isnan(pred).any():
+            raise Exception('The observed and predicted batches should not include missing values')
+        if (self.transf == 'diffln') and ((obs <= 0).any() or (pred <= 0).any()):
+            raise Exception("The observed and predicted batches should only include positive values when 'transf' "
+                            "is 'diffln'")
+        if len(obs) == 0:
+            return
+        batch = NumericAccumulator(transf=self.transf, decay=self.decay, window=self.window)
+        if self.window is not None:
+            batch._buffer = np.column_stack([obs, pred])[-self.window:]
+        else:
+            weights = _batch_weights(n=len(obs), decay=self.decay)
+            errors = obs - pred
+            batch.levels = _CoMoments.from_values(x=obs, y=pred, weights=weights)
+            batch.sum_sq_errors = float(weights @ errors ** 2)
+            batch.sum_abs_prct_errors = float(weights @ np.abs(errors / (obs + 10**(-10))))
+            if self.transf != 'lvl':
+                values = self._transform(np.column_stack([obs, pred]))
+                batch.diffs = _CoMoments.from_values(x=np.diff(values[:, 0]), y=np.diff(values[:, 1]),
+                                                    weights=weights[1:])
+        batch.n_obs = len(obs)
+        batch.first, batch.last = np.array([obs[0], pred[0]]), np.array([obs[-1], pred[-1]])
+        merged = self.merge(batch)
+        for field in ['n_obs', 'levels', 'diffs', 'sum_sq_errors', 'sum_abs_prct_errors', 'first', 'last',
+                      '_buffer']:
+            setattr(self, field, getattr(merged, field))
+
+    def merge(self, other: 'NumericAccumulator') -> 'NumericAccumulator':
+        """
+        Combine two accumulators, the values of other following the values of self
+        :param other: NumericAccumulator, the accumulator to be merged with, with the same transf, decay and window
+        :return: NumericAccumulator, the accumulator of the values of both
+        """
+        if (self.transf, self.decay, self.window) != (other.transf, other.decay, other.window):
+            raise Exception("Both accumulators should have the same 'transf', 'decay' and 'window'")
+        if self.n_obs == 0:
+            return other
+        if other.n_obs == 0:
+            return self
+        merged = NumericAccumulator(transf=self.transf, decay=self.decay, window=self.window,
+                                    n_obs=self.n_obs + other.n_obs, first=self.first, last=other.last)
+        if self.window is not None:
+            merged._buffer = np.concatenate([self._buffer, other._buffer])[-self.window:]
+            return merged
+
+        # The values of self are older than every value of other, so their weights decay once per value of other
+        factor = 1.0 if self.decay is None else self.decay ** other.n_obs
+        merged.levels = self.levels.scale(factor).merge(other.levels)
+        merged.sum_sq_errors = self.sum_sq_errors * factor + other.sum_sq_errors
+        merged.sum_abs_prct_errors = self.sum_abs_prct_errors * factor + other.sum_abs_prct_errors
+        if self.transf != 'lvl':
+            # The difference between the last value of self and the first value of other
+            boundary = np.diff(self._transform(np.vstack([self.last, other.first])), axis=0)[0]
+            boundary_weight = 1.0 if self.decay is None else self.decay ** (other.n_obs - 1)
+            merged.diffs = self.diffs.scale(factor).merge(
+                _CoMoments.from_values(x=boundary[:1], y=boundary[1:], weights=np.array([boundary_weight]))).merge(
+                other.diffs)
+        return merged
+
+    def result(self) -> dict:
+        """
+        Report the metrics of the values added so far
+        :return: dict, the same metrics as perf_metrics for a numerical dependent variable
+        """
+        key = {'diff': 'diffCorr', 'diffln': 'diffLnCorr'}.get(self.transf)
+        if self.window is not None:
+            if len(self._buffer) == 0:
+                return {metric: np.nan for metric in ['lvlCorr'] + ([key] if key else []) + ['RMSE', 'NRMSE', 'MAPE']}
+            metrics = _batch_metrics(obs_values=self._buffer[:, 0], pred_values=self._buffer[:, 1:],
+                                     transf=self.transf)
+            return {metric: float(values[0]) for metric, values in metrics.items()}
+
+        weight = self.levels.weight
+        rmse = np.sqrt(self.sum_sq_errors / weight) if weight > 0 else np.nan
+        metrics = {'lvlCorr': self.levels.corr()}
+        if key is not None:
+            metrics[key] = self.diffs.corr()
+        metrics['RMSE'] = rmse
+        metrics['NRMSE'] = rmse / self.levels.mean_x if weight > 0 else np.nan
+        metrics['MAPE'] = self.sum_abs_prct_errors / weight if weight > 0 else np.nan
+        return metrics
+
+
+@attr.define(slots=True)
+class CategoricalAccumulator:
+    """
+    This class updates the confusion matrix of a categorical dependent variable batch by batch, in memory which only
+    depends on the number of classes. Observations can be weighted with an exponential decay, or only the last window
+    observations can be kept in a ring buffer
+    """
+
+    decay: float = attr.field(default=None, validator=attr.validators.optional(
+        attr.validators.and_(attr.validators.gt(0), attr.validators.le(1))))
+    window: int = attr.field(default=None, validator=attr.validators.optional(
+        attr.validators.and_(attr.validators.instance_of(int), attr.validators.gt(0))))
+    counts: pd.DataFrame = attr.field(factory=lambda: pd.DataFrame(dtype=np.float64))
+    n_obs: int = attr.field(default=0)
+    _buffer: Union[pd.DataFrame, None] = attr.field(default=None)
+
+    def __attrs_post_init__(self):
+        if (self.decay is not None) and (self.window is not None):
+            raise Exception("Only one of 'decay' and 'window' can be provided")
+        if (self.window is not None) and (self._buffer is None):
+            self._buffer = pd.DataFrame({'obs': pd.Series(dtype=object), 'pred': pd.Series(dtype=object)})
+
+    def update(self, obs_batch: Union[pd.DataFrame, pd.Series, np.ndarray, list],
+               pred_batch: Union[pd.DataFrame, pd.Series, np.ndarray, list]) -> None:
+        """
+        Add a batch of observed and predicted labels, which follow the labels already added
+        :param obs_batch: pd.DataFrame of 1 column, pd.Series, np.ndarray or list, the observed labels
+        :param pred_batch: pd.DataFrame of 1 column, pd.Series, np.ndarray or list, the predicted labels
+        :return: None
+        """
+        obs, pred = _to_array(obs_batch), _to_array(pred_batch)
+        if len(obs) != len(pred):
+            raise Exception('Both observed and predicted batches should have the same number of rows')
+        if len(obs) == 0:
+            return
+        batch = CategoricalAccumulator(decay=self.decay, window=self.window, n_obs=len(obs))
+        if self.window is not None:
+            batch._buffer = pd.DataFrame({'obs': obs, 'pred': pred}).iloc[-self.window:]
+        else:
+            obs_codes, obs_labels = pd.factorize(obs, sort=True)
+            pred_codes, pred_labels = pd.factorize(pred, sort=True)
+            if (obs_codes < 0).any() or (pred_codes < 0).any():
+                raise Exception('The observed and predicted batches should not include missing values')
+            cells = obs_codes.astype(np.int64) * len(pred_labels) + pred_codes
+            weights = _batch_weights(n=len(obs), decay=self.decay)
+            counts = np.bincount(cells, weights=weights, minlength=len(obs_labels) * len(pred_labels))
+            batch.counts = pd.DataFrame(counts.reshape(len(obs_labels), len(pred_labels)), index=obs_labels,
+                                        columns=pred_labels)
+        merged = self.merge(batch)
+        self.counts, self.n_obs, self._buffer = merged.counts, merged.n_obs, merged._buffer
+
+    def merge(self, other: 'CategoricalAccumulator') -> 'CategoricalAccumulator':
+        """
+        Combine two accumulators, the labels of other following the labels of self
+        :param other: CategoricalAccumulator, the accumulator to be merged with, with the same decay and window
+        :return: CategoricalAccumulator, the accumulator of the labels of both
+        """
+        if (self.decay, self.window) != (other.decay, other.window):
+            raise Exception("Both accumulators should have the same 'decay' and 'window'")
+        merged = CategoricalAccumulator(decay=self.decay, window=self.window, n_obs=self.n_obs + other.n_obs)
+        if self.window is not None:
+            merged._buffer = pd.concat([self._buffer, other._buffer], ignore_index=True).iloc[-self.window:]
+            return merged
+        factor = 1.0 if self.decay is None else self.decay ** other.n_obs
+        merged.counts = (self.counts * factor).add(other.counts, fill_value=0).fillna(0.0)
+        return merged
+
+    def result(self) -> dict:
+        """
+        Report the metrics of the labels added so far
+        :return: dict, the sorted labels, the confusion matrix (rows are observed and columns are predicted labels,
+                    with weighted counts if decay is provided), and the metrics of confusion_metrics
+        """
+        if self.window is not None:
+            return confusion_metrics(obs=self._buffer['obs'], pred=self._buffer['pred'], sparse=False)
+        labels = self.counts.index.union(self.counts.columns)
+        conf_matrix = self.counts.reindex(index=labels, columns=labels, fill_value=0.0).to_numpy()
+        if self.decay is None:
+            conf_matrix = conf_matrix.astype(np.int64)
+        return {'labels': np.asarray(labels), 'conf_matrix': conf_matrix,
+                **_confusion_derived(true_pos=np.diagonal(conf_matrix), true_sum=conf_matrix.sum(axis=1),
+                                     pred_sum=conf_matrix.sum(axis=0))}
@@ -0,0 +1,97 @@
+"""
+                        This script includes a runner which evaluates many candidate models over
+                            a pool of processes sharing their inputs through shared memory
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-03-27
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from modelselec.modules_paths import *
+from modelselec.util.util_perf import _batch_metrics
+
+# Arrays of the worker processes, attached to the shared memory blocks by _attach_shared
+_shared = {}
+
+
+def _attach_shared(obs_name: str, preds_name: str, n_obs: int, n_models: int) -> None:
+    """
+    This function attaches a worker process to the shared memory blocks holding the observed and predicted values
+    :param obs_name: str, the name of the shared memory block of the observed values
+    :param preds_name: str, the name of the shared memory block of the predicted values
+    :param n_obs: int, the number of observations
+    :param n_models: int, the number of candidate models
+    :return: None
+    """
+    for key, name, shape in [('obs', obs_name, (n_obs,)), ('preds', preds_name, (n_obs, n_models))]:
+        # The workers share the resource tracker of the parent process, which unlinks the block
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[key + '_shm'] = shm
+        _shared[key] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf, order='F')
+
+
+def _score_chunk(start: int, stop: int, transf: str) -> dict:
+    """
+    This function scores a chunk of candidate models in a worker process
+    :param start: int, the position of the first candidate model of the chunk
+    :param stop: int, the position after the last candidate model of the chunk
+    :param transf: str, one of 'lvl', 'diff' or 'diffln'
+    :return: dict, the name of each metric and an np.ndarray with its values for the chunk
+    """
+    return _batch_metrics(obs_values=_shared['obs'], pred_values=_shared['preds'][:, start:stop], transf=transf)
+
+
+def parallel_perf_metrics(obs: pd.DataFrame, preds: pd.DataFrame, transf: str = 'lvl', n_workers: int = None,
+                          chunk_size: int = None) -> pd.DataFrame:
+    """
+    This function evaluates many candidate models over a pool of processes. The observed and predicted values are
+    copied once into shared memory, where every worker reads them without receiving a pickled copy, and each worker
+    scores chunks of candidate models with vectorized computations
+    :param obs: pd.DataFrame of 1 column which includes the observed historical data of the dependent variable
+    :param preds: pd.DataFrame, one column per candidate model with its predicted values of the dependent variable,
+                    with the same number of rows as obs
+    :param transf: str, optional, one of 'lvl', 'diff' or 'diffln', the transformation whose correlation should be
+                    reported in addition to the correlation in level
+    :param n_workers: int, optional, the number of worker processes. All the available CPUs by default
+    :param chunk_size: int, optional, the number of candidate models scored by each task. By default, the candidate
+                        models are split into 4 chunks per worker
+    :return: pd.DataFrame, one row per candidate model with the same metrics as perf_metrics
+    """
+    if len(obs.columns) != 1:
+        raise Exception('The observed dataframe should have only 1 column')
+    if len(preds.columns) == 0:
+        raise Exception('The predicted dataframe should have at least 1 candidate model')
+    if len(obs) != len(preds):
+        raise Exception('Both observed and predicted dataframes should have the same number of rows')
+    if (transf is None) or (transf.lower() not in ['lvl', 'diff', 'diffln']):
+        raise Exception("'transf' should be one of the following transformations ['lvl', 'diff', 'diffln']")
+    if obs.isna().any().any() or preds.isna().any().any():
+        raise Exception('The observed and predicted dataframes should not include missing values')
+
+    n_obs, n_models = preds.shape
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    chunk_size = max(1, -(-n_models // (4 * n_workers))) if chunk_size is None else chunk_size
+    chunks = [(start, min(start + chunk_size, n_models)) for start in range(0, n_models, chunk_size)]
+
+    obs_shm = shared_memory.SharedMemory(create=True, size=max(1, n_obs * 8))
+    preds_shm = shared_memory.SharedMemory(create=True, size=max(1, n_obs * n_models * 8))
+    try:
+        np.ndarray((n_obs,), dtype=np.float64, buffer=obs_shm.buf)[:] = obs.iloc[:, 0].to_numpy(dtype=np.float64)
+        # Column-major storage keeps each chunk of candidate models contiguous. Columns are copied one at a time so
+        # that no temporary copy of all the predicted values is made
+        preds_values = np.ndarray((n_obs, n_models), dtype=np.float64, buffer=preds_shm.buf, order='F')
+        for i, (_, values) in enumerate(preds.items()):
+            preds_values[:, i] = values.to_numpy(dtype=np.float64)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach_shared,
+                                 initargs=(obs_shm.name, preds_shm.name, n_obs, n_models)) as executor:
+            results = list(executor.map(_score_chunk, [start for start, _ in chunks], [stop for _, stop in chunks],
+                                        [transf] * len(chunks)))
+    finally:
+        obs_shm.close()
+        obs_shm.unlink()
+        preds_shm.close()
+        preds_shm.unlink()
+
+    metrics = {metric: np.concatenate([result[metric] for result in results]) for metric in results[0]}
+    return pd.DataFrame(metrics, index=preds.columns)
@@ -7,11 +7,29 @@
                                                 2024-02-10
 """
 
+from typing import Union
 from modelselec.modules_paths import *
-from sklearn.metrics import (root_mean_squared_error, accuracy_score, precision_score, recall_score, f1_score,
-                             confusion_matrix)
+from modelselec.util.util_profile import profiled
 from modelselec.util.util_db import diff, ln_diff
 
+# The metrics of sklearn, imported on first use because importing sklearn is slow
+_SKLEARN_METRICS = ['root_mean_squared_error', 'accuracy_score', 'precision_score', 'recall_score', 'f1_score',
+                    'confusion_matrix']
+
+
+def __getattr__(name: str):
+    """
+    This function imports the metrics of sklearn the first time they are accessed as attributes of the module
+    :param name: str, the name of the attribute
+    :return: the sklearn metric
+    """
+    if name in _SKLEARN_METRICS:
+        import sklearn.metrics
+        return getattr(sklearn.metrics, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@profiled
 def perf_metrics(obs: pd.DataFrame, pred: pd.DataFrame, y_type: str = 'num', transf: str = None) -> dict:
     """
     This function returns useful metrics that quantify how well our model forecast the dependent variable
@@ -21,7 +39,8 @@ def perf_metrics(obs: pd.DataFrame, pred: pd.DataFrame, y_type: str = 'num', tra
                     is categorical
     :param transf: str,
     :return: dict, a dictionary with the relevant forecasting performance metrics
-                    (depending on the type of the dependent variable)
+                    (depending on the type of the dependent variable). For a categorical variable with more than 1000
+                    classes, the confusion matrix is a scipy.sparse matrix (see confusion_metrics)
     """
 
     if obs.columns != pred.columns:
@@ -46,6 +65,7 @@ def perf_metrics(obs: pd.DataFrame, pred: pd.DataFrame, y_type: str = 'num', tra
 
         lvl_corr = pred[obs.columns[0]].astype('float64').corr(obs[obs.columns[0]].astype('float64'))
 
+        from sklearn.metrics import root_mean_squared_error
         rmse = root_mean_squared_error(y_true=obs, y_pred=pred)
         nrmse = rmse/np.mean(obs)
 
@@ -60,9 +80,175 @@ def perf_metrics(obs: pd.DataFrame, pred: pd.DataFrame, y_type: str = 'num', tra
         elif transf.lower() == 'lvl':
             return {'lvlCorr': lvl_corr, 'RMSE': rmse, 'NRMSE': nrmse, 'MAPE': mape}
     elif y_type == 'categ':
-        accuracy = accuracy_score(obs, pred)
-        precision = precision_score(obs, pred, average=None)
-        recall = recall_score(obs, pred, average=None)
-        f1 = f1_score(obs, pred, average=None)
-        conf_matrix = confusion_matrix(obs, pred)
-        return {'accuracy': accuracy, 'precision': precision, 'recall': recall, 'f1': f1, 'conf_matrix': conf_matrix}
\ No newline at end of file
+        metrics = confusion_metrics(obs=obs, pred=pred)
+        return {metric: metrics[metric] for metric in ['accuracy', 'precision', 'recall', 'f1', 'conf_matrix']}
+
+@profiled
+def confusion_metrics(obs: Union[pd.DataFrame, pd.Series], pred: Union[pd.DataFrame, pd.Series],
+                      sparse: bool = None) -> dict:
+    """
+    This function returns the metrics of a categorical dependent variable from a single pass over the data: the labels
+    are converted to integer codes once and the confusion matrix is counted with np.bincount, then every metric is
+    derived from it. The metrics are the same as sklearn's, with 0 when a denominator is 0
+    :param obs: pd.DataFrame of 1 column or pd.Series which includes the observed values of the dependent variable
+    :param pred: pd.DataFrame of 1 column or pd.Series which includes the model predicted values of the dependent
+                    variable
+    :param sparse: bool, optional, True if the confusion matrix should be a scipy.sparse matrix. By default, it is
+                    sparse when there are more than 1000 classes
+    :return: dict, the sorted labels, the confusion matrix (rows are observed and columns are predicted labels), the
+                accuracy, the precision, recall, f1 and support of each class, and the precision, recall and f1
+                averaged with the 'macro', 'micro' and 'weighted' methods
+    """
+    obs_values = obs.iloc[:, 0] if isinstance(obs, pd.DataFrame) else obs
+    pred_values = pred.iloc[:, 0] if isinstance(pred, pd.DataFrame) else pred
+    if len(obs_values) != len(pred_values):
+        raise Exception('Both observed and predicted dataframes should have the same number of rows')
+
+    # Labels are sorted as in sklearn, so the metrics of each class are reported in the same order
+    codes, labels = pd.factorize(pd.concat([pd.Series(obs_values), pd.Series(pred_values)], ignore_index=True),
+                                 sort=True)
+    if (codes < 0).any():
+        raise Exception('The observed and predicted dataframes should not include missing values')
+    n_obs, n_labels = len(obs_values), len(labels)
+    obs_codes, pred_codes = codes[:n_obs].astype(np.int64), codes[n_obs:].astype(np.int64)
+
+    sparse = n_labels > 1000 if sparse is None else sparse
+    if sparse:
+        from scipy.sparse import coo_matrix
+        cells, counts = np.unique(obs_codes * n_labels + pred_codes, return_counts=True)
+        conf_matrix = coo_matrix((counts, (cells // n_labels, cells % n_labels)), shape=(n_labels, n_labels)).tocsr()
+    else:
+        conf_matrix = np.bincount(obs_codes * n_labels + pred_codes,
+                                  minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+
+    true_pos = np.bincount(obs_codes[obs_codes == pred_codes], minlength=n_labels)
+    true_sum = np.bincount(obs_codes, minlength=n_labels)
+    pred_sum = np.bincount(pred_codes, minlength=n_labels)
+    return {'labels': np.asarray(labels), 'conf_matrix': conf_matrix,
+            **_confusion_derived(true_pos=true_pos, true_sum=true_sum, pred_sum=pred_sum)}
+
+
+def _confusion_derived(true_pos: np.ndarray, true_sum: np.ndarray, pred_sum: np.ndarray) -> dict:
+    """
+    This function derives the metrics of a categorical dependent variable from the diagonal and the sums of the rows
+    and columns of its confusion matrix, with the same formulas as sklearn and 0 when a denominator is 0
+    :param true_pos: np.ndarray, the number of correct predictions of each class
+    :param true_sum: np.ndarray, the number of observations of each class
+    :param pred_sum: np.ndarray, the number of predictions of each class
+    :return: dict, the accuracy, the precision, recall, f1 and support of each class, and the precision, recall and
+                f1 averaged with the 'macro', 'micro' and 'weighted' methods
+    """
+    def divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.asarray(numerator, dtype=np.float64) / denominator
+        return np.where(denominator == 0, 0.0, ratio)
+
+    def prf(tp: np.ndarray, true: np.ndarray, predicted: np.ndarray) -> tuple:
+        return divide(tp, predicted), divide(tp, true), divide(2.0 * tp, 1.0 * true + predicted)
+
+    precision, recall, f1 = prf(true_pos, true_sum, pred_sum)
+    n_obs = true_sum.sum()
+    metrics = {'accuracy': float(true_pos.sum() / n_obs) if n_obs > 0 else 0.0, 'precision': precision,
+               'recall': recall, 'f1': f1, 'support': true_sum}
+    metrics['macro'] = {'precision': float(np.mean(precision)), 'recall': float(np.mean(recall)),
+                        'f1': float(np.mean(f1))}
+    micro = prf(true_pos.sum(keepdims=True), true_sum.sum(keepdims=True), pred_sum.sum(keepdims=True))
+    metrics['micro'] = {'precision': float(micro[0][0]), 'recall': float(micro[1][0]), 'f1': float(micro[2][0])}
+    metrics['weighted'] = {name: float(np.average(values, weights=true_sum)) if n_obs > 0 else 0.0
+                           for name, values in [('precision', precision), ('recall', recall), ('f1', f1)]}
+    return metrics
+
+
+def _corr_columns(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    This function computes the Pearson correlation between a series and each column of a matrix, over the rows where
+    both are not missing, as pd.Series.corr does
+    :param x: np.ndarray of shape (n,), the series
+    :param y: np.ndarray of shape (n, k), the matrix
+    :return: np.ndarray of shape (k,), the correlations. NaN when fewer than 2 rows are available or a variance is 0
+    """
+    x = np.where(np.isfinite(x), x, np.nan)
+    y = np.where(np.isfinite(y), y, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if not (np.isnan(x).any() or np.isnan(y).any()):
+            n = np.full(y.shape[1], len(x))
+            x_centered = x - x.mean()
+            y_centered = y - y.mean(axis=0)
+            cov = x_centered @ y_centered
+            var_x = np.full(y.shape[1], x_centered @ x_centered)
+            var_y = np.einsum('ij,ij->j', y_centered, y_centered)
+        else:
+            valid = ~np.isnan(y) & ~np.isnan(x)[:, None]
+            n = valid.sum(axis=0)
+            x_valid = np.where(valid, x[:, None], 0.0)
+            y_valid = np.where(valid, y, 0.0)
+            x_centered = np.where(valid, x_valid - x_valid.sum(axis=0) / n, 0.0)
+            y_centered = np.where(valid, y_valid - y_valid.sum(axis=0) / n, 0.0)
+            cov = np.einsum('ij,ij->j', x_centered, y_centered)
+            var_x = np.einsum('ij,ij->j', x_centered, x_centered)
+            var_y = np.einsum('ij,ij->j', y_centered, y_centered)
+        corr = cov / np.sqrt(var_x * var_y)
+    corr[(n < 2) | (var_x == 0) | (var_y == 0)] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def _batch_metrics(obs_values: np.ndarray, pred_values: np.ndarray, transf: str) -> dict:
+    """
+    This function computes the metrics of perf_metrics for a numerical dependent variable for each column of a matrix
+    of predictions
+    :param obs_values: np.ndarray of shape (n,), the observed values
+    :param pred_values: np.ndarray of shape (n, k), the predicted values of k candidate models
+    :param transf: str, one of 'lvl', 'diff' or 'diffln'
+    :return: dict, the name of each metric and an np.ndarray of shape (k,) with its values
+    """
+    errors = obs_values[:, None] - pred_values
+    rmse = np.sqrt(np.einsum('ij,ij->j', errors, errors) / len(obs_values))
+    metrics = {'lvlCorr': _corr_columns(x=obs_values, y=pred_values)}
+    match transf.lower():
+        case 'diff':
+            metrics['diffCorr'] = _corr_columns(x=np.diff(obs_values), y=np.diff(pred_values, axis=0))
+        case 'diffln':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                metrics['diffLnCorr'] = _corr_columns(x=np.diff(np.log(obs_values)),
+                                                      y=np.diff(np.log(pred_values), axis=0))
+    metrics['RMSE'] = rmse
+    metrics['NRMSE'] = rmse / np.mean(obs_values)
+    metrics['MAPE'] = np.mean(np.abs(errors / (obs_values[:, None] + 10**(-10))), axis=0)
+    return metrics
+
+
+@profiled
+def perf_metrics_batch(obs: pd.DataFrame, preds: pd.DataFrame, transf: str = 'lvl', sort_by: str = 'RMSE',
+                       ascending: bool = None) -> pd.DataFrame:
+    """
+    This function returns the same metrics as perf_metrics for a numerical dependent variable, for many candidate
+    models at once, with vectorized computations over all candidates
+    :param obs: pd.DataFrame of 1 column which includes the observed historical data of the dependent variable
+    :param preds: pd.DataFrame, one column per candidate model with its predicted values of the dependent variable,
+                    with the same number of rows as obs
+    :param transf: str, one of 'lvl', 'diff' or 'diffln', the transformation whose correlation should be reported
+                    in addition to the correlation in level
+    :param sort_by: str, optional, the metric used to rank the candidate models
+    :param ascending: bool, optional, the order of the ranking. By default, correlations are sorted in descending
+                        order and errors in ascending order
+    :return: pd.DataFrame, the leaderboard, with one row per candidate model and one column per metric
+    """
+    if len(obs.columns) != 1:
+        raise Exception('The observed dataframe should have only 1 column')
+    if len(obs) != len(preds):
+        raise Exception('Both observed and predicted dataframes should have the same number of rows')
+    if (transf is None) or (transf.lower() not in ['lvl', 'diff', 'diffln']):
+        raise Exception("'transf' should be one of the following transformations ['lvl', 'diff', 'diffln']")
+
+    obs_values = obs.iloc[:, 0].to_numpy(dtype=np.float64)
+    pred_values = preds.to_numpy(dtype=np.float64)
+    if np.isnan(obs_values).any() or np.isnan(pred_values).any():
+        raise Exception('The observed and predicted dataframes should not include missing values')
+
+    metrics = _batch_metrics(obs_values=obs_values, pred_values=pred_values, transf=transf)
+    leaderboard = pd.DataFrame(metrics, index=preds.columns)
+    if sort_by not in leaderboard.columns:
+        raise Exception(f"'sort_by' should be one of the following metrics {list(leaderboard.columns)}")
+    if ascending is None:
+        ascending = 'Corr' not in sort_by
+    return leaderboard.sort_values(by=sort_by, ascending=ascending)
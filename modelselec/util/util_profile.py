@@ -0,0 +1,203 @@
+"""
+                        This script includes instrumentation hooks which report the time spent, the size
+                            of the inputs and outputs and the memory used by each public function
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-04-02
+"""
+import attr, contextlib, functools, json, logging, threading, time, tracemalloc
+from typing import Union
+from modelselec.modules_paths import *
+
+# Profiling is enabled by setting the environment variable MODELSELEC_PROFILE to 1 (records are logged) or to the
+# path of a JSON lines file, and the peak memory is traced if MODELSELEC_PROFILE_MEMORY is set to 1
+PROFILE_ENV = 'MODELSELEC_PROFILE'
+PROFILE_MEMORY_ENV = 'MODELSELEC_PROFILE_MEMORY'
+
+_enabled = False
+_trace_memory = False
+_sinks = []
+_local = threading.local()
+
+
+@attr.define(slots=True)
+class ListSink:
+    """
+    This class stores the profiling records in memory
+    """
+
+    records: list = attr.field(factory=list)
+
+    def __call__(self, record: dict) -> None:
+        self.records.append(record)
+
+
+@attr.define(slots=True)
+class JSONLinesSink:
+    """
+    This class appends each profiling record to a JSON lines file
+    """
+
+    path: str = attr.field(validator=attr.validators.instance_of(str))
+    _lock: threading.Lock = attr.field(init=False, factory=threading.Lock)
+
+    def __call__(self, record: dict) -> None:
+        line = json.dumps(record, default=str) + '\n'
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line)
+
+
+@attr.define(slots=True)
+class LoggingSink:
+    """
+    This class sends each profiling record to a logger as a JSON message
+    """
+
+    logger: str = attr.field(default='modelselec.profile', validator=attr.validators.instance_of(str))
+    level: int = attr.field(default=logging.INFO, validator=attr.validators.instance_of(int))
+
+    def __call__(self, record: dict) -> None:
+        logging.getLogger(self.logger).log(self.level, json.dumps(record, default=str))
+
+
+def enable_profiling(sinks: list, trace_memory: bool = False) -> None:
+    """
+    This function turns on the profiling of the public functions of modelselec
+    :param sinks: list of callables, each of them receives every profiling record as a dict
+    :param trace_memory: bool, optional, True if the peak memory allocated by each call should be traced with
+                            tracemalloc, which slows down the calls
+    :return: None
+    """
+    global _enabled, _trace_memory, _sinks
+    _sinks = list(sinks)
+    _trace_memory = trace_memory
+    _enabled = len(_sinks) > 0
+
+
+def disable_profiling() -> None:
+    """
+    This function turns off the profiling of the public functions of modelselec
+    :return: None
+    """
+    global _enabled, _sinks
+    _enabled = False
+    _sinks = []
+
+
+@contextlib.contextmanager
+def profiling(sink=None, trace_memory: bool = False):
+    """
+    This context manager profiles the public functions of modelselec called inside it, the previous profiling
+    configuration is restored on exit
+    :param sink: callable, optional, receives every profiling record as a dict. By default, a ListSink
+    :param trace_memory: bool, optional, True if the peak memory allocated by each call should be traced
+    :return: the sink
+    """
+    global _enabled, _trace_memory, _sinks
+    previous = (_enabled, _trace_memory, _sinks)
+    sink = ListSink() if sink is None else sink
+    enable_profiling(sinks=[sink], trace_memory=trace_memory)
+    try:
+        yield sink
+    finally:
+        _enabled, _trace_memory, _sinks = previous
+
+
+def _size(value) -> Union[list, int, None]:
+    """
+    This function describes the size of an input or output of a profiled function
+    :param value: any object
+    :return: list of int, the shape of dataframes, series and arrays, int, the length of dicts, lists and tuples,
+                or None for other objects
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return list(value.shape)
+    if isinstance(value, (dict, list, tuple)):
+        return len(value)
+    return None
+
+
+def _profile_call(func, args: tuple, kwargs: dict):
+    """
+    This function calls a profiled function and sends its profiling record to the sinks
+    :param func: callable, the profiled function
+    :param args: tuple, the positional arguments of the call
+    :param kwargs: dict, the keyword arguments of the call
+    :return: the output of the function
+    """
+    depth = getattr(_local, 'depth', 0)
+    input_value = next((value for value in list(args) + list(kwargs.values())
+                        if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray))), None)
+    record = {'function': f'{func.__module__}.{func.__qualname__}', 'depth': depth, 'input_shape': _size(input_value)}
+
+    trace = _trace_memory
+    if trace:
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        # The peak is reset for this call, so the peak reached so far is kept aside for the enclosing call
+        start_current, start_peak = tracemalloc.get_traced_memory()
+        if not hasattr(_local, 'peaks'):
+            _local.peaks = []
+        if len(_local.peaks) > 0:
+            _local.peaks[-1] = max(_local.peaks[-1], start_peak)
+        _local.peaks.append(0)
+        tracemalloc.reset_peak()
+
+    _local.depth = depth + 1
+    error = None
+    start = time.perf_counter()
+    try:
+        output = func(*args, **kwargs)
+        return output
+    except BaseException as e:
+        error = type(e).__name__
+        output = None
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        _local.depth = depth
+        if trace:
+            peak = max(_local.peaks.pop(), tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = max(0, peak - start_current)
+            if len(_local.peaks) > 0:
+                _local.peaks[-1] = max(_local.peaks[-1], peak)
+            if started:
+                tracemalloc.stop()
+        else:
+            record['peak_bytes'] = None
+        record['output_size'] = _size(output)
+        record['error'] = error
+        for sink in _sinks:
+            sink(record)
+
+
+def profiled(func):
+    """
+    This decorator profiles a function when profiling is enabled. When it is disabled, the only overhead is the
+    check of a global flag
+    :param func: callable, the function to be profiled
+    :return: callable, the profiled function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        return _profile_call(func, args, kwargs)
+    return wrapper
+
+
+def _configure_from_env() -> None:
+    """
+    This function enables profiling if the environment variable MODELSELEC_PROFILE is set
+    :return: None
+    """
+    value = os.environ.get(PROFILE_ENV, '').strip()
+    if value.lower() in ['', '0', 'false']:
+        return
+    sink = LoggingSink() if value.lower() in ['1', 'true', 'log'] else JSONLinesSink(path=value)
+    enable_profiling(sinks=[sink], trace_memory=os.environ.get(PROFILE_MEMORY_ENV, '').strip() == '1')
+
+
+_configure_from_env()
@@ -0,0 +1,494 @@
+"""
+                        This script includes mergeable summary statistics which allow describing
+                            a database chunk by chunk, without holding all of it in memory
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-03-20
+"""
+import attr
+from typing import Tuple, Union
+from modelselec.modules_paths import *
+
+CONTINUOUS_ROWS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+CATEGORICAL_ROWS = ['count', 'unique', 'top', 'freq']
+DATETIME_ROWS = ['count', 'mean', 'min', '25%', '50%', '75%', 'max']
+
+
+@attr.define(slots=True)
+class QuantileSketch:
+    """
+    This class stores a mergeable summary of the distribution of a variable as sorted (value, weight) centroids.
+    Quantiles are exact (same linear interpolation as pandas) as long as fewer than max_size values were added,
+    beyond that neighbouring values are merged into centroids and quantiles are approximate
+    """
+
+    max_size: int = attr.field(default=4096, validator=attr.validators.and_(attr.validators.instance_of(int),
+                                                                            attr.validators.gt(1)))
+    values: np.ndarray = attr.field(factory=lambda: np.empty(0, dtype=np.float64))
+    weights: np.ndarray = attr.field(factory=lambda: np.empty(0, dtype=np.float64))
+
+    def update(self, values: np.ndarray) -> None:
+        """
+        Add non-missing observations to the sketch
+        :param values: np.ndarray, the observations
+        :return: None
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(self.values) == 0:
+            # Observations all have a weight of 1, so sorting them is enough and much faster than a stable argsort
+            self._compress(values=np.sort(values), weights=np.ones(len(values)), is_sorted=True)
+            return
+        self._compress(values=np.concatenate([self.values, values]),
+                       weights=np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """
+        Combine two sketches into a new one
+        :param other: QuantileSketch, the sketch to be merged with
+        :return: QuantileSketch, the sketch of the union of the observations of both sketches
+        """
+        merged = QuantileSketch(max_size=max(self.max_size, other.max_size))
+        merged._compress(values=np.concatenate([self.values, other.values]),
+                         weights=np.concatenate([self.weights, other.weights]))
+        return merged
+
+    def quantile(self, q: Union[float, list]) -> Union[float, np.ndarray]:
+        """
+        Compute quantiles of the summarized distribution
+        :param q: float or list of floats between 0 and 1, the quantiles to compute
+        :return: float or np.ndarray, the quantiles. NaN if the sketch is empty
+        """
+        if len(self.values) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        ranks = np.cumsum(self.weights) - self.weights / 2 - 0.5
+        return np.interp(np.asarray(q) * (self.weights.sum() - 1), ranks, self.values)
+
+    def _compress(self, values: np.ndarray, weights: np.ndarray, is_sorted: bool = False) -> None:
+        if not is_sorted:
+            order = np.argsort(values, kind='stable')
+            values, weights = values[order], weights[order]
+        if len(values) > self.max_size:
+            cum_weights = np.cumsum(weights)
+            bucket = ((cum_weights - weights / 2) / cum_weights[-1] * self.max_size).astype(np.int64)
+            bucket = np.minimum(bucket, self.max_size - 1)
+            bucket_weights = np.bincount(bucket, weights=weights, minlength=self.max_size)
+            bucket_values = np.bincount(bucket, weights=weights * values, minlength=self.max_size)
+            keep = bucket_weights > 0
+            values, weights = bucket_values[keep] / bucket_weights[keep], bucket_weights[keep]
+        self.values, self.weights = values, weights
+
+
+@attr.define(slots=True)
+class ContinuousSummary:
+    """
+    This class stores mergeable summary statistics of a continuous variable: count, Welford mean and sum of squared
+    deviations, min, max and a quantile sketch
+    """
+
+    count: int = attr.field(default=0)
+    mean: float = attr.field(default=0.0)
+    m2: float = attr.field(default=0.0)
+    min: float = attr.field(default=np.nan)
+    max: float = attr.field(default=np.nan)
+    sketch: QuantileSketch = attr.field(factory=QuantileSketch)
+
+    def update(self, values: np.ndarray) -> None:
+        """
+        Add observations to the summary, missing values are ignored
+        :param values: np.ndarray, the observations
+        :return: None
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        mean = values.mean()
+        chunk = ContinuousSummary(count=len(values), mean=mean, m2=((values - mean) ** 2).sum(), min=values.min(),
+                                  max=values.max(), sketch=QuantileSketch(max_size=self.sketch.max_size))
+        chunk.sketch.update(values)
+        merged = self.merge(chunk)
+        self.count, self.mean, self.m2 = merged.count, merged.mean, merged.m2
+        self.min, self.max, self.sketch = merged.min, merged.max, merged.sketch
+
+    def merge(self, other: 'ContinuousSummary') -> 'ContinuousSummary':
+        """
+        Combine two summaries with Chan's parallel formulas
+        :param other: ContinuousSummary, the summary to be merged with
+        :return: ContinuousSummary, the summary of the union of the observations of both summaries
+        """
+        count = self.count + other.count
+        if count == 0:
+            return ContinuousSummary(sketch=self.sketch.merge(other.sketch))
+        delta = other.mean - self.mean
+        return ContinuousSummary(count=count, mean=self.mean + delta * other.count / count,
+                                 m2=self.m2 + other.m2 + delta ** 2 * self.count * other.count / count,
+                                 min=np.fmin(self.min, other.min), max=np.fmax(self.max, other.max),
+                                 sketch=self.sketch.merge(other.sketch))
+
+    def shift(self, offset: float) -> 'ContinuousSummary':
+        """
+        Add a constant to every observation of the summary
+        :param offset: float, the constant
+        :return: ContinuousSummary, the summary of the shifted observations
+        """
+        sketch = QuantileSketch(max_size=self.sketch.max_size, values=self.sketch.values + offset,
+                                weights=self.sketch.weights)
+        return ContinuousSummary(count=self.count, mean=self.mean + offset, m2=self.m2, min=self.min + offset,
+                                 max=self.max + offset, sketch=sketch)
+
+    def describe(self) -> pd.Series:
+        """
+        Report the summary with the same rows as pd.Series.describe
+        :return: pd.Series, indexed by count, mean, std, min, 25%, 50%, 75% and max
+        """
+        std = np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+        mean = self.mean if self.count > 0 else np.nan
+        return pd.Series([float(self.count), mean, std, self.min, *self.sketch.quantile([0.25, 0.5, 0.75]),
+                          self.max], index=CONTINUOUS_ROWS, dtype=np.float64)
+
+
+@attr.define(slots=True)
+class CategoricalSummary:
+    """
+    This class stores mergeable summary statistics of a categorical variable: the frequency of each category,
+    in order of first appearance
+    """
+
+    counts: pd.Series = attr.field(factory=lambda: pd.Series(dtype=np.int64))
+
+    def update(self, values: pd.Series) -> None:
+        """
+        Add observations to the summary, missing values are ignored
+        :param values: pd.Series, the observations
+        :return: None
+        """
+        counts = values.value_counts(sort=False)
+        # The unused categories of a category dtype have a count of 0 and are not observed values
+        self.counts = self.merge(CategoricalSummary(counts=counts[counts > 0])).counts
+
+    def merge(self, other: 'CategoricalSummary') -> 'CategoricalSummary':
+        """
+        Combine two summaries
+        :param other: CategoricalSummary, the summary to be merged with
+        :return: CategoricalSummary, the summary of the union of the observations of both summaries
+        """
+        counts = pd.concat([self.counts, other.counts])
+        counts = counts.groupby(level=0, sort=False).sum().astype(np.int64)
+        return CategoricalSummary(counts=counts)
+
+    def describe(self) -> pd.Series:
+        """
+        Report the summary with the same rows as pd.Series.describe for non-numerical variables
+        :return: pd.Series, indexed by count, unique, top and freq
+        """
+        if len(self.counts) == 0:
+            return pd.Series([0, 0, np.nan, np.nan], index=CATEGORICAL_ROWS, dtype=object)
+        return pd.Series([int(self.counts.sum()), len(self.counts), self.counts.idxmax(), int(self.counts.max())],
+                         index=CATEGORICAL_ROWS, dtype=object)
+
+
+@attr.define(slots=True)
+class DatetimeSummary:
+    """
+    This class stores mergeable summary statistics of a datetime variable as the summary of its integer timestamps,
+    in the unit and time zone of the first observations. Timestamps are counted from the first observed one, so
+    that their floating point values stay small and precise
+    """
+
+    unit: Union[str, None] = attr.field(default=None)
+    tz: object = attr.field(default=None)
+    origin: Union[int, None] = attr.field(default=None)
+    summary: ContinuousSummary = attr.field(factory=ContinuousSummary)
+
+    def update(self, values: pd.Series) -> None:
+        """
+        Add observations to the summary, missing values are ignored
+        :param values: pd.Series of datetime dtype, the observations
+        :return: None
+        """
+        if self.unit is None:
+            self.unit, self.tz = values.dt.unit, values.dt.tz
+        # Time zone aware timestamps are stored as UTC integers
+        timestamps = values.dt.as_unit(self.unit).array.asi8
+        observed = ~values.isna().to_numpy()
+        if not observed.any():
+            return
+        if self.origin is None:
+            self.origin = int(timestamps[observed][0])
+        self.summary.update((timestamps[observed] - self.origin).astype(np.float64))
+
+    def merge(self, other: 'DatetimeSummary') -> 'DatetimeSummary':
+        """
+        Combine two summaries
+        :param other: DatetimeSummary, the summary to be merged with
+        :return: DatetimeSummary, the summary of the union of the observations of both summaries
+        """
+        if other.origin is None:
+            return DatetimeSummary(unit=self.unit or other.unit, tz=self.tz if self.unit else other.tz,
+                                   origin=self.origin, summary=self.summary)
+        if self.origin is None:
+            return other
+        if self.unit != other.unit:
+            raise Exception('Both datetime summaries should have the same unit')
+        return DatetimeSummary(unit=self.unit, tz=self.tz, origin=self.origin,
+                               summary=self.summary.merge(other.summary.shift(float(other.origin - self.origin))))
+
+    def describe(self) -> pd.Series:
+        """
+        Report the summary with the same rows as pd.Series.describe for datetime variables
+        :return: pd.Series, indexed by count, mean, min, 25%, 50%, 75% and max
+        """
+        def to_timestamp(value: float) -> pd.Timestamp:
+            if np.isnan(value):
+                return pd.NaT
+            # Timestamps are truncated towards 0 to the unit, as in pandas
+            whole = int(np.floor(value))
+            timestamp = self.origin + whole
+            if (timestamp < 0) and (value > whole):
+                timestamp += 1
+            timestamp = pd.Timestamp(timestamp, unit=self.unit)
+            return timestamp.tz_localize('UTC').tz_convert(self.tz) if self.tz is not None else timestamp
+
+        desc = self.summary.describe()
+        return pd.Series([int(self.summary.count)] + [to_timestamp(desc[row]) for row in DATETIME_ROWS[1:]],
+                         index=DATETIME_ROWS, dtype=object)
+
+
+def _categorical_rows(categorical: bool, datetime: bool) -> list:
+    """
+    This function lists the rows of the description of the non-numerical variables, in the order of
+    pd.DataFrame.describe(include='all')
+    :param categorical: bool, True if some variables are categorical
+    :param datetime: bool, True if some variables are datetimes
+    :return: list of str, the rows
+    """
+    rows = CATEGORICAL_ROWS if categorical else []
+    return rows + [row for row in DATETIME_ROWS if (row not in rows) and datetime]
+
+
+@attr.define(slots=True)
+class SummaryState:
+    """
+    This class stores mergeable summaries of every column of a database so that it can be described chunk by
+    chunk. Columns are split between continuous and categorical the same way as in DBhist.get_desc, and the
+    categorical datetime columns are summarized with the statistics of pd.Series.describe for datetimes. The type
+    of a column which only had missing values so far is provisional: a chunk in which it is not missing decides
+    its type
+    """
+
+    sketch_size: int = attr.field(default=4096, validator=attr.validators.instance_of(int))
+    n_rows: int = attr.field(default=0)
+    na_counts: dict = attr.field(factory=dict)
+    continuous: dict = attr.field(factory=dict)
+    categorical: dict = attr.field(factory=dict)
+    datetime: dict = attr.field(factory=dict)
+    provisional: set = attr.field(factory=set)
+
+    @classmethod
+    def from_frame(cls, db: pd.DataFrame, sketch_size: int = 4096) -> 'SummaryState':
+        """
+        Summarize a whole dataframe
+        :param db: pd.DataFrame, the dataframe to be summarized
+        :param sketch_size: int, optional, the maximum number of centroids of the quantile sketches
+        :return: SummaryState, the summary of db
+        """
+        state = cls(sketch_size=sketch_size)
+        state.update(db)
+        return state
+
+    def update(self, db: pd.DataFrame) -> None:
+        """
+        Add a chunk of rows to the summaries
+        :param db: pd.DataFrame, the chunk of rows
+        :return: None
+        """
+        continuous_cols = set(db.select_dtypes(include=np.number).columns)
+        datetime_cols = set(db.select_dtypes(include=['datetime', 'datetimetz']).columns)
+        for col in db.columns:
+            n_na = int(db[col].isna().sum())
+            # The type of a chunk in which the column only has missing values, e.g. float64 in a .csv file, is ignored
+            all_na = (n_na == len(db)) and (len(db) > 0)
+            summaries = self.continuous if col in continuous_cols else \
+                self.datetime if col in datetime_cols else self.categorical
+            if (col not in self.na_counts) or ((col in self.provisional) and not all_na):
+                for kind in self._kinds():
+                    kind.pop(col, None)
+                if col in continuous_cols:
+                    summaries[col] = ContinuousSummary(sketch=QuantileSketch(max_size=self.sketch_size))
+                elif col in datetime_cols:
+                    summaries[col] = DatetimeSummary(
+                        summary=ContinuousSummary(sketch=QuantileSketch(max_size=self.sketch_size)))
+                else:
+                    summaries[col] = CategoricalSummary()
+                if all_na:
+                    self.provisional.add(col)
+                else:
+                    self.provisional.discard(col)
+            elif (col not in summaries) and not all_na:
+                raise Exception(f"The type of column '{col}' is not the same in every chunk, "
+                                f"please provide its type through 'dtype'")
+            self.na_counts[col] = self.na_counts.get(col, 0) + n_na
+            if all_na:
+                continue
+            if col in continuous_cols:
+                summaries[col].update(db[col].to_numpy(dtype=np.float64, na_value=np.nan))
+            else:
+                summaries[col].update(db[col])
+        self.n_rows += len(db)
+
+    def _kinds(self) -> list:
+        """
+        List the dicts of summaries, one per type of column
+        :return: list of dicts, the summaries of the continuous, categorical and datetime columns
+        """
+        return [self.continuous, self.categorical, self.datetime]
+
+    def merge(self, other: 'SummaryState') -> 'SummaryState':
+        """
+        Combine two states, e.g. computed on two chunks or two files of the same database
+        :param other: SummaryState, the state to be merged with
+        :return: SummaryState, the state of the union of the rows of both states
+        """
+        merged = SummaryState(sketch_size=max(self.sketch_size, other.sketch_size), n_rows=self.n_rows + other.n_rows)
+        for col in list(self.na_counts) + [col for col in other.na_counts if col not in self.na_counts]:
+            merged.na_counts[col] = self.na_counts.get(col, 0) + other.na_counts.get(col, 0)
+            # A provisional type gives way to the type of the other state
+            states = [state for state in [self, other] if (col in state.na_counts) and (col not in state.provisional)]
+            if len(states) == 0:
+                states = [self if col in self.na_counts else other]
+                merged.provisional.add(col)
+            kinds = [next(i for i, summaries in enumerate(state._kinds()) if col in summaries) for state in states]
+            if len(set(kinds)) > 1:
+                raise Exception(f"The type of column '{col}' is not the same in both states")
+            summaries = [state._kinds()[kinds[0]][col] for state in states]
+            merged._kinds()[kinds[0]][col] = summaries[0] if len(summaries) == 1 else summaries[0].merge(summaries[1])
+        return merged
+
+    def replace_columns(self, other: 'SummaryState', removed: list = None) -> 'SummaryState':
+        """
+        Replace the summaries of some columns, e.g. after their values changed, without summarizing the other
+        columns again
+        :param other: SummaryState, the summaries of the changed columns, computed on the same rows
+        :param removed: list, optional, the names of the columns to be removed from the summaries
+        :return: SummaryState, the updated state
+        """
+        if (other.n_rows != self.n_rows) and (len(other.na_counts) > 0):
+            raise Exception('The replaced columns should be summarized on the same rows as the other columns')
+        removed = [] if removed is None else removed
+        replaced = SummaryState(sketch_size=self.sketch_size, n_rows=self.n_rows)
+        for col in list(self.na_counts) + [col for col in other.na_counts if col not in self.na_counts]:
+            if col in removed:
+                continue
+            state = other if col in other.na_counts else self
+            replaced.na_counts[col] = state.na_counts[col]
+            if col in state.provisional:
+                replaced.provisional.add(col)
+            for state_summaries, replaced_summaries in zip(state._kinds(), replaced._kinds()):
+                if col in state_summaries:
+                    replaced_summaries[col] = state_summaries[col]
+        return replaced
+
+    def get_desc(self) -> Tuple[Union[pd.DataFrame, None], Union[pd.DataFrame, None]]:
+        """
+        Describe the summarized database with the same layout as DBhist.get_desc
+        :return: the description of the continuous variables and the description of the categorical variables
+        """
+        desc_continuous, desc_categorical = None, None
+        # Columns are described in the order in which they were first seen
+        if len(self.continuous) > 0:
+            desc_continuous = pd.DataFrame({col: self.continuous[col].describe() for col in self.na_counts
+                                            if col in self.continuous})
+        if len(self.categorical) + len(self.datetime) > 0:
+            desc_categorical = pd.DataFrame({col: (self.categorical[col] if col in self.categorical else
+                                                   self.datetime[col]).describe()
+                                             for col in self.na_counts
+                                             if (col in self.categorical) or (col in self.datetime)}, dtype=object)
+            desc_categorical = desc_categorical.reindex(_categorical_rows(categorical=len(self.categorical) > 0,
+                                                                          datetime=len(self.datetime) > 0))
+        return desc_continuous, desc_categorical
+
+    def get_na_percent(self) -> pd.Series:
+        """
+        Report the percentage of NAs in each column with the same layout as DBhist.get_na_percent
+        :return: pd.Series, the percentage of observations of NAs in each column
+        """
+        prct_nas = pd.Series(self.na_counts, dtype=np.float64) / self.n_rows * 100 if self.n_rows > 0 else \
+            pd.Series(np.nan, index=list(self.na_counts), dtype=np.float64)
+        prct_nas.name = '% of NA obs.'
+        return prct_nas
+
+
+def parquet_footer_desc(path: str, columns: list = None) -> Tuple[Union[pd.DataFrame, None],
+                                                                  Union[pd.DataFrame, None], pd.Series]:
+    """
+    This function describes a .parquet file from the statistics of its row groups, stored in the footer of the file,
+    without reading the column data. Only count, min and max for continuous and datetime variables and count for
+    categorical variables are available, the other rows are NaN. Cells are also NaN when a row group has no
+    statistics for a column. Float NaN values which are not stored as nulls are not counted as missing values
+    :param path: str, the path of the .parquet file
+    :param columns: list, optional, the columns to be described. All columns by default
+    :return: the description of the continuous variables and of the categorical variables with the same layout as
+                DBhist.get_desc, and the percentage of NAs in each column with the same layout as
+                DBhist.get_na_percent
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    metadata, schema = parquet_file.metadata, parquet_file.schema_arrow
+    index_cols = [col for col in (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(col, str)]
+    columns = [name for name in schema.names if name not in index_cols] if columns is None else columns
+
+    n_rows = metadata.num_rows
+    null_counts = {col: 0 for col in columns}
+    mins, maxs = {col: None for col in columns}, {col: None for col in columns}
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        chunks = {row_group.column(j).path_in_schema: row_group.column(j) for j in range(row_group.num_columns)}
+        for col in columns:
+            stats = chunks[col].statistics if col in chunks else None
+            if (stats is None) or not stats.has_null_count:
+                null_counts[col] = np.nan
+            else:
+                null_counts[col] += stats.null_count
+            if (stats is None) or not stats.has_min_max:
+                # An empty row group has no min and max but does not change them
+                if (stats is None) or (row_group.num_rows > stats.null_count):
+                    mins[col], maxs[col] = np.nan, np.nan
+            elif mins[col] is not np.nan:
+                mins[col] = stats.min if mins[col] is None else min(mins[col], stats.min)
+                maxs[col] = stats.max if maxs[col] is None else max(maxs[col], stats.max)
+
+    # Columns are split between continuous and categorical as pandas would after reading the file
+    continuous_cols = [col for col in columns if (pa.types.is_integer(schema.field(col).type) or
+                                                  pa.types.is_floating(schema.field(col).type))]
+    datetime_cols = [col for col in columns if pa.types.is_timestamp(schema.field(col).type)]
+    categorical_cols = [col for col in columns if col not in continuous_cols]
+    counts = {col: n_rows - null_counts[col] for col in columns}
+
+    desc_continuous, desc_categorical = None, None
+    if len(continuous_cols) > 0:
+        desc_continuous = pd.DataFrame(np.nan, index=CONTINUOUS_ROWS, columns=continuous_cols)
+        for col in continuous_cols:
+            desc_continuous.loc['count', col] = counts[col]
+            desc_continuous.loc[['min', 'max'], col] = [np.nan if mins[col] is None else float(mins[col]),
+                                                        np.nan if maxs[col] is None else float(maxs[col])]
+    if len(categorical_cols) > 0:
+        rows = _categorical_rows(categorical=len(categorical_cols) > len(datetime_cols),
+                                 datetime=len(datetime_cols) > 0)
+        desc_categorical = pd.DataFrame(np.nan, index=rows, columns=categorical_cols, dtype=object)
+        for col in categorical_cols:
+            desc_categorical.loc['count', col] = counts[col]
+        for col in datetime_cols:
+            tz = schema.field(col).type.tz
+            for row, value in [('min', mins[col]), ('max', maxs[col])]:
+                if (value is not None) and (value is not np.nan):
+                    # Time zone aware timestamps are stored in UTC
+                    value = pd.Timestamp(value)
+                    desc_categorical.loc[row, col] = value.tz_convert(tz) if tz is not None else value
+
+    prct_nas = pd.Series(null_counts, dtype=np.float64) / n_rows * 100 if n_rows > 0 else \
+        pd.Series(np.nan, index=columns, dtype=np.float64)
+    prct_nas.name = '% of NA obs.'
+    return desc_continuous, desc_categorical, prct_nas
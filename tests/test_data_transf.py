@@ -10,7 +10,7 @@ import pandas as pd
 import pytest
 
 # Import the functions to test
-from modelselec.util.util_db import diff, diff_inv, ln_diff, ln_diff_inv
+from modelselec.util.util_db import diff, diff_inv, ln_diff, ln_diff_inv, panel_transform, diff_inv_paths
 
 # DataFrames for testing
 data1 = {'A': [1, 2, 3, 4],
@@ -90,4 +90,50 @@ def test_diff_inv(in_db: pd.DataFrame, in_n: int, in_t0: pd.DataFrame, expected:
 ])
 def test_ln_diff_inv(in_db: pd.DataFrame, in_n: int, in_t0: pd.DataFrame, expected: pd.DataFrame):
     assert ((ln_diff_inv(db=in_db, nTransf=in_n, t0=in_t0) - expected < 10**(-12)) |
-            (ln_diff_inv(db=in_db, nTransf=in_n, t0=in_t0).isna() & expected.isna())).all().all()
\ No newline at end of file
+            (ln_diff_inv(db=in_db, nTransf=in_n, t0=in_t0).isna() & expected.isna())).all().all()
+
+@pytest.mark.parametrize("in_n", [1, 7])
+def test_diff_inv_long(in_n: int):
+    rng = np.random.default_rng(0)
+    df_lvl = pd.DataFrame(rng.uniform(1, 2, size=(5000, 3)).cumsum(axis=0), columns=['A', 'B', 'C'])
+    pd.testing.assert_frame_equal(diff_inv(db=diff(db=df_lvl, nTransf=in_n), nTransf=in_n,
+                                           t0=df_lvl.iloc[:in_n]), df_lvl, rtol=1e-10)
+    pd.testing.assert_frame_equal(ln_diff_inv(db=ln_diff(db=df_lvl, nTransf=in_n), nTransf=in_n,
+                                              t0=df_lvl.iloc[:in_n]), df_lvl, rtol=1e-10)
+
+@pytest.mark.parametrize("in_dtype", ['float64', 'float32'])
+def test_panel_transform(in_dtype: str):
+    rng = np.random.default_rng(1)
+    panel = pd.DataFrame({'entity': np.repeat(['x', 'y', 'z'], [6, 1, 9]),
+                          'date': np.concatenate([pd.date_range('2020-01-01', periods=n, freq='MS')
+                                                  for n in [6, 1, 9]]),
+                          'A': rng.uniform(1, 10, size=16), 'B': rng.uniform(1, 10, size=16)})
+    panel = panel.sample(frac=1, random_state=0)
+    features = panel_transform(db=panel, entity='entity', time='date', lags=[1, 3], dtype=in_dtype)
+    assert list(features.columns) == ['A_diff_1', 'B_diff_1', 'A_diff_3', 'B_diff_3',
+                                      'A_ln_diff_1', 'B_ln_diff_1', 'A_ln_diff_3', 'B_ln_diff_3']
+    assert (features.dtypes == in_dtype).all()
+    assert features.index.equals(panel.index)
+    expected = []
+    for _, group in panel.sort_values('date').groupby('entity'):
+        values = group[['A', 'B']].astype(in_dtype)
+        expected.append(pd.concat([transf(db=values, nTransf=lag).add_suffix(f'_{name}_{lag}')
+                                   for name, transf in [('diff', diff), ('ln_diff', ln_diff)] for lag in [1, 3]],
+                                  axis='columns'))
+    expected = pd.concat(expected).loc[panel.index, features.columns].astype(in_dtype)
+    pd.testing.assert_frame_equal(features, expected, rtol=1e-5 if in_dtype == 'float32' else 1e-10)
+
+@pytest.mark.parametrize("in_n, in_log", [(1, False), (3, True)])
+def test_diff_inv_paths(in_n: int, in_log: bool):
+    rng = np.random.default_rng(2)
+    t0 = pd.DataFrame(rng.uniform(1, 2, size=(5, 2)), columns=['A', 'B'])
+    values = rng.normal(scale=0.1, size=(50, 8, 2))
+    paths = diff_inv_paths(values=values, nTransf=in_n, t0=t0, log=in_log, quantiles=[0.05, 0.5, 0.95])
+    assert paths['levels'].shape == (50, 8, 2)
+    inverse = ln_diff_inv if in_log else diff_inv
+    for i in [0, 17, 49]:
+        expected = inverse(db=pd.DataFrame(values[i], columns=['A', 'B']), nTransf=in_n, t0=t0).iloc[len(t0):]
+        np.testing.assert_allclose(paths['levels'][i], expected.to_numpy(), rtol=1e-12)
+    np.testing.assert_allclose(paths['bands'], np.quantile(paths['levels'], [0.05, 0.5, 0.95], axis=0))
+    assert 'bands' not in diff_inv_paths(values=values.astype(np.float32), nTransf=in_n, t0=t0.to_numpy())
+    assert diff_inv_paths(values=values.astype(np.float32), nTransf=in_n, t0=t0)['levels'].dtype == np.float32
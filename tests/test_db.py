@@ -0,0 +1,335 @@
+"""
+                        This script includes unit tests for the historical database class
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-03-12
+"""
+import os, shutil
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal, assert_series_equal
+
+from modelselec.db.db_cls import DBhist
+from modelselec.util.util_stats import SummaryState
+from modelselec.util.util_db import dataset_files, compact_dtypes
+
+path_tests_in = os.path.dirname(__file__) + '/tests_in/'
+path_tests_out = os.path.dirname(__file__) + '/tests_out/'
+if not os.path.exists(path_tests_out):
+    os.makedirs(path_tests_out)
+
+db = pd.read_csv(filepath_or_buffer=path_tests_in + 'categ_cont_vars.csv')
+db.to_parquet(path=path_tests_out + 'categ_cont_vars.parquet')
+
+# A dataset partitioned by year, whose rows are assigned to 3 years
+db_years = db.assign(year=2020 + np.arange(len(db)) % 3)
+if os.path.exists(path_tests_out + 'dataset/'):
+    shutil.rmtree(path_tests_out + 'dataset/')
+for year in range(2020, 2023):
+    os.makedirs(path_tests_out + f'dataset/year={year}/')
+    db_years.loc[db_years['year'] == year, db.columns].to_parquet(
+        path=path_tests_out + f'dataset/year={year}/part-0.parquet', index=False)
+db_dataset = pd.concat([db_years[db_years['year'] == year] for year in range(2020, 2023)], ignore_index=True)
+
+
+@pytest.mark.parametrize("path_db, file_type", [
+    (path_tests_in, 'csv'),
+    (path_tests_out, 'parquet')
+])
+def test_dbhist_eager(path_db: str, file_type: str):
+    db_hist = DBhist(path_db=path_db, file_name='categ_cont_vars', file_type=file_type)
+    assert_frame_equal(db_hist.db, db)
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical)
+
+
+@pytest.mark.parametrize("path_db, file_type", [
+    (path_tests_in, 'csv'),
+    (path_tests_out, 'parquet')
+])
+def test_dbhist_lazy(path_db: str, file_type: str):
+    db_hist = DBhist(path_db=path_db, file_name='categ_cont_vars', file_type=file_type, lazy=True,
+                     columns=['txId', 'class'], filters=[('class', '==', 'unknown')])
+    assert db_hist._db is None
+    assert db_hist._desc_stale
+
+    expected = db.loc[db['class'] == 'unknown', ['txId', 'class']]
+    assert_frame_equal(db_hist.desc_continuous, expected.describe())
+    assert_frame_equal(db_hist.db.reset_index(drop=True), expected.reset_index(drop=True))
+    assert_series_equal(db_hist.get_na_percent(), db_hist.get_na_percent(db=expected))
+
+
+def test_dbhist_desc_setter():
+    db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv', lazy=True)
+    desc_continuous = db[['txId']].describe()
+    db_hist.desc_continuous = desc_continuous
+    assert db_hist._db is None
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+
+
+@pytest.mark.parametrize("path_db, file_type, chunksize", [
+    (path_tests_in, 'csv', 7),
+    (path_tests_in, 'csv', 1000),
+    (path_tests_out, 'parquet', 7)
+])
+def test_dbhist_streaming(path_db: str, file_type: str, chunksize: int):
+    db_hist = DBhist(path_db=path_db, file_name='categ_cont_vars', file_type=file_type, chunksize=chunksize)
+    assert db_hist._db is None
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical, check_dtype=False)
+    assert_series_equal(db_hist.get_na_percent(), db_hist.get_na_percent(db=db))
+    assert db_hist._db is None
+
+
+@pytest.mark.parametrize("path_db, file_type, chunksize", [
+    (path_tests_in, 'csv', None),
+    (path_tests_in, 'csv', 7),
+    (path_tests_out, 'parquet', None),
+    (path_tests_out, 'parquet', 7)
+])
+def test_dbhist_filters_other_columns(path_db: str, file_type: str, chunksize: int):
+    # The filters have conditions on a column which is not requested
+    db_hist = DBhist(path_db=path_db, file_name='categ_cont_vars', file_type=file_type, chunksize=chunksize,
+                     columns=['txId'], filters=[('class', '=', 'unknown')], lazy=True)
+    expected = db.loc[db['class'] == 'unknown', ['txId']]
+    desc_continuous, desc_categorical = db_hist.get_desc(db=expected)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert db_hist.desc_categorical is None
+    assert_frame_equal(db_hist.db.reset_index(drop=True), expected.reset_index(drop=True))
+
+
+def test_dbhist_streaming_sparse_categ():
+    # The sparse text column only has missing values in the first chunks, which are parsed as float64
+    db_sparse = pd.DataFrame({'x': np.arange(40), 'note': [np.nan] * 30 + ['a', 'b'] * 5,
+                              'empty': np.nan, 'level': pd.Categorical(['u', 'v'] * 20, categories=['u', 'v', 'w'])})
+    db_sparse.to_csv(path_tests_out + 'sparse.csv', index=False)
+    db_sparse.to_parquet(path_tests_out + 'sparse.parquet')
+    for file_type in ['csv', 'parquet']:
+        db_hist = DBhist(path_db=path_tests_out, file_name='sparse', file_type=file_type, chunksize=8)
+        db_eager = DBhist(path_db=path_tests_out, file_name='sparse', file_type=file_type)
+        assert_frame_equal(db_hist.desc_continuous, db_eager.desc_continuous)
+        assert_frame_equal(db_hist.desc_categorical, db_eager.desc_categorical, check_dtype=False)
+        assert_series_equal(db_hist.get_na_percent(), db_eager.get_na_percent())
+    os.remove(path_tests_out + 'sparse.csv')
+    os.remove(path_tests_out + 'sparse.parquet')
+
+
+def test_summary_state_merge():
+    rng = np.random.default_rng(0)
+    db_rand = pd.DataFrame({'x': rng.normal(size=20000), 'y': rng.choice(['a', 'b', 'c'], size=20000)})
+    db_rand.loc[::17, 'x'] = np.nan
+    state = SummaryState.from_frame(db_rand.iloc[:5000]).merge(SummaryState.from_frame(db_rand.iloc[5000:]))
+    desc_continuous, desc_categorical = state.get_desc()
+    expected = db_rand[['x']].describe()
+    assert_frame_equal(desc_continuous.drop(['25%', '50%', '75%']), expected.drop(['25%', '50%', '75%']))
+    assert np.allclose(desc_continuous.loc[['25%', '50%', '75%']], expected.loc[['25%', '50%', '75%']], atol=0.01)
+    assert_frame_equal(desc_categorical, db_rand[['y']].describe(), check_dtype=False)
+
+
+@pytest.mark.parametrize("mergeable_desc", [False, True])
+def test_dbhist_append_rows(mergeable_desc: bool):
+    db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv',
+                     mergeable_desc=mergeable_desc)
+    db_hist.update_db(db_new=db.iloc[:60])
+    db_hist.append_rows(db_rows=db.iloc[60:80])
+    db_hist.append_rows(db_rows=db.iloc[80:])
+    assert len(db_hist._db_parts) == 2
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical, check_dtype=False)
+    assert_frame_equal(db_hist.db, db)
+    assert len(db_hist._db_parts) == 0
+
+
+@pytest.mark.parametrize("mergeable_desc", [False, True])
+def test_dbhist_append_rows_large(mergeable_desc: bool):
+    # Beyond the size of the quantile sketches, only the mergeable descriptions have approximate quartiles
+    rng = np.random.default_rng(0)
+    db_rand = pd.DataFrame({'x': rng.normal(size=20000), 'y': rng.choice(['a', 'b', 'c'], size=20000)})
+    db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv',
+                     mergeable_desc=mergeable_desc)
+    db_hist.update_db(db_new=db_rand.iloc[:12000])
+    db_hist.update_db(db_new=db_rand.iloc[:16000])
+    db_hist.append_rows(db_rows=db_rand.iloc[16000:])
+    assert (db_hist._summary_state is not None) == mergeable_desc
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db_rand)
+    if mergeable_desc:
+        assert np.allclose(db_hist.desc_continuous, desc_continuous, atol=0.01)
+    else:
+        assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical, check_dtype=False)
+
+
+def test_dbhist_update_columns():
+    db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv')
+    db_new = db.copy()
+    db_new['txId'] = db_new['txId'] / 2
+    db_new['txId_categ'] = db_new['txId'].astype(str)
+    db_hist.update_columns(db_columns=db_new[['txId', 'class', 'txId_categ']])
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db_new)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical)
+
+
+@pytest.mark.parametrize("db_first, db_new", [
+    (db.iloc[:30], db.iloc[:50]),
+    (db, db.assign(txId=db['txId'] * 3)),
+    (db, db.drop(columns=['random_categ'])),
+    (db, db.sample(frac=1, random_state=0))
+])
+def test_dbhist_update_db(db_first: pd.DataFrame, db_new: pd.DataFrame):
+    db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv')
+    db_hist.update_db(db_new=db_first)
+    db_hist.update_db(db_new=db_new)
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db_new)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical, check_dtype=False)
+
+
+def test_dbhist_update_db_in_place():
+    db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv')
+    db_in_place = db_hist.db
+    db_in_place['txId'] *= 1000
+    db_in_place['txId_half'] = db_in_place['txId'] / 2
+    db_hist.update_db(db_new=db_in_place)
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db_in_place)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical)
+
+
+def test_dbhist_compact():
+    db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv', compact=True)
+    assert db_hist.db['txId'].dtype == np.int32
+    assert isinstance(db_hist.db['class'].dtype, pd.CategoricalDtype)
+    report = db_hist.get_memory_report()
+    assert list(report.index) == list(db.columns) + ['Total']
+    assert report.loc['Total', 'Bytes after'] < report.loc['Total', 'Bytes before']
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical, check_dtype=False)
+
+
+def test_compact_dtypes():
+    db_mixed = pd.DataFrame({'int': [1, 2, 300], 'float_exact': [0.5, 1.0, np.nan], 'float': [0.1, 0.2, 0.3],
+                             'categ': ['a', 'b', 'a'], 'text': ['x', 'y', 'z']})
+    db_compact = compact_dtypes(db=db_mixed, category_threshold=0.7, arrow_strings=True)
+    assert list(db_compact.dtypes.astype(str)) == ['int16', 'float32', 'float64', 'category', 'string']
+    assert_frame_equal(db_compact.astype(db_mixed.dtypes.to_dict()), db_mixed)
+
+
+def test_dbhist_csv_cache():
+    path_cache = path_tests_out + 'cache/'
+    db.to_csv(path_tests_out + 'categ_cont_vars_cached.csv', index=False)
+    if os.path.exists(path_cache):
+        for file_name in os.listdir(path_cache):
+            os.remove(path_cache + file_name)
+
+    db_first = DBhist(path_db=path_tests_out, file_name='categ_cont_vars_cached', file_type='csv',
+                      cache_dir=path_cache).db
+    assert len(os.listdir(path_cache)) == 1
+    db_cached = DBhist(path_db=path_tests_out, file_name='categ_cont_vars_cached', file_type='csv',
+                       cache_dir=path_cache, columns=['class', 'txId']).db
+    assert_frame_equal(db_first, db)
+    assert_frame_equal(db_cached, db[['txId', 'class']])
+
+    db.iloc[:50].to_csv(path_tests_out + 'categ_cont_vars_cached.csv', index=False)
+    os.utime(path_tests_out + 'categ_cont_vars_cached.csv', ns=(0, 10 ** 9))
+    db_modified = DBhist(path_db=path_tests_out, file_name='categ_cont_vars_cached', file_type='csv',
+                         cache_dir=path_cache).db
+    assert_frame_equal(db_modified, db.iloc[:50])
+    assert len(os.listdir(path_cache)) == 1
+
+    DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv', cache_dir=path_cache,
+           cache_max_bytes=1)
+    assert len(os.listdir(path_cache)) == 1
+
+
+@pytest.mark.parametrize("chunksize", [None, 17])
+def test_dbhist_footer_stats(chunksize: int):
+    db_na = db.assign(n=np.arange(len(db)))
+    db_na.loc[::5, 'txId'] = np.nan
+    db_na.to_parquet(path=path_tests_out + 'categ_cont_vars_footer.parquet', row_group_size=30)
+    db_hist = DBhist(path_db=path_tests_out, file_name='categ_cont_vars_footer', footer_stats=True,
+                     chunksize=chunksize)
+    desc_continuous, desc_categorical = db_hist.get_desc(db=db_na)
+    assert_frame_equal(db_hist.desc_continuous.loc[['count', 'min', 'max']],
+                       desc_continuous.loc[['count', 'min', 'max']])
+    assert db_hist.desc_continuous.loc['mean'].isna().all()
+    assert list(db_hist.desc_categorical.loc['count']) == list(desc_categorical.loc['count'])
+    assert_series_equal(db_hist.get_na_percent(), db_hist.get_na_percent(db=db_na))
+
+    db_hist.complete_desc(stats=['mean'])
+    assert list(db_hist.desc_continuous.loc['mean']) == pytest.approx(list(desc_continuous.loc['mean']))
+    assert db_hist.desc_continuous.loc['std'].isna().all()
+    db_hist.complete_desc()
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous, check_exact=chunksize is None)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical)
+    # The data was only read to compute the missing rows of the descriptions
+    assert db_hist._db is None
+    os.remove(path_tests_out + 'categ_cont_vars_footer.parquet')
+
+
+@pytest.mark.parametrize("chunksize", [None, 17])
+def test_dbhist_datetime(chunksize: int):
+    db_dates = db.assign(date=pd.date_range('2020-01-01', periods=len(db), freq='D'),
+                         date_tz=pd.date_range('2021-06-01', periods=len(db), freq='h', tz='Europe/Paris'))
+    db_dates.loc[::7, 'date'] = pd.NaT
+    db_dates.to_parquet(path=path_tests_out + 'categ_cont_vars_dates.parquet', row_group_size=30)
+    db_hist = DBhist(path_db=path_tests_out, file_name='categ_cont_vars_dates', footer_stats=True,
+                     chunksize=chunksize)
+    # The expected descriptions are computed on the file, whose timestamps may have another unit than db_dates
+    desc_continuous, desc_categorical = db_hist.get_desc(db=pd.read_parquet(path_tests_out +
+                                                                            'categ_cont_vars_dates.parquet'))
+    assert list(desc_categorical.index) == ['count', 'unique', 'top', 'freq', 'mean', 'min', '25%', '50%', '75%',
+                                            'max']
+    assert list(db_hist.desc_categorical.index) == list(desc_categorical.index)
+    assert list(db_hist.desc_categorical.loc[['count', 'min', 'max'], 'date_tz']) == \
+        list(desc_categorical.loc[['count', 'min', 'max'], 'date_tz'])
+    db_hist.complete_desc()
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical, check_dtype=False)
+
+    db_stream = DBhist(path_db=path_tests_out, file_name='categ_cont_vars_dates', chunksize=chunksize or 13)
+    assert_frame_equal(db_stream.desc_categorical, desc_categorical, check_dtype=False)
+    assert_series_equal(db_stream.get_na_percent(), db_stream.get_na_percent(db=db_dates))
+    os.remove(path_tests_out + 'categ_cont_vars_dates.parquet')
+
+
+def test_dbhist_footer_stats_csv():
+    with pytest.raises(Exception):
+        DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv', footer_stats=True)
+
+
+@pytest.mark.parametrize("file_name, filters, years", [
+    ('dataset', None, [2020, 2021, 2022]),
+    ('dataset/year=*/*.parquet', None, [2020, 2021, 2022]),
+    ('dataset', [('year', '>=', 2021)], [2021, 2022]),
+    ('dataset', [[('year', '=', 2020)], [('year', 'in', [2022]), ('class', '!=', 'unknown')]], [2020, 2022])
+])
+def test_dbhist_dataset(file_name: str, filters: list, years: list):
+    files = dataset_files(path=path_tests_out + file_name, filters=filters)
+    assert [partition['year'] for _, partition in files] == years
+    db_hist = DBhist(path_db=path_tests_out, file_name=file_name, file_type='dataset', filters=filters, n_jobs=2)
+    expected = db_dataset[db_dataset['year'].isin(years)]
+    if filters is not None and len(filters) == 2:
+        expected = expected[(expected['year'] == 2020) | (expected['class'] != 'unknown')]
+    expected = expected.reset_index(drop=True)
+    # The descriptions are merged from the summaries of each file, before the files are concatenated
+    assert db_hist._db is None
+    desc_continuous, desc_categorical = db_hist.get_desc(db=expected)
+    assert_frame_equal(db_hist.desc_continuous, desc_continuous)
+    assert_frame_equal(db_hist.desc_categorical, desc_categorical)
+    assert_series_equal(db_hist.get_na_percent(), db_hist.get_na_percent(db=expected))
+    assert_frame_equal(db_hist.db, expected)
+
+
+def test_dbhist_dataset_columns():
+    db_hist = DBhist(path_db=path_tests_out, file_name='dataset', file_type='dataset', columns=['year', 'txId'],
+                     filters=[('class', '=', 'unknown')], lazy=True)
+    expected = db_dataset.loc[db_dataset['class'] == 'unknown', ['year', 'txId']].reset_index(drop=True)
+    assert_frame_equal(db_hist.db, expected)
+    with pytest.raises(ValueError):
+        DBhist(path_db=path_tests_out, file_name='missing/*.parquet', file_type='dataset')
@@ -6,10 +6,15 @@
                                                 2024-02-11
 """
 import pytest, os
+import numpy as np
 import pandas as pd
-from modelselec.eda.categorical_var import categorical_categorical_crosstab
+import matplotlib.pyplot as plt
+from modelselec.eda.categorical_var import categorical_categorical_crosstab, categorical_categorical_crosstab_batch, \
+    crosstab_counts, CrosstabCounts
+from modelselec.eda.eda_report import eda_report
 from modelselec.eda.continuous_var import continuous_continuous_heatmap, continuous_categorical_stats, \
-    continuous_categorical_boxplot, continuous_continuous_scatter, continuous_categorical_overlap_histogram
+    continuous_categorical_boxplot, continuous_continuous_scatter, continuous_categorical_overlap_histogram, bin_2d, \
+    continuous_categorical_histogram_counts, correlation_matrix
 from pandas.testing import assert_frame_equal
 
 path_tests_in = os.path.dirname(__file__) + '/tests_in/'
@@ -34,6 +39,16 @@ def test_continuous_categorical_overlap_histogram():
         os.remove(path_file)
 
 
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_continuous_categorical_overlap_histogram_na_categ():
+    # The continuous variable of one category is always missing
+    db_na = pd.concat([db, pd.DataFrame({'txId': [np.nan] * 3, 'class': ['missing'] * 3})], ignore_index=True)
+    counts = continuous_categorical_overlap_histogram(db=db_na, continuous_var='txId', categorical_var='class',
+                                                      path_save=path_tests_out)
+    assert counts.loc['missing'].sum() == 0
+    os.remove(path_tests_out + 'class_txId_overlap_hist.png')
+
+
 def test_continuous_categorical_boxplot():
     path_file = path_tests_out + 'class_txId_boxplot.png'
     if os.path.exists(path_file):
@@ -117,3 +132,144 @@ def test_continuous_continuous_heatmap():
     assert os.path.exists(path_file)
     if os.path.exists(path_file):
         os.remove(path_file)
+
+
+def test_continuous_categorical_stats_multiple():
+    db_mult = db.assign(txId_half=db['txId'] / 2)
+    stat_df = continuous_categorical_stats(db=db_mult, continuous_var=['txId', 'txId_half'], categorical_var='class',
+                                           stats=['mean', 'std', 'count', 'q25'])
+    for categ in class_categs:
+        series = db_mult['txId_half'][db_mult['class'] == categ]
+        assert list(stat_df.loc[categ, 'txId_half']) == pytest.approx([series.mean(), series.std(), len(series),
+                                                                       series.quantile(0.25)])
+
+
+def test_eda_report():
+    path_report = path_tests_out + 'report/'
+    manifest = eda_report(db_hist=db, path_save=path_report, n_workers=2)
+    assert manifest['n_tasks'] == 7
+    assert manifest['n_errors'] == 0
+    assert os.path.exists(path_report + 'eda_manifest.json')
+    for artifact in manifest['artifacts']:
+        for file_name in artifact['files']:
+            assert os.path.exists(path_report + file_name)
+            os.remove(path_report + file_name)
+    os.remove(path_report + 'eda_manifest.json')
+
+
+def test_continuous_continuous_scatter_aggregate():
+    path_file = path_tests_out + 'ftre_10_ftre_11_scatter.png'
+    if os.path.exists(path_file):
+        os.remove(path_file)
+    continuous_continuous_scatter(db=db_cont, x_var='ftre_10', y_var='ftre_11', path_save=path_tests_out,
+                                  aggregate=True, gridsize=50, n_outliers=20, random_state=0)
+    assert os.path.exists(path_file)
+    if os.path.exists(path_file):
+        os.remove(path_file)
+
+
+def test_bin_2d():
+    counts, x_edges, y_edges = bin_2d(x=db_cont['ftre_10'].to_numpy(), y=db_cont['ftre_11'].to_numpy(), gridsize=20,
+                                      chunk_size=7)
+    expected, _, _ = np.histogram2d(db_cont['ftre_10'], db_cont['ftre_11'], bins=[x_edges, y_edges])
+    assert np.array_equal(counts, expected)
+
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_bin_2d_nan():
+    x, y = db_cont['ftre_10'].to_numpy().copy(), db_cont['ftre_11'].to_numpy()
+    x[::5] = np.nan
+    counts, x_edges, y_edges = bin_2d(x=x, y=y, gridsize=20, chunk_size=7)
+    valid = ~np.isnan(x)
+    expected, _, _ = np.histogram2d(x[valid], y[valid], bins=[x_edges, y_edges])
+    assert np.array_equal(counts, expected)
+
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_bin_2d_non_finite():
+    x, y = db_cont['ftre_10'].to_numpy().copy(), db_cont['ftre_11'].to_numpy()
+    x[::5], x[1::5] = np.inf, -np.inf
+    counts, x_edges, y_edges = bin_2d(x=x, y=y, gridsize=20)
+    valid = np.isfinite(x)
+    assert (x_edges[0], x_edges[-1]) == (x[valid].min(), x[valid].max())
+    expected, _, _ = np.histogram2d(x[valid], y[valid], bins=[x_edges, y_edges])
+    assert np.array_equal(counts, expected)
+
+    counts, x_edges, _ = bin_2d(x=np.full(len(y), np.nan), y=y, gridsize=20)
+    assert counts.sum() == 0
+    assert (x_edges[0], x_edges[-1]) == (-0.5, 0.5)
+
+
+def test_continuous_categorical_histogram_counts():
+    counts = continuous_categorical_histogram_counts(db=db, continuous_var='txId', categorical_var='class', bins=8)
+    edges = np.append(counts.columns.left, counts.columns.right[-1])
+    assert counts.to_numpy().sum() == len(db)
+    for categ in class_categs:
+        expected, _ = np.histogram(db['txId'][db['class'] == categ], bins=edges)
+        assert np.array_equal(counts.loc[categ].to_numpy(), expected)
+
+
+@pytest.mark.parametrize('na', ['pairwise', 'complete'])
+def test_correlation_matrix(na: str):
+    db_na = db_cont.iloc[:, 5:20].copy()
+    db_na.iloc[::7, 2] = np.nan
+    db_na.iloc[3::11, 5] = np.nan
+    expected = db_na.corr() if na == 'pairwise' else db_na.dropna().corr()
+    corr = correlation_matrix(db=db_na, block_size=4, na=na, n_jobs=2)
+    assert_frame_equal(corr, expected, rtol=10**(-10))
+    corr_32 = correlation_matrix(db=db_na, block_size=4, dtype='float32', na=na)
+    assert np.allclose(corr_32, expected, atol=10**(-4))
+
+
+@pytest.mark.parametrize('top_k_by', ['overall', 'variable'])
+def test_correlation_matrix_top_k(top_k_by: str):
+    var_list = list(db_cont.columns)[5:20]
+    corr = db_cont[var_list].corr()
+    top = correlation_matrix(db=db_cont, var_list=var_list, block_size=4, top_k=3, top_k_by=top_k_by)
+    assert list(top.columns) == ['var1', 'var2', 'corr']
+    assert np.allclose(top['corr'], [corr.loc[var1, var2] for var1, var2 in zip(top['var1'], top['var2'])])
+    pairs = corr.where(~np.eye(len(var_list), dtype=bool)).stack()
+    if top_k_by == 'overall':
+        expected = pairs.abs().sort_values(ascending=False).iloc[::2].head(3)
+        assert np.allclose(top['corr'].abs(), expected)
+    else:
+        assert len(top) == 3 * len(var_list)
+        for var in var_list:
+            expected = pairs.loc[var].abs().sort_values(ascending=False).head(3)
+            assert np.allclose(top.loc[top['var1'] == var, 'corr'].abs(), expected)
+
+
+def test_continuous_continuous_heatmap_top_k():
+    path_file = path_tests_out + 'ftre_4_--_ftre_18_heatmap.png'
+    if os.path.exists(path_file):
+        os.remove(path_file)
+    var_list = list(db_cont.columns)[5:20]
+    continuous_continuous_heatmap(db=db_cont, var_list=var_list, path_save=path_tests_out, top_k=3)
+    assert os.path.exists(path_file)
+    # The plotted variables are those of the top 3 pairs
+    top = correlation_matrix(db=db_cont, var_list=var_list, top_k=3)
+    plotted = [label.get_text() for label in plt.gcf().axes[0].get_xticklabels()]
+    assert plotted == [var for var in var_list if var in set(top['var1']) | set(top['var2'])]
+    if os.path.exists(path_file):
+        os.remove(path_file)
+
+
+@pytest.mark.parametrize('norm', [None, 'all', 'columns', 'index'])
+def test_categorical_categorical_crosstab_batch(norm):
+    db_categ = db.assign(class_shifted=np.roll(db['class'].to_numpy(), 1))
+    pairs = [('class', 'random_categ'), ('random_categ', 'class_shifted'), ('class', 'class_shifted')]
+    crosstabs = categorical_categorical_crosstab_batch(db=db_categ, pairs=pairs, normalize=norm)
+    for var1, var2 in pairs:
+        assert_frame_equal(crosstabs[(var1, var2)],
+                           categorical_categorical_crosstab(db=db_categ, var1=var1, var2=var2, normalize=norm))
+
+
+def test_crosstab_counts_merge():
+    counts = CrosstabCounts(var1='class', var2='random_categ')
+    for start in range(0, len(db), 37):
+        counts.update(db.iloc[start:start + 37])
+    merged = crosstab_counts(db=db.iloc[:50], pairs=[('class', 'random_categ')])[('class', 'random_categ')].merge(
+        crosstab_counts(db=db.iloc[50:], pairs=[('class', 'random_categ')])[('class', 'random_categ')])
+    expected = categorical_categorical_crosstab(db=db, var1='class', var2='random_categ')
+    assert_frame_equal(counts.crosstab(), expected)
+    assert_frame_equal(merged.crosstab(), expected)
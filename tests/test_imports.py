@@ -0,0 +1,38 @@
+"""
+                    This script includes unit tests which check that importing modelselec stays fast
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-03-31
+"""
+import pytest, subprocess, sys
+
+HEAVY_MODULES = ['matplotlib.pyplot', 'seaborn', 'sklearn']
+
+
+def loaded_modules(code: str) -> list:
+    """
+    Runs code in a new interpreter and returns the heavy modules it loaded
+    :param code: str, the Python code to be run
+    :return: list of str, the heavy modules loaded
+    """
+    check = code + f'\nimport sys\nprint([name for name in {HEAVY_MODULES} if name in sys.modules])'
+    output = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True).stdout
+    return eval(output.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("code", [
+    ('import modelselec'),
+    ('import modelselec.util.util_db as util_db\nutil_db.diff'),
+    ('from modelselec.util.util_perf import perf_metrics_batch'),
+    ('from modelselec.db.db_cls import DBhist'),
+    ('from modelselec.eda import continuous_var, categorical_var, eda_report'),
+    ('from modelselec.modules_paths import *')
+])
+def test_import_without_heavy_modules(code):
+    assert loaded_modules(code) == []
+
+
+def test_import_on_first_use():
+    assert loaded_modules('import modelselec\nmodelselec.eda.continuous_var.plt.figure') == ['matplotlib.pyplot']
+    assert loaded_modules('from modelselec.util.util_perf import accuracy_score') == ['sklearn']
@@ -9,8 +9,12 @@ import numpy as np
 import pandas as pd
 import pytest
 
-from modelselec.util.util_perf import (perf_metrics, accuracy_score, precision_score, recall_score, f1_score,
-                                       confusion_matrix)
+from modelselec.util.util_backtest import backtest_metrics
+from modelselec.util.util_bootstrap import bootstrap_metrics, bootstrap_indices, _resampled_metrics
+from modelselec.util.util_online import NumericAccumulator, CategoricalAccumulator
+from modelselec.util.util_parallel import parallel_perf_metrics
+from modelselec.util.util_perf import (perf_metrics, perf_metrics_batch, confusion_metrics, accuracy_score,
+                                       precision_score, recall_score, f1_score, confusion_matrix)
 
 dataObs = {'A': [2, 1, 5, 7]}
 dfObs = pd.DataFrame(dataObs)
@@ -61,4 +65,210 @@ def test_perf_metrics(in_obs: pd.DataFrame, in_pred: pd.DataFrame, in_y_type: st
         assert list(map(lambda metric: np.array_equal(perf_metrics(obs=in_obs, pred=in_pred, y_type=in_y_type,
                                                                    transf=in_transf)[metric].tolist(),
                                                       expected[metric].tolist()),
-                        ['precision', 'recall', 'f1', 'conf_matrix']))
\ No newline at end of file
+                        ['precision', 'recall', 'f1', 'conf_matrix']))
+
+@pytest.mark.parametrize("in_transf", ['lvl', 'diff', 'diffLn'])
+def test_perf_metrics_batch(in_transf: str):
+    rng = np.random.default_rng(0)
+    obs = pd.DataFrame({'A': rng.uniform(1, 10, size=50)})
+    preds = pd.DataFrame(obs['A'].to_numpy()[:, None] + rng.normal(scale=[0.5, 1, 2, 4], size=(50, 4)),
+                         columns=['m1', 'm2', 'm3', 'm4']).abs()
+    leaderboard = perf_metrics_batch(obs=obs, preds=preds, transf=in_transf)
+    assert list(leaderboard.index) == ['m1', 'm2', 'm3', 'm4']
+    for model in preds.columns:
+        expected = perf_metrics(obs=obs, pred=preds[[model]].rename(columns={model: 'A'}), y_type='num',
+                                transf=in_transf)
+        assert round_dict_values(leaderboard.loc[model].to_dict()) == round_dict_values(expected)
+
+
+@pytest.mark.parametrize("in_window_type, in_transf", [
+    ('rolling', 'lvl'),
+    ('rolling', 'diff'),
+    ('expanding', 'diffLn')
+])
+def test_backtest_metrics(in_window_type: str, in_transf: str):
+    rng = np.random.default_rng(1)
+    obs = pd.DataFrame({'A': rng.uniform(1, 10, size=40)}, index=pd.date_range('2024-01-01', periods=40))
+    pred = (obs + rng.normal(size=(40, 1))).abs()
+    backtest = backtest_metrics(obs=obs, pred=pred, window=10, step=3, window_type=in_window_type,
+                                transf=in_transf)
+    assert len(backtest) == 11
+    for _, row in backtest.iterrows():
+        expected = perf_metrics(obs=obs.loc[row['start']:row['end']], pred=pred.loc[row['start']:row['end']],
+                                y_type='num', transf=in_transf)
+        assert round_dict_values(row.drop(['start', 'end']).to_dict()) == round_dict_values(expected)
+
+
+def test_backtest_metrics_nan():
+    obs = pd.DataFrame({'A': np.arange(1.0, 31.0)})
+    pred = obs.copy()
+    pred.iloc[5, 0] = np.nan
+    with pytest.raises(Exception, match='missing values'):
+        backtest_metrics(obs=obs, pred=pred, window=10)
+
+
+def test_parallel_perf_metrics():
+    rng = np.random.default_rng(2)
+    obs = pd.DataFrame({'A': rng.uniform(1, 10, size=30)})
+    preds = pd.DataFrame(obs['A'].to_numpy()[:, None] + rng.normal(size=(30, 7)),
+                         columns=[f'm{i}' for i in range(7)]).abs()
+    metrics = parallel_perf_metrics(obs=obs, preds=preds, transf='diff', n_workers=2, chunk_size=3)
+    assert list(metrics.index) == list(preds.columns)
+    pd.testing.assert_frame_equal(metrics, perf_metrics_batch(obs=obs, preds=preds, transf='diff').loc[preds.columns])
+
+
+def test_parallel_perf_metrics_no_model():
+    obs = pd.DataFrame({'A': np.arange(1.0, 31.0)})
+    with pytest.raises(Exception, match='at least 1 candidate model'):
+        parallel_perf_metrics(obs=obs, preds=pd.DataFrame(index=obs.index), n_workers=1)
+
+
+@pytest.mark.parametrize("in_transf, in_method", [
+    ('lvl', 'iid'),
+    ('diff', 'block'),
+    ('diffLn', 'block')
+])
+def test_bootstrap_metrics(in_transf: str, in_method: str):
+    rng = np.random.default_rng(3)
+    obs = pd.DataFrame({'A': rng.uniform(1, 10, size=60)})
+    pred = (obs + rng.normal(size=(60, 1))).abs()
+    boot = bootstrap_metrics(obs=obs, pred=pred, transf=in_transf, n_boot=500, method=in_method, random_state=0,
+                             chunk_size=64)
+    expected = perf_metrics(obs=obs, pred=pred, y_type='num', transf=in_transf)
+    assert round_dict_values(boot['estimate'].to_dict()) == round_dict_values(expected)
+    assert ((boot['lower'] <= boot['estimate']) & (boot['estimate'] <= boot['upper'])).all()
+    boot_workers = bootstrap_metrics(obs=obs, pred=pred, transf=in_transf, n_boot=500, method=in_method,
+                                     random_state=0, chunk_size=64, n_workers=2)
+    pd.testing.assert_frame_equal(boot, boot_workers)
+
+
+def test_bootstrap_replicates():
+    rng = np.random.default_rng(4)
+    obs = pd.DataFrame({'A': rng.uniform(1, 10, size=40)})
+    pred = (obs + rng.normal(size=(40, 1))).abs()
+    idx = bootstrap_indices(rng=rng, n_boot=5, n_obs=40, method='block', block_size=6)
+    assert idx.shape == (5, 40)
+    assert (np.diff(idx[:, :6], axis=1) == 1).all()
+    replicates = _resampled_metrics(data={'y_type': 'num', 'transf': 'lvl', 'obs': obs['A'].to_numpy(),
+                                          'pred': pred['A'].to_numpy()}, idx=idx, idx_diff=None)
+    for i in range(5):
+        expected = perf_metrics(obs=obs.iloc[idx[i]], pred=pred.iloc[idx[i]], y_type='num', transf='lvl')
+        assert round_dict_values({metric: values[i] for metric, values in replicates.items()}) == \
+            round_dict_values(expected)
+
+
+def test_bootstrap_metrics_categ():
+    rng = np.random.default_rng(5)
+    obs = pd.DataFrame({'A': rng.choice(['a', 'b', 'c'], size=80)})
+    pred = pd.DataFrame({'A': np.where(rng.random(80) < 0.6, obs['A'], rng.choice(['a', 'b', 'd'], size=80))})
+    boot = bootstrap_metrics(obs=obs, pred=pred, y_type='categ', n_boot=300, random_state=1)
+    expected = perf_metrics(obs=obs, pred=pred, y_type='categ')
+    assert boot.loc['accuracy', 'estimate'] == pytest.approx(expected['accuracy'])
+    for metric in ['precision', 'recall', 'f1']:
+        estimates = boot.loc[[f'{metric}_{label}' for label in ['a', 'b', 'c', 'd']], 'estimate']
+        assert list(estimates) == pytest.approx(list(expected[metric]))
+    assert ((boot['lower'] <= boot['estimate']) & (boot['estimate'] <= boot['upper'])).all()
+
+
+@pytest.mark.parametrize("in_n_classes, in_sparse", [
+    (3, None),
+    (12, True),
+    (1200, None)
+])
+def test_confusion_metrics(in_n_classes: int, in_sparse: bool):
+    rng = np.random.default_rng(6)
+    obs = pd.DataFrame({'A': rng.integers(0, in_n_classes, size=5000)})
+    pred = pd.DataFrame({'A': np.where(rng.random(5000) < 0.5, obs['A'], rng.integers(0, in_n_classes + 2, size=5000))})
+    metrics = confusion_metrics(obs=obs, pred=pred, sparse=in_sparse)
+    conf_matrix = metrics['conf_matrix'].toarray() if in_sparse or in_n_classes > 1000 else metrics['conf_matrix']
+    assert np.array_equal(conf_matrix, confusion_matrix(obs, pred))
+    assert metrics['accuracy'] == accuracy_score(obs, pred)
+    for metric, score in [('precision', precision_score), ('recall', recall_score), ('f1', f1_score)]:
+        assert np.array_equal(metrics[metric], score(obs, pred, average=None, zero_division=0))
+        for average in ['macro', 'micro', 'weighted']:
+            assert metrics[average][metric] == score(obs, pred, average=average, zero_division=0)
+
+
+@pytest.mark.parametrize("in_transf", ['lvl', 'diff', 'diffln'])
+def test_numeric_accumulator(in_transf: str):
+    rng = np.random.default_rng(7)
+    obs = pd.DataFrame({'A': rng.uniform(1, 10, size=100)})
+    pred = (obs + rng.normal(size=(100, 1))).abs()
+    first, second = NumericAccumulator(transf=in_transf), NumericAccumulator(transf=in_transf)
+    for start, stop in [(0, 13), (13, 40), (40, 41)]:
+        first.update(obs_batch=obs.iloc[start:stop], pred_batch=pred.iloc[start:stop])
+    second.update(obs_batch=obs['A'].to_numpy()[41:], pred_batch=pred['A'].to_numpy()[41:])
+    expected = perf_metrics(obs=obs, pred=pred, y_type='num', transf=in_transf)
+    assert round_dict_values(first.merge(second).result()) == round_dict_values(expected)
+
+    window = NumericAccumulator(transf=in_transf, window=30)
+    for start in range(0, 100, 17):
+        window.update(obs_batch=obs.iloc[start:start + 17], pred_batch=pred.iloc[start:start + 17])
+    expected = perf_metrics(obs=obs.iloc[-30:], pred=pred.iloc[-30:], y_type='num', transf=in_transf)
+    assert round_dict_values(window.result()) == round_dict_values(expected)
+
+
+def test_numeric_accumulator_decay():
+    rng = np.random.default_rng(8)
+    obs, pred = rng.uniform(1, 10, size=50), rng.uniform(1, 10, size=50)
+    accumulator = NumericAccumulator(transf='diff', decay=0.9)
+    for start in range(0, 50, 12):
+        accumulator.update(obs_batch=obs[start:start + 12], pred_batch=pred[start:start + 12])
+    weights = 0.9 ** np.arange(49, -1, -1)
+    rmse = np.sqrt(weights @ (obs - pred) ** 2 / weights.sum())
+    diff_cov = np.cov(np.diff(obs), np.diff(pred), aweights=weights[1:])
+    expected = {'lvlCorr': np.cov(obs, pred, aweights=weights)[0, 1] /
+                np.sqrt(np.prod(np.diag(np.cov(obs, pred, aweights=weights)))),
+                'diffCorr': diff_cov[0, 1] / np.sqrt(diff_cov[0, 0] * diff_cov[1, 1]),
+                'RMSE': rmse, 'NRMSE': rmse / np.average(obs, weights=weights),
+                'MAPE': np.average(np.abs((obs - pred) / obs), weights=weights)}
+    assert round_dict_values(accumulator.result()) == round_dict_values(expected)
+    with pytest.raises(Exception):
+        NumericAccumulator(decay=0.9, window=10)
+
+
+@pytest.mark.parametrize("in_transf, in_invalid", [
+    ('lvl', np.nan),
+    ('diffln', 0.0),
+    ('diffln', -1.0)
+])
+def test_numeric_accumulator_invalid(in_transf: str, in_invalid: float):
+    rng = np.random.default_rng(10)
+    obs, pred = rng.uniform(1, 10, size=40), rng.uniform(1, 10, size=40)
+    accumulator = NumericAccumulator(transf=in_transf)
+    accumulator.update(obs_batch=obs[:20], pred_batch=pred[:20])
+    invalid = pred[20:30].copy()
+    invalid[3] = in_invalid
+    with pytest.raises(Exception, match='missing values|positive values'):
+        accumulator.update(obs_batch=obs[20:30], pred_batch=invalid)
+    # The rejected batch leaves the accumulator as it was
+    accumulator.update(obs_batch=obs[20:], pred_batch=pred[20:])
+    expected = perf_metrics(obs=pd.DataFrame({'A': obs}), pred=pd.DataFrame({'A': pred}), y_type='num',
+                            transf=in_transf)
+    assert round_dict_values(accumulator.result()) == round_dict_values(expected)
+
+
+def test_categorical_accumulator():
+    rng = np.random.default_rng(9)
+    obs = pd.Series(rng.choice(['a', 'b', 'c'], size=200))
+    pred = pd.Series(np.where(rng.random(200) < 0.6, obs, rng.choice(['a', 'b', 'd'], size=200)))
+    first, second = CategoricalAccumulator(), CategoricalAccumulator()
+    for start in range(0, 120, 25):
+        first.update(obs_batch=obs.iloc[start:min(start + 25, 120)], pred_batch=pred.iloc[start:min(start + 25, 120)])
+    second.update(obs_batch=obs.iloc[120:], pred_batch=pred.iloc[120:])
+    metrics, expected = first.merge(second).result(), confusion_metrics(obs=obs, pred=pred)
+    assert list(metrics['labels']) == list(expected['labels'])
+    assert np.array_equal(metrics['conf_matrix'], expected['conf_matrix'])
+    for metric in ['accuracy', 'precision', 'recall', 'f1', 'support', 'macro', 'micro', 'weighted']:
+        assert np.all(metrics[metric] == expected[metric])
+
+    window = CategoricalAccumulator(window=50)
+    for start in range(0, 200, 30):
+        window.update(obs_batch=obs.iloc[start:start + 30], pred_batch=pred.iloc[start:start + 30])
+    expected = confusion_metrics(obs=obs.iloc[-50:], pred=pred.iloc[-50:])
+    assert np.array_equal(window.result()['conf_matrix'], expected['conf_matrix'])
+
+    decayed = CategoricalAccumulator(decay=0.5)
+    decayed.update(obs_batch=['a', 'b'], pred_batch=['a', 'a'])
+    decayed.update(obs_batch=['b'], pred_batch=['b'])
+    assert np.array_equal(decayed.result()['conf_matrix'], np.array([[0.25, 0.0], [0.5, 1.0]]))
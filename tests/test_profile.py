@@ -0,0 +1,94 @@
+"""
+                        This script includes unit tests for the profiling hooks
+
+                                            Guillaume A. Khayat
+                                           guill.khayat@gmail.com
+                                                2024-04-02
+"""
+import json, os, subprocess, sys
+import numpy as np
+import pandas as pd
+import pytest
+
+from modelselec.util import util_profile
+from modelselec.util.util_profile import profiling, profiled, ListSink
+from modelselec.util.util_db import diff, ln_diff_inv
+from modelselec.util.util_perf import perf_metrics
+from modelselec.db.db_cls import DBhist
+
+path_tests_in = os.path.dirname(__file__) + '/tests_in/'
+path_tests_out = os.path.dirname(__file__) + '/tests_out/'
+if not os.path.exists(path_tests_out):
+    os.makedirs(path_tests_out)
+
+df_lvl = pd.DataFrame({'A': np.arange(1, 101, dtype=float), 'B': np.arange(2, 102, dtype=float)})
+
+
+def test_profiling_records():
+    with profiling() as sink:
+        ln_diff_inv(db=np.log(df_lvl).diff(), nTransf=1, t0=df_lvl.head(1))
+    assert [record['function'] for record in sink.records] == ['modelselec.util.util_db.diff_inv',
+                                                                'modelselec.util.util_db.ln_diff_inv']
+    inner, outer = sink.records
+    assert (inner['depth'], outer['depth']) == (1, 0)
+    assert outer['input_shape'] == [100, 2]
+    assert outer['output_size'] == [100, 2]
+    assert outer['seconds'] >= inner['seconds'] > 0
+    assert outer['peak_bytes'] is None
+    assert outer['error'] is None
+
+
+def test_profiling_disabled():
+    with profiling() as sink:
+        diff(db=df_lvl, nTransf=1)
+    diff(db=df_lvl, nTransf=1)
+    assert len(sink.records) == 1
+    assert not util_profile._enabled
+
+
+def test_profiling_memory():
+    @profiled
+    def allocate(n: int) -> np.ndarray:
+        return np.ones(n)
+
+    @profiled
+    def allocate_twice(n: int) -> np.ndarray:
+        allocate(4 * n)
+        return allocate(n)
+
+    with profiling(trace_memory=True) as sink:
+        allocate_twice(10**6)
+    inner_first, inner_second, outer = sink.records
+    assert inner_first['peak_bytes'] >= 32 * 10**6
+    assert 8 * 10**6 <= inner_second['peak_bytes'] < 32 * 10**6
+    assert outer['peak_bytes'] >= 32 * 10**6
+
+
+def test_profiling_errors_and_methods():
+    sink = ListSink()
+    with profiling(sink=sink):
+        db_hist = DBhist(path_db=path_tests_in, file_name='categ_cont_vars', file_type='csv')
+        with pytest.raises(Exception):
+            perf_metrics(obs=df_lvl[['A']], pred=df_lvl[['B']], y_type='num')
+    functions = [record['function'] for record in sink.records]
+    assert 'modelselec.db.db_cls.DBhist.load_db' in functions
+    assert 'modelselec.db.db_cls.DBhist.get_desc' in functions
+    assert sink.records[-1]['function'] == 'modelselec.util.util_perf.perf_metrics'
+    assert sink.records[-1]['error'] == 'Exception'
+    assert db_hist.db.shape[0] > 0
+
+
+def test_profiling_environment_variable():
+    path_file = path_tests_out + 'profile.jsonl'
+    if os.path.exists(path_file):
+        os.remove(path_file)
+    code = 'import pandas as pd\nfrom modelselec.util.util_db import diff\ndiff(pd.DataFrame({"A": [1, 2, 3]}), 1)'
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.dirname(__file__)),
+                   env={**os.environ, 'MODELSELEC_PROFILE': path_file, 'MODELSELEC_PROFILE_MEMORY': '1'})
+    with open(path_file) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1
+    assert records[0]['function'] == 'modelselec.util.util_db.diff'
+    assert records[0]['input_shape'] == [3, 1]
+    assert records[0]['peak_bytes'] > 0
+    os.remove(path_file)